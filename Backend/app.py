@@ -1,14 +1,26 @@
-from flask import Flask, session, jsonify, redirect, request
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
+from flask import Flask, session, jsonify, redirect, request, g, stream_with_context
 from google_auth_oauthlib.flow import Flow
-from googleapiclient.discovery import build
 import os
 import pathlib
 import datetime
-import pytz
+import itertools
+import threading
+import time
 from dotenv import load_dotenv
 from flask_cors import CORS
+from googleapiclient.errors import HttpError
+from event_store import parse_event_time, events_range
+from fetcher import sync_all, sync_each, merge_sorted, submit
+from service_manager import ServiceManager, OFFLINE_ERRORS
+from compression import accepts_gzip, gzip_response
+from batch import run_batch, METHODS
+from notifications import calendar_from_uri
+from scheduler import UpstreamScheduler, is_rate_limited
+from users import UserRegistry, LEGACY_USER
+from shared_store import open_store
+from ics import ICSError, read_events, to_event, write_calendar
+from freebusy import to_timestamp, iso_utc, merge_intervals, free_slots, local_busy, google_busy, find_conflicts
+import metrics
 
 # Load environment variables from .env file
 load_dotenv()
@@ -30,8 +42,37 @@ SCOPES = ['https://www.googleapis.com/auth/calendar']
 # Path to the credentials.json file
 CLIENT_SECRETS_FILE = os.getenv('GOOGLE_CLIENT_SECRET')
 os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
-# Path to token.json file
-TOKEN_FILE = "A:\\Calendar App\\Backend\\token.json"
+# Public HTTPS address Google posts change notifications to, and the shared secret it echoes back
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_TOKEN = os.getenv('WEBHOOK_TOKEN')
+# Directory with one subdirectory per signed-in user: token, saved events and widget API key
+USERS_DIR = pathlib.Path(os.getenv('USERS_DIR', pathlib.Path(__file__).parent / 'users'))
+# Token and event database of a single-user install, used for requests that carry no identity
+TOKEN_FILE = pathlib.Path(os.getenv('TOKEN_FILE', pathlib.Path(__file__).parent / 'token.json'))
+EVENT_DB_FILE = pathlib.Path(os.getenv('EVENT_DB_FILE', pathlib.Path(__file__).parent / 'events.sqlite3'))
+
+# Rate limits, retries and coalescing for every call made to Google
+upstream = UpstreamScheduler()
+
+# /changes streams and long-polls a process holds open at once, each of which keeps a request
+# thread busy; past this, clients get what is pending right away and ask again CHANGE_POLL_RETRY
+# seconds later. serve.py sets it from its thread count; 0 (the default) is no limit.
+MAX_CHANGE_STREAMS = int(os.getenv('MAX_CHANGE_STREAMS', '0'))
+CHANGE_POLL_RETRY = 5
+change_stream_slots = threading.BoundedSemaphore(MAX_CHANGE_STREAMS) if MAX_CHANGE_STREAMS > 0 else None
+
+# Where workers share cached responses, change notifications and event store versions:
+# in-process by default, 'sqlite:///path' or 'redis://host:port/db' when serve.py runs several
+shared_store = open_store(os.getenv('CACHE_BACKEND'))
+
+# Each user's credentials, pooled Calendar services, event stores (refreshed with sync tokens
+# and saved to disk), response cache and change feed, kept in memory for recently active users
+users = UserRegistry(USERS_DIR, SCOPES, upstream, WEBHOOK_URL, WEBHOOK_TOKEN,
+                     legacy_token_file=TOKEN_FILE, legacy_db_file=EVENT_DB_FILE, store=shared_store)
+metrics.REGISTRY.add(metrics.Gauge('active_users', 'Users whose data is loaded in memory',
+                                   lambda: users.active_count))
+# Workers sharing a cache tier answer /metrics for all of them
+shared_metrics = metrics.SharedMetrics(shared_store) if shared_store.shared else None
 
 @app.route('/')
 def home():
@@ -59,26 +100,152 @@ def oauth2callback():
     authorization_response = request.url
     flow.fetch_token(authorization_response=authorization_response)
 
-    credentials = flow.credentials
-    with open(TOKEN_FILE, 'w') as token:
-        token.write(credentials.to_json())
-
-    return redirect(app.url_for('get_events'))
-
-# Convert datetime to local timezone
-def convert_to_local(datetime_str, tz_name='Asia/Kolkata'):
-    utc_time = datetime.datetime.fromisoformat(datetime_str.replace('Z', '+00:00'))
-    local_tz = pytz.timezone(tz_name)
-    return utc_time.astimezone(local_tz).strftime('%Y-%m-%d %H:%M:%S')
-
-# Add event
-@app.route('/add_event', methods=['POST'])
-def add_event():
-    creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
-    service = build('calendar', 'v3', credentials=creds)
-
-    event_data = request.json
-    event = {
+    # The primary calendar's ID is the account's email address, which is what identifies the user
+    probe = ServiceManager(None, SCOPES, upstream)
+    probe.store(flow.credentials)
+    with probe.service() as service:
+        user_id = service.calendars().get(calendarId='primary', fields='id').execute()['id']
+
+    user = users.sign_in(user_id, flow.credentials)
+    user.response_cache.invalidate()
+    session['user'] = user.key
+
+    return redirect(app.url_for('account'))
+
+# The signed-in user's API key, which the desktop widget sends as X-Api-Key
+@app.route('/account')
+def account():
+    user = signed_in_user()
+    if user is None:
+        return redirect('/authorize')
+    if user.key == LEGACY_USER:
+        return jsonify({'user': user.key})
+    return jsonify({'user': user.key, 'apiKey': users.api_key(user.key)})
+
+# The user a request acts for: the widget's X-Api-Key header, the browser session,
+# or failing both the single user of an install that predates multi-user support
+def current_user():
+    api_key = request.headers.get('X-Api-Key')
+    if api_key:
+        return users.for_api_key(api_key)
+    if session.get('user'):
+        return users.get(session['user'])
+    return users.legacy()
+
+# The current user if they have usable credentials, else None
+def signed_in_user():
+    user = current_user()
+    if user is None or user.service_manager.credentials() is None:
+        return None
+    return user
+
+# Read an RFC 3339 timeMin/timeMax query parameter, assuming UTC when no offset is given
+def query_time(name, default=None):
+    value = request.args.get(name)
+    if not value:
+        return default
+    parsed = parse_event_time(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed
+
+# Calendar IDs to restrict a query to, given as repeated or comma-separated calendarId parameters
+def query_calendar_ids():
+    ids = set()
+    for value in request.args.getlist('calendarId'):
+        ids.update(part for part in value.split(',') if part)
+    return ids
+
+# Partial response for calendarList().list: only the fields the backend reads
+CALENDAR_FIELDS = 'nextPageToken,items(id,summary,timeZone,primary)'
+
+# Fetch the user's calendar list, following pagination
+def list_calendars(service):
+    calendars = []
+    page_token = None
+    with metrics.span('calendar_list'):
+        while True:
+            calendars_result = service.calendarList().list(pageToken=page_token, fields=CALENDAR_FIELDS).execute()
+            calendars.extend(calendars_result.get('items', []))
+            page_token = calendars_result.get('nextPageToken')
+            if not page_token:
+                return calendars
+
+# Seconds clients are told to wait when Google did not say
+DEFAULT_RETRY_AFTER = 30
+
+# Error response for a failed request: Google's rate limiting is passed on as a 429
+# once the scheduler's retries are used up, anything else is a 500
+def error_response(e):
+    if isinstance(e, HttpError) and is_rate_limited(e.resp.status, e.content):
+        response = jsonify({'error': 'Google Calendar rate limit exceeded, try again later'})
+        response.status_code = 429
+        response.headers['Retry-After'] = e.resp.get('retry-after') or str(DEFAULT_RETRY_AFTER)
+        return response
+    return jsonify({'error': str(e)}), 500
+
+# Serve a cached JSON body, or 304 when the client already holds this ETag.
+# The gzip variant gets its own strong ETag, and either one revalidates.
+def etag_response(body, etag, compressed=None):
+    use_gzip = compressed is not None and accepts_gzip(request)
+    matched = request.if_none_match.contains(etag) or request.if_none_match.contains(etag + '-gzip')
+    if use_gzip:
+        etag += '-gzip'
+    if matched:
+        response = app.response_class(status=304)
+    elif use_gzip:
+        response = app.response_class(compressed, mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+# Compress any other large JSON response for clients that accept gzip
+@app.after_request
+def compress_response(response):
+    return gzip_response(request, response)
+
+# Requests can ask for a timing breakdown (?profile=timing or an X-Profile header), sent back
+# in Server-Timing, or for a sampled profile (?profile=sample), sent back instead of the body.
+# Both need PROFILING=1; streamed responses are only profiled up to their first byte.
+@app.before_request
+def start_request():
+    g.started = time.perf_counter()
+    mode = request.args.get('profile') or request.headers.get('X-Profile')
+    if metrics.PROFILING and mode in metrics.PROFILE_MODES:
+        g.profile = metrics.start_profile(mode)
+
+# Registered after compress_response so it runs first, on the uncompressed body
+@app.after_request
+def record_request(response):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.HTTP_DURATION.observe(time.perf_counter() - g.started, route, request.method)
+    metrics.HTTP_REQUESTS.inc(route, request.method, response.status_code)
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profile.finish()
+        if profile.mode == 'sample' and not response.is_streamed:
+            report = dict(profile.report(), status=response.status_code)
+            response = app.response_class(app.json.dumps(report), mimetype='application/json')
+        response.headers['Server-Timing'] = profile.server_timing()
+    return response
+
+@app.teardown_request
+def end_request(exc):
+    metrics.detach()
+
+# Prometheus metrics for the whole server, summed over its workers when serve.py runs several
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    body = shared_metrics.render() if shared_metrics is not None else metrics.REGISTRY.render()
+    return app.response_class(body, mimetype='text/plain; version=0.0.4')
+
+# Build a Calendar API event resource from the JSON the frontend sends
+def event_body(event_data):
+    return {
         'summary': event_data['summary'],
         'start': {
             'dateTime': event_data['start'],
@@ -90,117 +257,596 @@ def add_event():
         },
     }
 
-    event = service.events().insert(calendarId='primary', body=event).execute()
+# Drop the user's cached responses and tell their frontends which calendar and dates changed
+def notify_change(user, calendar_id, *events):
+    user.response_cache.invalidate()
+    user.change_feed.publish(user.event_store.resolve(calendar_id), events_range([e for e in events if e]))
+
+# Last synced version of an event or series instance, used to know which dates an edit or delete touched
+def stored_event(user, calendar_id, event_id):
+    store = user.event_store.get(user.event_store.resolve(calendar_id))
+    return store.get_event(event_id) if store else None
+
+# Apply a write we just made to the local store, so search and conflict checks see it
+# before the next sync; a deletion is passed as the event ID alone
+def apply_locally(user, calendar_id, event=None, deleted_id=None):
+    store = user.event_store.get(user.event_store.resolve(calendar_id))
+    if store is None:
+        return
+    if event is not None:
+        store.put(event)
+    else:
+        store.remove(deleted_id)
+
+# apply_locally() for one run_batch() result, if it succeeded
+def apply_result(user, op, result):
+    if result['status'] != 'ok':
+        return
+    if op['method'] == 'delete':
+        apply_locally(user, op['calendarId'], deleted_id=op['eventId'])
+    elif result.get('event'):
+        apply_locally(user, op['calendarId'], result['event'])
+
+# Pull the delta for a calendar Google told us about and pass it on to the user's frontends
+def refresh_calendar(user, calendar_id):
+    store = user.event_store.get(calendar_id)
+    if store is None:
+        return
+    try:
+        with user.service_manager.service() as service:
+            changed = store.sync(service)
+    except Exception:
+        app.logger.exception('Refreshing calendar %s after a notification failed', calendar_id)
+        return
+    if changed:
+        user.response_cache.invalidate()
+        user.change_feed.publish(calendar_id, events_range(changed))
+
+# Busy events across the user's synced calendars that overlap a new or edited event
+def event_conflicts(user, event_data, exclude=None):
+    start_ts = to_timestamp(event_data['start'], event_data.get('timeZone'))
+    end_ts = to_timestamp(event_data['end'], event_data.get('timeZone'))
+    return find_conflicts(user.event_store.all(), start_ts, end_ts, exclude)
+
+# Clients pass rejectConflicts=true to have a clashing event refused instead of just reported
+def reject_conflicts():
+    return request.args.get('rejectConflicts', '').lower() in ('1', 'true', 'yes')
+
+def conflict_response(conflicts):
+    return jsonify({'error': 'Event conflicts with existing events', 'conflicts': conflicts}), 409
+
+# Add event
+@app.route('/add_event', methods=['POST'])
+def add_event():
+    user = signed_in_user()
+    if user is None:
+        return redirect('/authorize')
+
+    try:
+        event = event_body(request.json)
+        conflicts = event_conflicts(user, request.json)
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'error': f'Invalid event: {e}'}), 400
+    if conflicts and reject_conflicts():
+        return conflict_response(conflicts)
 
-    return jsonify({'message': 'Event created', 'eventId': event['id']}), 201
+    try:
+        with user.service_manager.service() as service:
+            event = service.events().insert(calendarId='primary', body=event).execute()
+    except Exception as e:
+        return error_response(e)
+    notify_change(user, 'primary', event)
+    apply_locally(user, 'primary', event)
+
+    return jsonify({'message': 'Event created', 'eventId': event['id'], 'conflicts': conflicts}), 201
+
+# Media type of the opt-in streaming form of /events: one event per line
+NDJSON = 'application/x-ndjson'
+STALE_WARNING = '110 - "Response is stale, Google Calendar is unreachable"'
+# Events written to the stream per chunk
+STREAM_CHUNK = 500
+
+# Stream the window's events calendar by calendar, in the order their syncs finish.
+# Each calendar's events are in start order; a failed sync ends the stream with an error line.
+def stream_events(user, stores, min_ts, max_ts, synced):
+    def lines():
+        if synced:
+            finished = ((store, None) for store in stores)
+        else:
+            finished = sync_each(stores, user.service_manager)
+        for store, future in finished:
+            if future is not None:
+                try:
+                    future.result()
+                except OFFLINE_ERRORS:
+                    pass  # Unreachable now, send what was stored last time
+                except Exception as e:
+                    yield app.json.dumps({'error': str(e), 'calendarId': store.calendar_id}) + '\n'
+                    return
+            records = store.window(min_ts, max_ts)
+            for start in range(0, len(records), STREAM_CHUNK):
+                yield ''.join(app.json.dumps(record.to_wire(store.summary)) + '\n'
+                              for record in records[start:start + STREAM_CHUNK])
+
+    return app.response_class(lines(), mimetype=NDJSON, headers={'Cache-Control': 'no-cache'})
+
+# Refresh the calendar list and return the stores of the selected calendars, or of all of them
+def calendar_stores(user, calendar_ids):
+    with user.service_manager.service() as service:
+        calendars = list_calendars(service)
+    stores = user.event_store.set_calendars(calendars)
+    if user.watch_channels.enabled:
+        submit(user.watch_channels.ensure, [store.calendar_id for store in stores], user.service_manager)
+    if calendar_ids:
+        stores = [store for store in stores if store.calendar_id in calendar_ids]
+    return stores
+
+# Pull only what changed since the last refresh, fanning the calendars out over the fetch
+# worker pool. Requests arriving while a refresh of the same calendars is running wait for it.
+def sync_stores(user, calendar_ids):
+    def refresh():
+        stores = calendar_stores(user, calendar_ids)
+        sync_all(stores, user.service_manager)
+        return stores
+
+    return user.refreshes.do(('sync', tuple(sorted(calendar_ids))), refresh)
+
+# (stores, offline): fetch(user, calendar_ids), or while Google is unreachable the stores
+# saved last time, if there are any, with offline set so the response can be marked stale
+def current_stores(user, calendar_ids, fetch=sync_stores):
+    try:
+        return fetch(user, calendar_ids), False
+    except OFFLINE_ERRORS:
+        stores = user.event_store.all()
+        if not stores:
+            raise
+        if calendar_ids:
+            stores = [store for store in stores if store.calendar_id in calendar_ids]
+        return stores, True
 
 # Get Events from all calendars
 @app.route('/events', methods=['GET'])
 def get_events():
-    creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
+    user = signed_in_user()
+    if user is None:
+        return redirect('/authorize')
 
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            return redirect('/authorize')
+    try:
+        time_min = query_time('timeMin', datetime.datetime.now(datetime.timezone.utc))
+        time_max = query_time('timeMax')
+        calendar_ids = query_calendar_ids()
+    except ValueError as e:
+        return jsonify({'error': f'Invalid time range: {e}'}), 400
+
+    streaming = NDJSON in request.headers.get('Accept', '')
+    cache_key = ('events', request.args.get('timeMin'), request.args.get('timeMax'),
+                 tuple(sorted(calendar_ids)))
+    cached = None if streaming else user.response_cache.get(cache_key)
+    if cached:
+        return etag_response(*cached)
 
     try:
-        service = build('calendar', 'v3', credentials=creds)
-        now = datetime.datetime.utcnow().isoformat() + 'Z'  # Current time in UTC
+        # A stream syncs its calendars while it is being sent
+        stores, offline = current_stores(user, calendar_ids, calendar_stores if streaming else sync_stores)
+        min_ts = time_min.timestamp()
+        max_ts = time_max.timestamp() if time_max else None
+        if streaming:
+            response = stream_events(user, stores, min_ts, max_ts, synced=offline)
+            if offline:
+                response.headers['Warning'] = STALE_WARNING
+            return response
+
+        per_calendar = []  # Event lists sorted by start, one per calendar
+        with metrics.span('window'):
+            for store in stores:
+                per_calendar.append([record.to_wire(store.summary) for record in store.window(min_ts, max_ts)])
+            all_events = merge_sorted(per_calendar, key=lambda event: event['startTs'])
+        if offline:
+            response = jsonify(all_events)
+            response.headers['Warning'] = STALE_WARNING
+            return response
+        with metrics.span('serialize'):
+            cached = user.response_cache.put(cache_key, app.json.dumps(all_events))
+        return etag_response(*cached)
 
-        # Get all calendars
-        calendars_result = service.calendarList().list().execute()
-        calendars = calendars_result.get('items', [])
+    except Exception as e:
+        return error_response(e)
+
+@app.route('/events/<event_id>', methods=['PUT'])
+def update_event(event_id):
+    user = signed_in_user()
+    if user is None:
+        return redirect('/authorize')
 
-        all_events = []  # List to hold events from all calendars
+    try:
+        updated_event = event_body(request.json)
+        conflicts = event_conflicts(user, request.json, exclude=(user.event_store.resolve('primary'), event_id))
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'error': f'Invalid event: {e}'}), 400
+    if conflicts and reject_conflicts():
+        return conflict_response(conflicts)
 
-        for calendar in calendars:
-            calendar_id = calendar['id']
-            events_result = service.events().list(calendarId=calendar_id, timeMin=now,
-                                                  maxResults=1000000, singleEvents=True,
-                                                  orderBy='startTime').execute()
-            events = events_result.get('items', [])
-
-            for event in events:
-                start = event['start'].get('dateTime', event['start'].get('date'))
-                all_events.append({
-                    'calendarId': calendar_id,
-                    'calendarSummary': calendar['summary'],
-                    'eventId': event['id'],
-                    'start': convert_to_local(start),
-                    'summary': event.get('summary', 'No Title'),
-                    'end': event['end'].get('dateTime', event['end'].get('date'))
-                })
-
-        return jsonify(all_events)
+    try:
+        with user.service_manager.service() as service:
+            updated_event = service.events().update(calendarId='primary', eventId=event_id, body=updated_event).execute()
+        notify_change(user, 'primary', stored_event(user, 'primary', event_id), updated_event)
+        apply_locally(user, 'primary', updated_event)
+        return jsonify(dict(updated_event, conflicts=conflicts))
 
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_response(e)
 
-@app.route('/events/<event_id>', methods=['PUT'])
-def update_event(event_id):
-    creds = None
-    if TOKEN_FILE.exists():
-        creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
+def busy_periods(intervals):
+    return [{'start': iso_utc(start), 'end': iso_utc(end)} for start, end in intervals]
+
+# Busy and free time over a window, per calendar and across all of them. Calendars synced
+# locally are answered from their interval index; any other calendar (a colleague's, say),
+# or every calendar with source=google, is asked of Google's freebusy().query.
+@app.route('/freebusy', methods=['GET'])
+def get_freebusy():
+    user = signed_in_user()
+    if user is None:
+        return redirect('/authorize')
 
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
+    try:
+        time_min = query_time('timeMin', datetime.datetime.now(datetime.timezone.utc))
+        time_max = query_time('timeMax', time_min + datetime.timedelta(days=1))
+        calendar_ids = {user.event_store.resolve(calendar_id) or calendar_id for calendar_id in query_calendar_ids()}
+    except ValueError as e:
+        return jsonify({'error': f'Invalid time range: {e}'}), 400
+    if time_max <= time_min:
+        return jsonify({'error': 'timeMax must be after timeMin'}), 400
+    min_ts, max_ts = time_min.timestamp(), time_max.timestamp()
+
+    try:
+        if not user.event_store.all():
+            sync_stores(user, set())  # Nothing synced yet, load the calendars once
+        stores = [store for store in user.event_store.all()
+                  if not calendar_ids or store.calendar_id in calendar_ids]
+        if request.args.get('source') == 'google':
+            remote = calendar_ids or {store.calendar_id for store in stores}
+            stores = []
         else:
-            return redirect('/authorize')
+            remote = calendar_ids - {store.calendar_id for store in stores}
+
+        busy = local_busy(stores, min_ts, max_ts)
+        if remote:
+            with user.service_manager.service() as service:
+                busy.update(google_busy(service, remote, min_ts, max_ts))
+    except Exception as e:
+        return error_response(e)
+
+    merged = merge_intervals(interval for intervals in busy.values() if intervals for interval in intervals)
+    return jsonify({
+        'timeMin': iso_utc(min_ts),
+        'timeMax': iso_utc(max_ts),
+        'calendars': {calendar_id: {'busy': busy_periods(intervals)} if intervals is not None else {'error': 'notFound'}
+                      for calendar_id, intervals in busy.items()},
+        'busy': busy_periods(merged),
+        'free': busy_periods(free_slots(merged, min_ts, max_ts)),
+    })
+
+# Results per /search page unless the client asks for fewer or more, and the most it can ask for
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+
+# Full-text search over event summaries, locations and descriptions in all synced calendars.
+# Every word of q must match a word in the event or the start of one; exact matches rank higher.
+@app.route('/search', methods=['GET'])
+def search_events():
+    user = signed_in_user()
+    if user is None:
+        return redirect('/authorize')
 
     try:
-        service = build('calendar', 'v3', credentials=creds)
-        event_data = request.json
-        updated_event = {
-            'summary': event_data['summary'],
-            'start': {'dateTime': event_data['start'], 'timeZone': event_data['timeZone']},
-            'end': {'dateTime': event_data['end'], 'timeZone': event_data['timeZone']}
-        }
-        updated_event = service.events().update(calendarId='primary', eventId=event_id, body=updated_event).execute()
-        return jsonify(updated_event)
+        time_min = query_time('timeMin')
+        time_max = query_time('timeMax')
+        calendar_ids = {user.event_store.resolve(calendar_id) or calendar_id for calendar_id in query_calendar_ids()}
+        limit = int(request.args.get('limit', SEARCH_PAGE_SIZE))
+        offset = int(request.args.get('pageToken') or 0)
+    except ValueError as e:
+        return jsonify({'error': f'Invalid search parameters: {e}'}), 400
+    if not 1 <= limit <= SEARCH_MAX_PAGE_SIZE or offset < 0:
+        return jsonify({'error': f'limit must be 1-{SEARCH_MAX_PAGE_SIZE} and pageToken a valid offset'}), 400
 
+    try:
+        if not user.event_store.all():
+            sync_stores(user, set())  # Nothing synced yet, load the calendars once
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_response(e)
+
+    min_ts = time_min.timestamp() if time_min else None
+    max_ts = time_max.timestamp() if time_max else None
+    matches = user.search_index.search(request.args.get('q', ''), min_ts, max_ts, calendar_ids)
+    items = []
+    for (calendar_id, event_id), score in matches[offset:offset + limit]:
+        # A recurring series is listed as its first instance in the range
+        store = user.event_store.get(calendar_id)
+        record = store.find(event_id, min_ts, max_ts) if store else None
+        if record is not None:
+            items.append(dict(record.to_wire(store.summary), score=round(score, 3)))
+
+    body = {'items': items, 'total': len(matches)}
+    if offset + limit < len(matches):
+        body['nextPageToken'] = str(offset + limit)
+    return jsonify(body)
 
 @app.route('/events/<event_id>', methods=['DELETE'])
 def delete_event(event_id):
-    creds = None
-    if TOKEN_FILE.exists():
-        creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
-
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            return redirect('/authorize')
+    user = signed_in_user()
+    if user is None:
+        return redirect('/authorize')
 
     try:
-        service = build('calendar', 'v3', credentials=creds)
-        service.events().delete(calendarId='primary', eventId=event_id).execute()
+        with user.service_manager.service() as service:
+            service.events().delete(calendarId='primary', eventId=event_id).execute()
+        notify_change(user, 'primary', stored_event(user, 'primary', event_id))
+        apply_locally(user, 'primary', deleted_id=event_id)
         return jsonify({'status': 'Event deleted'})
 
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_response(e)
+
+# Create, update and delete many events through Calendar API batch requests
+@app.route('/events/batch', methods=['POST'])
+def batch_events():
+    user = signed_in_user()
+    if user is None:
+        return redirect('/authorize')
+
+    body = request.get_json(silent=True)
+    operations = body.get('operations') if isinstance(body, dict) else None
+    if not isinstance(operations, list):
+        return jsonify({'error': 'Expected a JSON body with an "operations" list'}), 400
+
+    results = [None] * len(operations)
+    valid = []  # (index, operation) pairs that can be sent upstream
+    for index, op in enumerate(operations):
+        method = op.get('method') if isinstance(op, dict) else None
+        try:
+            if method not in METHODS:
+                raise ValueError(f'method must be one of {", ".join(METHODS)}')
+            if method != 'create' and not op.get('eventId'):
+                raise ValueError('eventId is required')
+            valid.append((index, {
+                'method': method,
+                'calendarId': op.get('calendarId', 'primary'),
+                'eventId': op.get('eventId'),
+                'body': event_body(op['event']) if method != 'delete' else None,
+            }))
+        except (KeyError, TypeError, ValueError) as e:
+            results[index] = {'index': index, 'method': method, 'status': 'error',
+                              'code': 400, 'error': f'Invalid operation: {e}'}
+
+    try:
+        with user.service_manager.service() as service:
+            batch_results = run_batch(service, [op for _, op in valid])
+    except Exception as e:
+        return error_response(e)
+
+    for (index, op), result in zip(valid, batch_results):
+        result['index'] = index
+        results[index] = result
+        apply_result(user, op, result)
+    for calendar_id in {op['calendarId'] for _, op in valid}:
+        notify_change(user, calendar_id)
+
+    failed = sum(1 for result in results if result['status'] == 'error')
+    return jsonify({'results': results, 'succeeded': len(results) - failed, 'failed': failed})
+
+# Events sent upstream per import step, in batch requests; progress is reported after each step
+IMPORT_CHUNK = int(os.getenv('IMPORT_CHUNK', '500'))
+# Failures listed in an import's final line; past this they are only counted
+MAX_IMPORT_ERRORS = 100
+
+# Download the selected calendars over a time range (all of it by default) as one iCalendar file,
+# written calendar by calendar while it is sent. Recurring events go out as their rules.
+@app.route('/export.ics', methods=['GET'])
+def export_ics():
+    user = signed_in_user()
+    if user is None:
+        return redirect('/authorize')
+
+    try:
+        time_min = query_time('timeMin')
+        time_max = query_time('timeMax')
+        calendar_ids = query_calendar_ids()
+    except ValueError as e:
+        return jsonify({'error': f'Invalid time range: {e}'}), 400
+
+    try:
+        stores, offline = current_stores(user, calendar_ids)
+    except Exception as e:
+        return error_response(e)
+
+    min_ts = time_min.timestamp() if time_min else None
+    max_ts = time_max.timestamp() if time_max else None
+
+    def batches():
+        for store in stores:
+            events = store.export(min_ts, max_ts)
+            for start in range(0, len(events), STREAM_CHUNK):
+                yield events[start:start + STREAM_CHUNK]
+
+    name = stores[0].summary if len(stores) == 1 else None
+    response = app.response_class(write_calendar(batches(), name), mimetype='text/calendar')
+    response.headers['Content-Disposition'] = 'attachment; filename="calendar.ics"'
+    response.headers['Cache-Control'] = 'no-cache'
+    if offline:
+        response.headers['Warning'] = STALE_WARNING
+    return response
+
+# Import an iCalendar file, sent as the body or as a 'file' form field, into one calendar
+# (calendarId, default primary). The file is read as it arrives and sent to Google with
+# events().import in batches of IMPORT_CHUNK, under the user's upstream rate limits; importing
+# the same file again updates its events rather than duplicating them. The response is NDJSON:
+# a progress line after every batch, then a final line with done=true and the first failures.
+# A body without any VEVENT is answered with a 400 instead.
+@app.route('/import', methods=['POST'])
+def import_ics():
+    user = signed_in_user()
+    if user is None:
+        return redirect('/authorize')
+
+    calendar_id = request.args.get('calendarId', 'primary')
+    # Only a multipart upload is parsed as a form: parsing any other body (curl sends files as
+    # form-urlencoded) would use it up before it could be read as the calendar
+    upload = request.files.get('file') if request.mimetype == 'multipart/form-data' else None
+    stream = upload.stream if upload is not None else request.stream
+    # Read up to the first event before answering, so a body with none is refused outright
+    events = read_events(stream)
+    first = next(events, None)
+    if first is None:
+        return jsonify({'error': 'Expected an iCalendar file with at least one VEVENT'}), 400
+
+    def lines():
+        totals = {'processed': 0, 'imported': 0, 'skipped': 0, 'failed': 0}
+        errors = []
+        deferred = []  # Exceptions to a series, sent after every master so they have one to attach to
+
+        def fail(uid, error):
+            totals['failed'] += 1
+            if len(errors) < MAX_IMPORT_ERRORS:
+                errors.append({'uid': uid, 'error': error})
+
+        def send(operations):
+            with user.service_manager.service() as service:
+                results = run_batch(service, operations)
+            for op, result in zip(operations, results):
+                totals['processed'] += 1
+                apply_result(user, op, result)
+                if result['status'] == 'ok':
+                    totals['imported'] += 1
+                else:
+                    fail(op['body']['iCalUID'], result['error'])
+            return app.json.dumps(totals) + '\n'
+
+        chunk = []
+        try:
+            for properties in itertools.chain([first], events):
+                try:
+                    event = to_event(properties)
+                except (ICSError, ValueError, KeyError) as e:
+                    totals['processed'] += 1
+                    fail(next((value for name, _, value in properties if name == 'UID'), None), f'Invalid event: {e}')
+                    continue
+                if event is None:
+                    totals['processed'] += 1
+                    totals['skipped'] += 1
+                    continue
+                op = {'method': 'import', 'calendarId': calendar_id, 'body': event}
+                (deferred if 'originalStartTime' in event else chunk).append(op)
+                if len(chunk) >= IMPORT_CHUNK:
+                    yield send(chunk)
+                    chunk = []
+            for operations in (chunk, deferred):
+                for start in range(0, len(operations), IMPORT_CHUNK):
+                    yield send(operations[start:start + IMPORT_CHUNK])
+        except Exception as e:
+            # Whatever was sent before stays imported; report how far the import got
+            app.logger.exception('Import into %s failed', calendar_id)
+            totals['error'] = str(e)
+        finally:
+            if totals['imported']:
+                notify_change(user, calendar_id)
+        yield app.json.dumps(dict(totals, done=True, errors=errors)) + '\n'
+
+    return app.response_class(stream_with_context(lines()), mimetype=NDJSON, headers={'Cache-Control': 'no-cache'})
+
+# Webhook Google calls when a watched calendar changes.
+# Channel tokens are WEBHOOK_TOKEN followed by ':' and the user's key.
+@app.route('/notifications', methods=['POST'])
+def receive_notification():
+    token = request.headers.get('X-Goog-Channel-Token') or ''
+    if not WEBHOOK_TOKEN:
+        return '', 403
+    if token == WEBHOOK_TOKEN:
+        user = users.legacy()
+    elif token.startswith(WEBHOOK_TOKEN + ':'):
+        user = users.get(token[len(WEBHOOK_TOKEN) + 1:])
+    else:
+        return '', 403
+
+    # 'sync' only confirms that a new channel is live, nothing has changed yet
+    if user is None or request.headers.get('X-Goog-Resource-State') == 'sync':
+        return '', 200
+
+    calendar_id = (user.watch_channels.calendar_for(request.headers.get('X-Goog-Channel-ID'))
+                   or calendar_from_uri(request.headers.get('X-Goog-Resource-URI')))
+    if calendar_id:
+        # Answer right away, Google retries notifications that are slow to acknowledge
+        submit(refresh_calendar, user, calendar_id)
+    return '', 200
+
+# The current user's watch channels registered with Google
+@app.route('/notifications/channels', methods=['GET'])
+def get_channels():
+    user = current_user()
+    return jsonify(user.watch_channels.listing() if user else [])
+
+# Change notifications for frontends, as Server-Sent Events or by long-polling
+@app.route('/changes', methods=['GET'])
+def get_changes():
+    user = current_user()
+    if user is None:
+        return jsonify({'error': 'Not signed in'}), 401
+    change_feed = user.change_feed
+
+    # SSE clients resume from Last-Event-ID ('<epoch>-<seq>'), long-polling clients pass since
+    # and the epoch they got it under; either from an earlier epoch gets a reset
+    headers = {'Cache-Control': 'no-cache', 'X-Feed-Epoch': change_feed.epoch}
+    last_event_id = request.headers.get('Last-Event-ID')
+    epoch = request.args.get('epoch')
+    try:
+        if last_event_id:
+            since = change_feed.resume_seq(last_event_id)
+        elif request.args.get('since'):
+            since = int(request.args['since']) if epoch in (None, change_feed.epoch) else None
+        else:
+            since = change_feed.last_seq
+        timeout = min(float(request.args.get('timeout', 25)), 60)
+    except ValueError:
+        return jsonify({'error': 'since and timeout must be numbers'}), 400
+
+    # A client that finds every slot taken is answered at once instead of being held
+    held = change_stream_slots is None or change_stream_slots.acquire(blocking=False)
+    if 'text/event-stream' in request.headers.get('Accept', ''):
+        if held:
+            response = app.response_class(change_feed.stream(since), mimetype='text/event-stream', headers=headers)
+            if change_stream_slots is not None:
+                response.call_on_close(change_stream_slots.release)
+            return response
+        # Pending changes and a short stream that ends, which EventSource clients reconnect after
+        return app.response_class(change_feed.poll(since, CHANGE_POLL_RETRY), mimetype='text/event-stream',
+                                  headers=headers)
+
+    try:
+        if since is None:
+            changes = [change_feed.reset()]
+        else:
+            changes = change_feed.since(since, timeout if held else 0)
+    finally:
+        if held and change_stream_slots is not None:
+            change_stream_slots.release()
+    response = jsonify({'seq': changes[-1]['seq'] if changes else since, 'epoch': change_feed.epoch,
+                        'changes': changes})
+    response.headers.update(headers)
+    return response
 
 # Get all calendars
 @app.route('/calendars', methods=['GET'])
 def get_calendars():
-    creds = None
-    if TOKEN_FILE.exists():
-        creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
+    user = signed_in_user()
+    if user is None:
+        return redirect('/authorize')
 
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            return redirect('/authorize')
+    cached = user.response_cache.get(('calendars',))
+    if cached:
+        return etag_response(*cached)
 
     try:
-        service = build('calendar', 'v3', credentials=creds)
-        calendars_result = service.calendarList().list().execute()
-        calendars = calendars_result.get('items', [])
+        with user.service_manager.service() as service:
+            calendars = list_calendars(service)
 
         calendars_list = []
         for calendar in calendars:
@@ -210,10 +856,11 @@ def get_calendars():
                 'timeZone': calendar['timeZone']
             })
 
-        return jsonify(calendars_list)
+        return etag_response(*user.response_cache.put(('calendars',), app.json.dumps(calendars_list)))
 
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return error_response(e)
 
+# Development server with the reloader and debugger; serve.py runs the app for real use
 if __name__ == '__main__':
     app.run(port=9876, debug=True)
@@ -0,0 +1,90 @@
+import time
+from urllib.parse import urljoin
+
+from googleapiclient.errors import HttpError
+from googleapiclient.http import BatchHttpRequest
+
+from scheduler import MAX_RETRIES, is_retryable, parse_retry_after, retry_delay
+from service_manager import API_ENDPOINT
+
+# Requests per upstream batch call; Google allows up to 1000 but recommends 50
+BATCH_SIZE = 50
+
+METHODS = ('create', 'update', 'delete')
+# Batches follow CALENDAR_API_ENDPOINT when it is set, the discovery document always names Google
+BATCH_URI = urljoin(API_ENDPOINT, '/batch/calendar/v3') if API_ENDPOINT else None
+
+
+def _request(events, op):
+    if op['method'] == 'create':
+        return events.insert(calendarId=op['calendarId'], body=op['body'])
+    if op['method'] == 'update':
+        return events.update(calendarId=op['calendarId'], eventId=op['eventId'], body=op['body'])
+    if op['method'] == 'import':
+        # Keyed by iCalUID, so sending the same event again updates it instead of duplicating it
+        return events.import_(calendarId=op['calendarId'], body=op['body'])
+    return events.delete(calendarId=op['calendarId'], eventId=op['eventId'])
+
+
+# Send operations to Google in batch requests of BATCH_SIZE.
+# Operations Google throttled or failed with a 5xx are sent again in a later batch, after a backoff.
+# Returns one result per operation, in the order the operations were given; a successful
+# create, update or import carries the event Google returned.
+def run_batch(service, operations, batch_size=BATCH_SIZE, max_retries=MAX_RETRIES):
+    results = [None] * len(operations)
+    retry = []  # Indexes to send again after this round
+    retry_after = None
+
+    def callback(request_id, response, exception):
+        nonlocal retry_after
+        index = int(request_id)
+        if exception is None:
+            op = operations[index]
+            event_id = response.get('id') if response else op.get('eventId')
+            results[index] = {'index': index, 'method': op['method'], 'status': 'ok', 'eventId': event_id}
+            if response:
+                results[index]['event'] = response
+            return
+        resp = getattr(exception, 'resp', None)
+        if resp is not None and attempt < max_retries and is_retryable(resp.status, exception.content):
+            retry.append(index)
+            delay = parse_retry_after(resp.get('retry-after'))
+            if delay is not None:
+                retry_after = max(retry_after or 0, delay)
+            return
+        fail(index, exception)
+
+    def fail(index, exception):
+        resp = getattr(exception, 'resp', None)
+        code = resp.status if resp is not None else 500
+        reason = getattr(exception, 'reason', None) or str(exception)
+        results[index] = {'index': index, 'method': operations[index]['method'], 'status': 'error',
+                          'code': code, 'error': reason}
+
+    # Building the events resource parses its part of the discovery document, so do it once
+    events = service.events()
+    pending = list(range(len(operations)))
+    attempt = 0
+    while pending:
+        for chunk_start in range(0, len(pending), batch_size):
+            chunk = pending[chunk_start:chunk_start + batch_size]
+            if BATCH_URI:
+                batch = BatchHttpRequest(callback=callback, batch_uri=BATCH_URI)
+            else:
+                batch = service.new_batch_http_request(callback=callback)
+            for index in chunk:
+                batch.add(_request(events, operations[index]), request_id=str(index))
+            try:
+                batch.execute()
+            except HttpError as e:
+                # The whole chunk was rejected even after the scheduler's retries,
+                # report it against every operation in it
+                for index in chunk:
+                    if results[index] is None and index not in retry:
+                        fail(index, e)
+        if not retry:
+            break
+        time.sleep(retry_delay(attempt, retry_after))
+        pending, retry, retry_after = retry, [], None
+        attempt += 1
+    return results
@@ -0,0 +1,334 @@
+# Offline benchmark of the backend routes and the widget's event bookkeeping.
+# Starts fake_calendar_api.py on a free port, points a fresh backend at it and reports latency
+# percentiles, throughput, upstream calls and peak memory per scenario as JSON, e.g.:
+#   python benchmark.py --calendars 10 --events 2000 --latency 40 --output before.json
+#   python benchmark.py --calendars 10 --events 2000 --latency 40 --compare before.json
+import argparse
+import datetime
+import json
+import os
+import pathlib
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import Request, urlopen
+
+HERE = pathlib.Path(__file__).resolve().parent
+PERCENTILES = (50, 95, 99)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(sorted_values, p):
+    # Nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+
+class FakeApi:
+    # fake_calendar_api.py in its own process, so its work does not share our GIL
+    def __init__(self, args):
+        self.port = free_port()
+        self.url = f'http://127.0.0.1:{self.port}'
+        command = [sys.executable, str(HERE / 'fake_calendar_api.py'), '--port', str(self.port),
+                   '--calendars', str(args.calendars), '--events', str(args.events), '--days', str(args.days),
+                   '--recurring', str(args.recurring), '--latency', str(args.latency), '--jitter', str(args.jitter),
+                   '--error-rate', str(args.error_rate), '--error-status', str(args.error_status),
+                   '--seed', str(args.seed)]
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+        self.process.stdout.readline()  # Printed once the server is listening
+
+    def call(self, path, method='GET'):
+        with urlopen(Request(self.url + path, method=method, data=b'' if method == 'POST' else None)) as response:
+            return json.loads(response.read())
+
+    def stats(self):
+        return self.call('/_stats')
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+def backend_app(api, workdir, upstream_rate):
+    # Import the backend configured for the fake API, as the single user of a local install
+    token_file = workdir / 'token.json'
+    token_file.write_text(json.dumps({
+        'token': 'benchmark', 'refresh_token': 'benchmark', 'client_id': 'benchmark', 'client_secret': 'benchmark',
+        'token_uri': api.url + '/token', 'expiry': '2099-01-01T00:00:00Z',
+        'scopes': ['https://www.googleapis.com/auth/calendar'],
+    }))
+    os.environ.update({
+        'CALENDAR_API_ENDPOINT': api.url + '/calendar/v3/',
+        'SECRET_KEY': 'benchmark',
+        'TOKEN_FILE': str(token_file),
+        'EVENT_DB_FILE': str(workdir / 'events.sqlite3'),
+        'USERS_DIR': str(workdir / 'users'),
+        'UPSTREAM_PROJECT_RATE': str(upstream_rate),
+        'UPSTREAM_PROJECT_BURST': str(int(upstream_rate)),
+        'UPSTREAM_USER_RATE': str(upstream_rate),
+        'UPSTREAM_USER_BURST': str(int(upstream_rate)),
+    })
+    os.environ.pop('WEBHOOK_URL', None)
+    sys.path.insert(0, str(HERE))
+    import app as backend
+    return backend
+
+
+class Runner:
+    def __init__(self, api, iterations, warmup, concurrency):
+        self.api = api
+        self.iterations = iterations
+        self.warmup = warmup
+        self.concurrency = concurrency
+
+    def measure(self, fn, setup=None, iterations=None, concurrency=None):
+        # Latency percentiles, throughput, upstream calls per run and peak traced memory of fn().
+        # setup() runs untimed before every call; memory comes from one extra traced run.
+        iterations = iterations or self.iterations
+        concurrency = concurrency or self.concurrency
+        for _ in range(self.warmup):
+            if setup:
+                setup()
+            fn()
+
+        def timed(_):
+            if setup:
+                setup()
+            started = time.perf_counter()
+            fn()
+            return time.perf_counter() - started
+
+        before = self.api.stats()
+        started = time.perf_counter()
+        if concurrency > 1 and setup is None:
+            with ThreadPoolExecutor(concurrency) as pool:
+                latencies = list(pool.map(timed, range(iterations)))
+        else:
+            latencies = [timed(_) for _ in range(iterations)]
+        elapsed = time.perf_counter() - started
+        after = self.api.stats()
+
+        if setup:
+            setup()
+        tracemalloc.start()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        latencies.sort()
+        calls = {route: count - before['calls'].get(route, 0) for route, count in after['calls'].items()
+                 if count != before['calls'].get(route, 0)}
+        result = {
+            'iterations': iterations,
+            'concurrency': concurrency if setup is None else 1,
+            'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3),
+            'throughput_per_s': round(iterations / elapsed, 2),
+            'upstream_calls': sum(calls.values()),
+            'upstream_calls_per_run': round(sum(calls.values()) / iterations, 2),
+            'upstream_calls_by_route': dict(sorted(calls.items())),
+            'upstream_errors': sum(count - before['statuses'].get(status, 0)
+                                   for status, count in after['statuses'].items() if int(status) >= 400),
+            'upstream_bytes': after['bytes'] - before['bytes'],
+            'peak_memory_kb': round(peak / 1024, 1),
+        }
+        for p in PERCENTILES:
+            result[f'p{p}_ms'] = round(percentile(latencies, p) * 1000, 3)
+        return result
+
+
+def backend_scenarios(runner, backend, args):
+    client = backend.app.test_client()
+    user = backend.users.legacy()
+    today = datetime.datetime.now(datetime.timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    # The month view with a month prefetched either side, as the widget asks for it
+    month = {'timeMin': (today - datetime.timedelta(days=31)).isoformat(),
+             'timeMax': (today + datetime.timedelta(days=62)).isoformat()}
+    day = {'timeMin': today.isoformat(), 'timeMax': (today + datetime.timedelta(days=1)).isoformat()}
+
+    def get(path, params=None, headers=None, expect=200):
+        def call():
+            response = client.get(path, query_string=params, headers=headers)
+            if response.status_code != expect:
+                raise RuntimeError(f'{path} returned {response.status_code}: {response.get_data(as_text=True)[:200]}')
+            return response
+        return call
+
+    def cold():
+        user.event_store.clear()
+        user.response_cache.invalidate()
+
+    results = {}
+    results['events_cold_sync'] = runner.measure(get('/events', month), setup=cold, iterations=args.cold_iterations)
+    results['events_delta_sync'] = runner.measure(get('/events', month), setup=user.response_cache.invalidate)
+    results['events_cached'] = runner.measure(get('/events', month))
+    etag = get('/events', month)().headers['ETag']
+    results['events_not_modified'] = runner.measure(get('/events', month, {'If-None-Match': etag}, expect=304))
+    results['events_gzip'] = runner.measure(get('/events', month, {'Accept-Encoding': 'gzip'}))
+
+    def stream():
+        get('/events', month, {'Accept': 'application/x-ndjson'})().get_data()
+    results['events_ndjson'] = runner.measure(stream)
+    results['calendars'] = runner.measure(get('/calendars'), setup=user.response_cache.invalidate)
+    results['freebusy_day'] = runner.measure(get('/freebusy', day))
+    results['search'] = runner.measure(get('/search', {'q': 'plan', 'limit': 50}))
+
+    def export():
+        get('/export.ics')().get_data()
+    results['export_ics'] = runner.measure(export, setup=user.response_cache.invalidate)
+
+    # The same file every run, so later runs update the events the first one created
+    upload = ics_file(args.import_events, today)
+
+    def import_ics():
+        response = client.post('/import', query_string={'calendarId': 'calendar1@group.example.com'},
+                               data=upload, content_type='text/calendar')
+        summary = response.get_data(as_text=True).splitlines()[-1]
+        if '"failed": 0' not in summary:
+            raise RuntimeError(f'/import reported failures: {summary[:200]}')
+    result = runner.measure(import_ics, iterations=args.cold_iterations, concurrency=1)
+    result['events_per_run'] = args.import_events
+    results['import_ics'] = result
+    return results, get('/events', month)().get_json()
+
+
+# An iCalendar file of count hour-long events spread over the 90 days from start
+def ics_file(count, start):
+    lines = ['BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//benchmark//EN']
+    for index in range(count):
+        begin = start + datetime.timedelta(days=index % 90, hours=8 + index % 10)
+        lines += ['BEGIN:VEVENT', f'UID:benchmark-{index}@example.com',
+                  f"DTSTART:{begin.strftime('%Y%m%dT%H%M%SZ')}", 'DURATION:PT1H',
+                  f'SUMMARY:Imported event {index}', 'END:VEVENT']
+    lines.append('END:VCALENDAR')
+    return ('\r\n'.join(lines) + '\r\n').encode('utf-8')
+
+
+def frontend_scenarios(runner, events):
+    # The widget's own bookkeeping, fed the /events payload the backend just served
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    sys.path.insert(0, str(HERE.parent))
+    try:
+        from PyQt6.QtCore import QDate
+        from PyQt6.QtWidgets import QApplication, QCalendarWidget, QLineEdit
+        import frontend
+    except ImportError as e:
+        return {'skipped': f'frontend unavailable: {e}'}
+    qt_app = QApplication.instance() or QApplication([])
+
+    class WidgetData:
+        # CalendarWidget's event methods without its window, network client or timers
+        organize_events_by_date = frontend.CalendarWidget.organize_events_by_date
+        add_events_by_date = frontend.CalendarWidget.add_events_by_date
+        update_events_list = frontend.CalendarWidget.update_events_list
+
+        def __init__(self):
+            self.events_by_date = {}
+            self.events_model = frontend.EventListModel()
+            self.search_input = QLineEdit()
+            self.calendar = QCalendarWidget()
+
+    widget = WidgetData()
+    days = sorted({datetime.date.fromordinal(event['day']) for event in events}) or [datetime.date.today()]
+    results = {'organize_events_by_date': runner.measure(lambda: widget.organize_events_by_date(events),
+                                                         concurrency=1)}
+
+    def select_each_day():
+        for day in days:
+            widget.calendar.setSelectedDate(QDate(day))
+            widget.update_events_list()
+    result = runner.measure(select_each_day, concurrency=1)
+    result['days_per_run'] = len(days)
+    results['update_events_list_all_days'] = result
+
+    # Marker index for the shown month, rebuilt on every change to the events and every page turn
+    shown = datetime.date.today()
+    results['month_markers'] = runner.measure(
+        lambda: frontend.MonthMarkers(shown.year, shown.month, widget.events_by_date), concurrency=1)
+
+    calendar = frontend.CustomCalendarWidget()
+    calendar.resize(300, 250)
+    calendar.set_events(widget.events_by_date)
+    results['paint_month'] = runner.measure(calendar.grab, concurrency=1)
+    qt_app.processEvents()
+    return results
+
+
+# Relative change of the latency percentiles against an earlier run, per scenario
+def compare(current, baseline):
+    rows = []
+    for group in ('backend', 'frontend'):
+        for name, result in current.get(group, {}).items():
+            old = baseline.get(group, {}).get(name)
+            if not isinstance(result, dict) or not isinstance(old, dict):
+                continue
+            row = {'scenario': f'{group}.{name}'}
+            for key in [f'p{p}_ms' for p in PERCENTILES] + ['upstream_calls_per_run', 'peak_memory_kb']:
+                if old.get(key):
+                    row[key] = f'{result[key] / old[key] - 1:+.1%}'
+            rows.append(row)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the backend against a local fake Calendar API')
+    parser.add_argument('--calendars', type=int, default=5)
+    parser.add_argument('--events', type=int, default=500, help='events per calendar')
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--recurring', type=float, default=0.05)
+    parser.add_argument('--latency', type=float, default=0.0, help='mean upstream milliseconds per call')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--error-status', type=int, default=503, choices=[403, 429, 500, 503])
+    parser.add_argument('--upstream-rate', type=float, default=10000,
+                        help='calls per second the backend lets itself make, high by default so quota is not measured')
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--cold-iterations', type=int, default=5)
+    parser.add_argument('--import-events', type=int, default=1000, help='events in the file import_ics uploads')
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--skip-frontend', action='store_true')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    parser.add_argument('--compare', help='earlier JSON report to compare against')
+    args = parser.parse_args()
+
+    api = FakeApi(args)
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            backend = backend_app(api, pathlib.Path(workdir), args.upstream_rate)
+            runner = Runner(api, args.iterations, args.warmup, args.concurrency)
+            backend_results, events = backend_scenarios(runner, backend, args)
+            report = {
+                'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+                'environment': {'python': platform.python_version(), 'platform': platform.platform()},
+                'window_events': len(events),
+                'backend': backend_results,
+            }
+            if not args.skip_frontend:
+                report['frontend'] = frontend_scenarios(runner, events)
+    finally:
+        api.close()
+
+    if args.compare:
+        report['comparison'] = compare(report, json.loads(pathlib.Path(args.compare).read_text()))
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        pathlib.Path(args.output).write_text(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
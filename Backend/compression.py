@@ -0,0 +1,30 @@
+import gzip
+
+# Bodies smaller than this are not worth the CPU or the extra header
+MIN_SIZE = 1024
+LEVEL = 6
+
+
+def compress(body):
+    if len(body) < MIN_SIZE:
+        return None
+    return gzip.compress(body, LEVEL)
+
+
+def accepts_gzip(request):
+    return 'gzip' in request.accept_encodings
+
+
+# Gzip a finished JSON response in place when the client allows it
+def gzip_response(request, response):
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers or response.mimetype != 'application/json'):
+        return response
+    response.vary.add('Accept-Encoding')
+    if not accepts_gzip(request):
+        return response
+    compressed = compress(response.get_data())
+    if compressed is not None:
+        response.set_data(compressed)
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
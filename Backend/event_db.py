@@ -0,0 +1,87 @@
+import json
+import sqlite3
+import threading
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS calendars (
+    calendar_id TEXT PRIMARY KEY,
+    summary TEXT,
+    is_primary INTEGER NOT NULL DEFAULT 0,
+    sync_token TEXT
+);
+CREATE TABLE IF NOT EXISTS events (
+    calendar_id TEXT NOT NULL,
+    event_id TEXT NOT NULL,
+    start_ts REAL NOT NULL,
+    end_ts REAL NOT NULL,
+    body TEXT NOT NULL,
+    PRIMARY KEY (calendar_id, event_id)
+);
+CREATE INDEX IF NOT EXISTS events_by_start ON events (calendar_id, start_ts);
+'''
+# Bumped when saved events can no longer be used as they are. Version 1 keeps recurring
+# events as masters and exceptions, where earlier stores held one copy per instance;
+# version 2 events carry the iCalUID that /export.ics writes.
+SCHEMA_VERSION = 2
+
+
+class EventDatabase:
+    # SQLite copy of the event stores and their sync tokens, so a restart resumes with a delta sync
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(SCHEMA)
+        if self._conn.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+            # Drop the old copies and their sync tokens, the next refresh is a full sync
+            with self._conn:
+                self._conn.execute('DELETE FROM events')
+                self._conn.execute('UPDATE calendars SET sync_token = NULL')
+            self._conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        self._lock = threading.Lock()
+
+    def load_calendars(self):
+        with self._lock:
+            return self._conn.execute(
+                'SELECT calendar_id, summary, is_primary, sync_token FROM calendars').fetchall()
+
+    def load_events(self, calendar_id):
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT body FROM events WHERE calendar_id = ? ORDER BY start_ts', (calendar_id,)).fetchall()
+        return [json.loads(body) for body, in rows]
+
+    def load_sync_token(self, calendar_id):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT sync_token FROM calendars WHERE calendar_id = ?', (calendar_id,)).fetchone()
+        return row[0] if row else None
+
+    def save_calendar(self, calendar_id, summary, is_primary, sync_token, upserts, deletes, reset=False):
+        # upserts are (event_id, start_ts, end_ts, event) tuples, deletes are event IDs
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT INTO calendars (calendar_id, summary, is_primary, sync_token) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(calendar_id) DO UPDATE SET summary = excluded.summary, '
+                'is_primary = excluded.is_primary, sync_token = excluded.sync_token',
+                (calendar_id, summary, int(bool(is_primary)), sync_token))
+            if reset:
+                self._conn.execute('DELETE FROM events WHERE calendar_id = ?', (calendar_id,))
+            self._conn.executemany(
+                'DELETE FROM events WHERE calendar_id = ? AND event_id = ?',
+                [(calendar_id, event_id) for event_id in deletes])
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO events (calendar_id, event_id, start_ts, end_ts, body) VALUES (?, ?, ?, ?, ?)',
+                [(calendar_id, event_id, start_ts, end_ts, json.dumps(event))
+                 for event_id, start_ts, end_ts, event in upserts])
+
+    def delete_calendar(self, calendar_id):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM events WHERE calendar_id = ?', (calendar_id,))
+            self._conn.execute('DELETE FROM calendars WHERE calendar_id = ?', (calendar_id,))
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM events')
+            self._conn.execute('DELETE FROM calendars')
@@ -0,0 +1,62 @@
+import datetime
+import functools
+import os
+
+import pytz
+
+# Timezone event times are shown in, and that decides which day an event falls on
+DISPLAY_TIMEZONE = os.getenv('DISPLAY_TIMEZONE', 'Asia/Kolkata')
+
+
+@functools.lru_cache(maxsize=None)
+def get_timezone(name):
+    return pytz.timezone(name)
+
+
+class EventRecord:
+    # Compact, pre-parsed view of one Calendar event, built once per event version
+    __slots__ = ('calendar_id', 'event_id', 'summary', 'start_ts', 'end_ts',
+                 'all_day', 'busy', 'day', 'start_text', 'end_text')
+
+    def __init__(self, calendar_id, event, tz_name=DISPLAY_TIMEZONE):
+        tz = get_timezone(tz_name)
+        self.calendar_id = calendar_id
+        self.event_id = event['id']
+        self.summary = event.get('summary', 'No Title')
+        self.all_day = 'dateTime' not in event['start']
+        # Events marked 'Show as available' do not block time
+        self.busy = event.get('transparency') != 'transparent'
+
+        if self.all_day:
+            # All-day events are floating dates: the same day everywhere, starting at local midnight
+            start_date = datetime.date.fromisoformat(event['start']['date'])
+            end_date = datetime.date.fromisoformat(event['end']['date'])
+            self.start_ts = tz.localize(datetime.datetime.combine(start_date, datetime.time())).timestamp()
+            self.end_ts = tz.localize(datetime.datetime.combine(end_date, datetime.time())).timestamp()
+            self.day = start_date.toordinal()
+            self.start_text = start_date.isoformat()
+            self.end_text = end_date.isoformat()
+        else:
+            start = datetime.datetime.fromisoformat(event['start']['dateTime'].replace('Z', '+00:00')).astimezone(tz)
+            end = datetime.datetime.fromisoformat(event['end']['dateTime'].replace('Z', '+00:00')).astimezone(tz)
+            self.start_ts = start.timestamp()
+            self.end_ts = end.timestamp()
+            self.day = start.toordinal()
+            self.start_text = start.strftime('%Y-%m-%d %H:%M:%S')
+            self.end_text = end.strftime('%Y-%m-%d %H:%M:%S')
+
+    def to_wire(self, calendar_summary):
+        # start/end are local display strings; startTs/endTs are epoch seconds and
+        # day is the local date's ordinal, so clients never have to parse times
+        return {
+            'calendarId': self.calendar_id,
+            'calendarSummary': calendar_summary,
+            'eventId': self.event_id,
+            'summary': self.summary,
+            'start': self.start_text,
+            'end': self.end_text,
+            'startTs': self.start_ts,
+            'endTs': self.end_ts,
+            'allDay': self.all_day,
+            'day': self.day,
+        }
@@ -0,0 +1,412 @@
+import bisect
+import datetime
+import itertools
+import threading
+from googleapiclient.errors import HttpError
+
+from event_record import EventRecord
+from recurrence import Series, instance_suffix
+
+# Largest page size accepted by events().list
+PAGE_SIZE = 2500
+# Partial response: only the event fields the backend actually uses
+EVENT_FIELDS = ('nextPageToken,nextSyncToken,items(id,iCalUID,status,summary,location,description,start,end,'
+                'transparency,recurrence,recurringEventId,originalStartTime)')
+
+
+# Parse an event's dateTime or all-day date into an aware UTC datetime
+def parse_event_time(value):
+    if 'T' not in value:
+        value += 'T00:00:00+00:00'
+    return datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+def event_bounds(event):
+    start = event['start'].get('dateTime', event['start'].get('date'))
+    end = event['end'].get('dateTime', event['end'].get('date'))
+    return parse_event_time(start), parse_event_time(end)
+
+
+class CalendarEventStore:
+    # Local copy of one calendar's events, kept current with sync tokens. When workers share a
+    # cache tier, each save bumps a version there, and a worker that finds its copy behind
+    # reloads it from the database before syncing.
+    def __init__(self, calendar_id, summary=None, database=None, search_index=None, shared=None, namespace=''):
+        self.calendar_id = calendar_id
+        self.summary = summary
+        self.primary = False
+        self.events = {}  # Every stored event: single events, series masters and their exceptions
+        self.records = {}  # Event ID -> EventRecord for single events and exceptions that still happen
+        self.series = {}  # Master event ID -> Series, expanded into instances per window
+        self._overrides = {}  # Master event ID -> suffixes of the instances its exceptions replace
+        self.sync_token = None
+        self.database = database
+        self.search_index = search_index
+        self.lock = threading.Lock()
+        # Event IDs changed since the last save to the database, and whether it must start over
+        self._dirty = set()
+        self._reset = False
+        # Interval index over the records, rebuilt lazily after the store changes
+        self._index = None
+        self.shared = shared
+        self._version_key = f'{namespace}:events:{calendar_id}'
+        self._version = 0  # Version of the saved copy this one matches
+
+    def sync(self, service):
+        with self.lock:
+            self._catch_up()
+            try:
+                changed = self._pull(service)
+            except HttpError as e:
+                # 410 Gone means the sync token expired, start over with a full sync
+                if e.resp.status != 410:
+                    raise
+                if self.search_index is not None:
+                    self.search_index.remove_calendar(self.calendar_id)
+                self._load([], None)
+                self._reset = True
+                changed = self._pull(service)
+            self.save()
+            return changed
+
+    def load(self, events, sync_token):
+        with self.lock:
+            self._load(events, sync_token)
+            if self.shared is not None:
+                self._version = self.shared.counter(self._version_key)
+
+    def _load(self, events, sync_token):
+        self._index = None
+        self.events = {}
+        self.records = {}
+        self.series = {}
+        self._overrides = {}
+        indexed = [self._insert(event) for event in events]
+        self.sync_token = sync_token
+        if self.search_index is not None:
+            self.search_index.add_many(pair for pair in indexed if pair is not None)
+
+    def _catch_up(self):
+        # Start from the saved copy if another worker saved a newer one than ours
+        if self.shared is None or self.database is None:
+            return
+        version = self.shared.counter(self._version_key)
+        if version == self._version:
+            return
+        if self.search_index is not None:
+            self.search_index.remove_calendar(self.calendar_id)
+        self._load(self.database.load_events(self.calendar_id), self.database.load_sync_token(self.calendar_id))
+        self._dirty.clear()
+        self._version = version
+
+    def save(self):
+        # Write what changed since the last save; callers hold self.lock
+        if self.database is None:
+            return
+        upserts = []
+        deletes = []
+        for event_id in self._dirty:
+            event = self.events.get(event_id)
+            if event is None:
+                deletes.append(event_id)
+            else:
+                # Cancelled instances of a series have no span of their own
+                span = self.records.get(event_id) or self.series.get(event_id)
+                upserts.append((event_id, span.start_ts if span else 0.0, span.end_ts if span else 0.0, event))
+        self.database.save_calendar(self.calendar_id, self.summary, self.primary, self.sync_token,
+                                    upserts, deletes, reset=self._reset)
+        # A new sync token alone is no reason for other workers to reload
+        if self.shared is not None and (upserts or deletes or self._reset):
+            self._version = self.shared.incr(self._version_key)
+        self._dirty.clear()
+        self._reset = False
+
+    # Returns the stored and incoming versions of every event that changed
+    def _pull(self, service):
+        changed = []
+        page_token = None
+        while True:
+            params = {
+                'calendarId': self.calendar_id,
+                'maxResults': PAGE_SIZE,
+                'fields': EVENT_FIELDS,
+            }
+            if self.sync_token:
+                params['syncToken'] = self.sync_token
+            if page_token:
+                params['pageToken'] = page_token
+
+            events_result = service.events().list(**params).execute()
+            for event in events_result.get('items', []):
+                previous = self.apply(event)
+                if previous is not None:
+                    changed.append(previous)
+                if event.get('status') != 'cancelled' or event.get('recurringEventId'):
+                    changed.append(event)
+
+            page_token = events_result.get('nextPageToken')
+            if not page_token:
+                # The sync token is only handed out on the last page
+                self.sync_token = events_result.get('nextSyncToken')
+                return changed
+
+    def apply(self, event):
+        self._index = None
+        self._dirty.add(event['id'])
+        previous = self._discard(event['id'])
+        # A cancelled instance of a series is kept, it stops that instance from being expanded
+        indexed = None
+        if event.get('status') != 'cancelled' or event.get('recurringEventId'):
+            indexed = self._insert(event)
+        if self.search_index is not None:
+            if indexed is not None:
+                self.search_index.add(*indexed)
+            else:
+                self.search_index.remove(self.calendar_id, event['id'])
+        return previous
+
+    def _insert(self, event):
+        # Store an event as a single event, a series master or an exception to a series;
+        # returns what the search index should hold for it, if anything
+        self.events[event['id']] = event
+        if event.get('recurringEventId'):
+            self._override(event, True)
+            if event.get('status') == 'cancelled':
+                return None
+        if event.get('recurrence'):
+            overrides = self._overrides.setdefault(event['id'], set())
+            series = self.series[event['id']] = Series(self.calendar_id, event, overrides)
+            return series.record, event
+        record = self.records[event['id']] = EventRecord(self.calendar_id, event)
+        return record, event
+
+    def _discard(self, event_id):
+        # Forget whatever is stored under event_id and return it
+        self.records.pop(event_id, None)
+        self.series.pop(event_id, None)
+        previous = self.events.pop(event_id, None)
+        if previous is not None and previous.get('recurringEventId'):
+            self._override(previous, False)
+        return previous
+
+    def _override(self, exception, add):
+        # Mark or unmark the instance an exception replaces, so expansion skips it
+        overrides = self._overrides.setdefault(exception['recurringEventId'], set())
+        suffix = instance_suffix(exception['originalStartTime'])
+        if add:
+            overrides.add(suffix)
+        else:
+            overrides.discard(suffix)
+        series = self.series.get(exception['recurringEventId'])
+        if series is not None:
+            series.forget_windows()
+
+    def _instance(self, event_id):
+        # Event resource of an expanded instance, from its ID: the master's ID, '_' and a suffix
+        master_id, _, suffix = event_id.rpartition('_')
+        series = self.series.get(master_id)
+        return series.instance(suffix) if series is not None else None
+
+    def get_event(self, event_id):
+        # A stored event, or an instance of a stored series
+        with self.lock:
+            event = self.events.get(event_id)
+            return event if event is not None else self._instance(event_id)
+
+    def put(self, event):
+        # Apply an event we just wrote to Google, without waiting for the next sync
+        with self.lock:
+            self._catch_up()
+            self.apply(event)
+            self.save()
+
+    def remove(self, event_id):
+        with self.lock:
+            self._catch_up()
+            instance = None if event_id in self.events else self._instance(event_id)
+            if instance is not None:
+                # Deleting one instance of a series leaves Google with a cancelled exception
+                self.apply({'id': event_id, 'status': 'cancelled', 'recurringEventId': instance['recurringEventId'],
+                            'originalStartTime': instance['originalStartTime']})
+            else:
+                self.apply({'id': event_id, 'status': 'cancelled'})
+            self.save()
+
+    def _build_index(self):
+        # Records and series that end, each grouped by how long they span; series that never
+        # end sorted by their first start
+        self._index = interval_groups(self.records.values())
+        self._series_index = interval_groups(series for series in self.series.values()
+                                             if series.end_ts != float('inf'))
+        self._open_series = sorted((series for series in self.series.values() if series.end_ts == float('inf')),
+                                   key=lambda series: series.start_ts)
+        self._open_starts = [series.start_ts for series in self._open_series]
+
+    def window(self, min_ts, max_ts=None):
+        # Records of events overlapping [min_ts, max_ts) in epoch seconds, ordered by start,
+        # with recurring series expanded into their instances for just this window
+        with self.lock:
+            if self._index is None:
+                self._build_index()
+            parts = [part for part in overlapping(self._index, min_ts, max_ts) if part]
+            hi = len(self._open_starts) if max_ts is None else bisect.bisect_left(self._open_starts, max_ts)
+            for group in overlapping(self._series_index, min_ts, max_ts):
+                for series in group:
+                    part = series.instances(min_ts, max_ts)
+                    if part:
+                        parts.append(part)
+            for series in self._open_series[:hi]:
+                part = series.instances(min_ts, max_ts)
+                if part:
+                    parts.append(part)
+        if len(parts) == 1:
+            return parts[0]
+        # Sorting the concatenated runs merges them in C, which beats heapq.merge's Python loop
+        # once every series in a busy window adds a run of its own
+        return sorted(itertools.chain.from_iterable(parts), key=lambda record: record.start_ts)
+
+    def find(self, event_id, min_ts=None, max_ts=None):
+        # Record of a stored event, or of a series' first instance in the window
+        with self.lock:
+            record = self.records.get(event_id)
+            series = self.series.get(event_id)
+            if record is not None or series is None:
+                return record
+            instances = series.instances(series.start_ts if min_ts is None else min_ts, max_ts)
+            return instances[0] if instances else None
+
+    def export(self, min_ts=None, max_ts=None):
+        # Stored events overlapping the range, as they came from Google: single events, series
+        # masters and the exceptions that still happen. Each is paired with the originalStartTimes
+        # of a master's cancelled instances, which only exist as exceptions here.
+        with self.lock:
+            cancelled = {}
+            for event in self.events.values():
+                if event.get('status') == 'cancelled' and event.get('recurringEventId'):
+                    cancelled.setdefault(event['recurringEventId'], []).append(event['originalStartTime'])
+            spans = list(self.records.values()) + list(self.series.values())
+            return [(self.events[span.event_id] if isinstance(span, EventRecord) else span.master,
+                     cancelled.get(span.master['id'], ()) if isinstance(span, Series) else ())
+                    for span in spans
+                    if (min_ts is None or span.end_ts > min_ts) and (max_ts is None or span.start_ts < max_ts)]
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.events.values())
+
+
+# Spans (anything with start_ts and end_ts) grouped by duration class, each twice as long as
+# the one before, every group sorted by start. Nothing in a group outlasts its longest span,
+# which bounds how far back a window has to look, so one long event cannot slow down queries
+# over short ones. Returns (spans, starts, longest) per group.
+def interval_groups(spans):
+    groups = {}
+    for span in spans:
+        duration = int(span.end_ts - span.start_ts)
+        groups.setdefault(max(duration, 1).bit_length(), []).append(span)
+    index = []
+    for members in groups.values():
+        members.sort(key=lambda span: span.start_ts)
+        longest = max(span.end_ts - span.start_ts for span in members)
+        index.append((members, [span.start_ts for span in members], longest))
+    return index
+
+
+# The spans of each group in interval_groups() that overlap [min_ts, max_ts), in start order
+def overlapping(index, min_ts, max_ts=None):
+    for spans, starts, longest in index:
+        lo = bisect.bisect_left(starts, min_ts - longest)
+        hi = len(starts) if max_ts is None else bisect.bisect_left(starts, max_ts)
+        yield [span for span in spans[lo:hi] if span.end_ts > min_ts]
+
+
+# Earliest start and latest end over a list of events, or None when there are none or
+# when a whole series changed, as its instances can span any range
+def events_range(events):
+    bounds = []
+    for event in events:
+        if event.get('recurrence'):
+            return None
+        if 'start' in event:
+            bounds.append(event_bounds(event))
+        elif 'originalStartTime' in event:
+            start = parse_event_time(event['originalStartTime'].get('dateTime', event['originalStartTime'].get('date')))
+            bounds.append((start, start))
+    if not bounds:
+        return None
+    return min(start for start, _ in bounds), max(end for _, end in bounds)
+
+
+class EventStore:
+    # Per-calendar event stores for every calendar in the user's calendar list,
+    # all feeding one search index
+    def __init__(self, database=None, search_index=None, shared=None, namespace=''):
+        self.calendars = {}
+        self.primary_id = None
+        self.database = database
+        self.search_index = search_index
+        self.shared = shared
+        self.namespace = namespace
+        self.lock = threading.Lock()
+
+    def load(self):
+        # Restore the stores saved by a previous run, sync tokens included
+        if self.database is None:
+            return
+        with self.lock:
+            for calendar_id, summary, is_primary, sync_token in self.database.load_calendars():
+                store = CalendarEventStore(calendar_id, summary, self.database, self.search_index,
+                                           self.shared, self.namespace)
+                store.primary = bool(is_primary)
+                store.load(self.database.load_events(calendar_id), sync_token)
+                self.calendars[calendar_id] = store
+                if is_primary:
+                    self.primary_id = calendar_id
+
+    def set_calendars(self, calendars):
+        with self.lock:
+            seen = set()
+            for calendar in calendars:
+                calendar_id = calendar['id']
+                seen.add(calendar_id)
+                if calendar.get('primary'):
+                    self.primary_id = calendar_id
+                store = self.calendars.get(calendar_id)
+                if store is None:
+                    store = self.calendars[calendar_id] = CalendarEventStore(
+                        calendar_id, calendar.get('summary'), self.database, self.search_index,
+                        self.shared, self.namespace)
+                store.summary = calendar.get('summary')
+                store.primary = bool(calendar.get('primary'))
+            # Drop calendars that were unsubscribed since the last refresh
+            for calendar_id in list(self.calendars):
+                if calendar_id not in seen:
+                    del self.calendars[calendar_id]
+                    if self.database is not None:
+                        self.database.delete_calendar(calendar_id)
+                    if self.search_index is not None:
+                        self.search_index.remove_calendar(calendar_id)
+            return [self.calendars[calendar['id']] for calendar in calendars]
+
+    def all(self):
+        with self.lock:
+            return list(self.calendars.values())
+
+    def get(self, calendar_id):
+        with self.lock:
+            return self.calendars.get(calendar_id)
+
+    def resolve(self, calendar_id):
+        # Map the 'primary' alias onto the real calendar ID once the calendar list is known
+        if calendar_id == 'primary':
+            return self.primary_id
+        return calendar_id
+
+    def clear(self):
+        with self.lock:
+            self.calendars.clear()
+            self.primary_id = None
+            if self.database is not None:
+                self.database.clear()
+            if self.search_index is not None:
+                self.search_index.clear()
@@ -0,0 +1,352 @@
+# Local stand-in for the parts of the Google Calendar API the backend calls, with generated data.
+# Point the backend at it with CALENDAR_API_ENDPOINT=http://127.0.0.1:<port>/calendar/v3/, e.g.:
+#   python fake_calendar_api.py --calendars 10 --events 2000 --latency 40 --error-rate 0.01
+# GET /_stats returns call counts by route and status, POST /_reset zeroes them.
+# Batch requests are answered at /batch/calendar/v3, where the backend sends them when pointed here.
+import argparse
+import datetime
+import email
+import gzip
+import json
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+from zoneinfo import ZoneInfo
+
+WORDS = ('standup', 'review', 'planning', 'lunch', 'sync', 'design', 'retro', 'interview', 'demo',
+         'budget', 'hiring', 'roadmap', 'launch', 'training', 'offsite', 'client', 'support', 'release')
+PLACES = ('Room 1', 'Room 2', 'Cafeteria', 'Online', 'Head office', 'Client site')
+# Items per calendarList page when the client does not ask, as Google does
+CALENDAR_PAGE = 100
+EVENT_PAGE = 250
+
+
+def iso(value):
+    return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+# Suffix of an instance ID: the original start in UTC, or the date of an all-day instance
+def instance_suffix(start):
+    if 'date' in start:
+        return start['date'].replace('-', '')
+    value = datetime.datetime.fromisoformat(start['dateTime'].replace('Z', '+00:00'))
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=ZoneInfo(start.get('timeZone') or 'UTC'))
+    return value.astimezone(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+class FakeCalendarData:
+    # Generated calendars and events, with a change log per calendar so sync tokens return deltas
+    def __init__(self, calendars, events, days, recurring, seed):
+        rng = random.Random(seed)
+        today = datetime.datetime.now(datetime.timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+        self.calendars = []
+        self.events = {}  # calendar ID -> {event ID: event}
+        self.log = {}  # calendar ID -> [event ID changed by version 1, 2, ...]
+        self.uids = {}  # calendar ID -> {iCalUID: event ID}, what events().import matches on
+        self.lock = threading.Lock()
+        for number in range(calendars):
+            calendar_id = 'primary@example.com' if number == 0 else f'calendar{number}@group.example.com'
+            self.calendars.append({'id': calendar_id, 'summary': f'Calendar {number}',
+                                   'timeZone': 'UTC', 'primary': number == 0})
+            items = {}
+            for index in range(events):
+                start = today + datetime.timedelta(days=rng.uniform(-days / 2, days / 2))
+                start = start.replace(minute=rng.choice((0, 15, 30, 45)), second=0)
+                event = {
+                    'id': f'c{number}e{index}',
+                    'status': 'confirmed',
+                    'summary': ' '.join(rng.sample(WORDS, 2)).capitalize(),
+                    'location': rng.choice(PLACES),
+                    'description': ' '.join(rng.sample(WORDS, 5)),
+                }
+                event['iCalUID'] = event['id'] + '@fake.example.com'
+                if rng.random() < 0.05:
+                    event['start'] = {'date': start.date().isoformat()}
+                    event['end'] = {'date': (start.date() + datetime.timedelta(days=1)).isoformat()}
+                else:
+                    end = start + datetime.timedelta(minutes=rng.choice((15, 30, 60, 90)))
+                    event['start'] = {'dateTime': iso(start), 'timeZone': 'UTC'}
+                    event['end'] = {'dateTime': iso(end), 'timeZone': 'UTC'}
+                if rng.random() < recurring:
+                    event['recurrence'] = [rng.choice(('RRULE:FREQ=DAILY;BYDAY=MO,TU,WE,TH,FR',
+                                                       'RRULE:FREQ=WEEKLY', 'RRULE:FREQ=MONTHLY;COUNT=12'))]
+                items[event['id']] = event
+            self.events[calendar_id] = items
+            self.log[calendar_id] = []
+            self.uids[calendar_id] = {event['iCalUID']: event['id'] for event in items.values()}
+
+    def calendar_id(self, calendar_id):
+        return self.calendars[0]['id'] if calendar_id == 'primary' else calendar_id
+
+    def sync_token(self, calendar_id):
+        return f'{calendar_id}|{len(self.log[calendar_id])}'
+
+    def change(self, calendar_id, event):
+        self.events[calendar_id][event['id']] = event
+        self.log[calendar_id].append(event['id'])
+
+    def import_event(self, calendar_id, body):
+        # Same iCalUID, same event; with an originalStartTime, an exception to that series
+        uids = self.uids[calendar_id]
+        uid = body.get('iCalUID')
+        if not uid:
+            return 400, {'error': {'code': 400, 'message': 'Missing iCalUID'}}
+        if body.get('originalStartTime'):
+            master_id = uids.get(uid)
+            if master_id is None:
+                return 404, {'error': {'code': 404, 'message': 'No series with this iCalUID'}}
+            event = dict(body, id=f"{master_id}_{instance_suffix(body['originalStartTime'])}",
+                         recurringEventId=master_id, status='confirmed')
+        else:
+            event_id = uids.get(uid) or uuid.uuid4().hex
+            uids[uid] = event_id
+            event = dict(body, id=event_id, status='confirmed')
+        self.change(calendar_id, event)
+        return 200, event
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes, don't let Nagle hold back the body
+    disable_nagle_algorithm = True
+    server_version = 'FakeCalendarAPI/1.0'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_call('GET')
+
+    def do_POST(self):
+        self.handle_call('POST')
+
+    def do_PUT(self):
+        self.handle_call('PUT')
+
+    def do_DELETE(self):
+        self.handle_call('DELETE')
+
+    def handle_call(self, method):
+        server = self.server
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        url = urlsplit(self.path)
+        parts = [unquote(part) for part in url.path.strip('/').split('/')]
+
+        if parts == ['_stats']:
+            return self.send_json(200, server.stats())
+        if parts == ['_reset']:
+            server.reset()
+            return self.send_json(200, {})
+
+        if server.latency:
+            time.sleep(max(0.0, server.rng.gauss(server.latency, server.jitter)) / 1000)
+        if parts == ['batch', 'calendar', 'v3']:
+            return server.count('batch', 200, self.send_batch(raw))
+        status, payload, route = self.call(method, self.path, raw)
+        headers = {'Retry-After': '0'} if status in (403, 429, 503) else None
+        server.count(route, status, self.send_json(status, payload, headers))
+
+    def call(self, method, path, raw):
+        # (status, payload, route) for one API call, failing it at the configured error rate
+        server = self.server
+        url = urlsplit(path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        parts = [unquote(part) for part in url.path.strip('/').split('/')]
+        route = self.route_name(method, parts)
+        if route != 'token' and server.rng.random() < server.error_rate:
+            return server.error_status, {'error': {
+                'code': server.error_status, 'message': 'Injected error',
+                'errors': [{'reason': 'rateLimitExceeded' if server.error_status in (403, 429) else 'backendError'}]}}, route
+        body = json.loads(raw) if raw else None
+        return (*self.answer(method, parts, params, body), route)
+
+    def send_batch(self, raw):
+        # Answer each request of a multipart/mixed batch in a part of our own, as Google does
+        message = email.message_from_bytes(
+            b'Content-Type: ' + self.headers['Content-Type'].encode('ascii') + b'\r\n\r\n' + raw)
+        boundary = uuid.uuid4().hex
+        answers = []
+        for part in message.get_payload():
+            request_text = part.get_payload()
+            head, _, body = request_text.replace('\r\n', '\n').partition('\n\n')
+            method, path, _ = head.split('\n', 1)[0].split(' ', 2)
+            status, payload, route = self.call(method, path, body.strip().encode('utf-8'))
+            self.server.count(route, status, 0)
+            content = '' if payload is None else json.dumps(payload)
+            answers.append(f'--{boundary}\r\nContent-Type: application/http\r\n'
+                           f"Content-ID: <response-{part['Content-ID'][1:]}\r\n\r\n"
+                           f'HTTP/1.1 {status} {self.responses.get(status, ("",))[0]}\r\n'
+                           f'Content-Type: application/json; charset=UTF-8\r\n\r\n{content}\r\n')
+        body = (''.join(answers) + f'--{boundary}--\r\n').encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', f'multipart/mixed; boundary={boundary}')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return len(body)
+
+    def route_name(self, method, parts):
+        if parts == ['token']:
+            return 'token'
+        if parts[-1:] == ['calendarList']:
+            return 'calendarList.list'
+        if parts[-1:] == ['freeBusy']:
+            return 'freebusy.query'
+        if 'events' in parts:
+            has_id = parts[-1] != 'events'
+            if parts[-1] in ('watch', 'import'):
+                return 'events.' + parts[-1]
+            return 'events.' + {'GET': 'get' if has_id else 'list', 'POST': 'insert',
+                                'PUT': 'update', 'DELETE': 'delete'}[method]
+        if parts[-2:-1] == ['calendars']:
+            return 'calendars.get'
+        return 'other'
+
+    def answer(self, method, parts, params, body):
+        data = self.server.data
+        route = self.route_name(method, parts)
+        with data.lock:
+            if route == 'token':
+                return 200, {'access_token': uuid.uuid4().hex, 'expires_in': 3600, 'token_type': 'Bearer'}
+            if route == 'calendarList.list':
+                start = int(params.get('pageToken') or 0)
+                size = int(params.get('maxResults') or CALENDAR_PAGE)
+                result = {'items': data.calendars[start:start + size]}
+                if start + size < len(data.calendars):
+                    result['nextPageToken'] = str(start + size)
+                return 200, result
+            if route == 'calendars.get':
+                return 200, {'id': data.calendar_id(parts[-1])}
+            if route == 'freebusy.query':
+                return 200, {'calendars': {item['id']: {'busy': []} for item in body.get('items', [])}}
+            if route == 'events.watch':
+                return 200, {'id': body.get('id'), 'resourceId': uuid.uuid4().hex,
+                             'expiration': str(int((time.time() + 7 * 86400) * 1000))}
+
+            calendar_id = data.calendar_id(parts[parts.index('calendars') + 1])
+            if calendar_id not in data.events:
+                return 404, {'error': {'code': 404, 'message': 'Not Found'}}
+            events = data.events[calendar_id]
+            if route == 'events.list':
+                return self.list_events(calendar_id, events, params)
+            if route == 'events.insert':
+                event = dict(body, id=uuid.uuid4().hex, status='confirmed')
+                event['iCalUID'] = event['id'] + '@fake.example.com'
+                data.uids[calendar_id][event['iCalUID']] = event['id']
+                data.change(calendar_id, event)
+                return 200, event
+            if route == 'events.import':
+                return data.import_event(calendar_id, body)
+            event_id = parts[-1]
+            if event_id not in events:
+                return 404, {'error': {'code': 404, 'message': 'Not Found'}}
+            if route == 'events.get':
+                return 200, events[event_id]
+            if route == 'events.update':
+                event = dict(body, id=event_id, status='confirmed')
+                data.change(calendar_id, event)
+                return 200, event
+            data.change(calendar_id, {'id': event_id, 'status': 'cancelled'})
+            return 204, None
+
+    def list_events(self, calendar_id, events, params):
+        data = self.server.data
+        if params.get('syncToken'):
+            token_calendar, _, version = params['syncToken'].rpartition('|')
+            if token_calendar != calendar_id or int(version) > len(data.log[calendar_id]):
+                return 410, {'error': {'code': 410, 'message': 'Sync token is no longer valid'}}
+            changed = dict.fromkeys(data.log[calendar_id][int(version):])
+            ids = list(changed)
+        else:
+            ids = [event_id for event_id, event in events.items() if event.get('status') != 'cancelled']
+        start = int(params.get('pageToken') or 0)
+        size = min(int(params.get('maxResults') or EVENT_PAGE), 2500)
+        result = {'items': [events[event_id] for event_id in ids[start:start + size]]}
+        if start + size < len(ids):
+            result['nextPageToken'] = str(start + size)
+        else:
+            result['nextSyncToken'] = data.sync_token(calendar_id)
+        return 200, result
+
+    def send_json(self, status, payload, headers=None):
+        body = b'' if payload is None else json.dumps(payload).encode('utf-8')
+        headers = dict(headers or {}, **{'Content-Type': 'application/json; charset=UTF-8'})
+        if body and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body, 6)
+            headers['Content-Encoding'] = 'gzip'
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return len(body)
+
+
+class FakeCalendarServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, data, latency=0.0, jitter=0.0, error_rate=0.0, error_status=503, seed=0):
+        super().__init__(address, Handler)
+        self.data = data
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.rng = random.Random(seed)
+        self._calls = Counter()
+        self._statuses = Counter()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def count(self, route, status, size):
+        with self._lock:
+            self._calls[route] += 1
+            self._statuses[str(status)] += 1
+            self._bytes += size
+
+    def stats(self):
+        with self._lock:
+            return {'calls': dict(self._calls), 'total': sum(self._calls.values()),
+                    'statuses': dict(self._statuses), 'bytes': self._bytes}
+
+    def reset(self):
+        with self._lock:
+            self._calls.clear()
+            self._statuses.clear()
+            self._bytes = 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a fake Google Calendar API with generated events')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--calendars', type=int, default=5)
+    parser.add_argument('--events', type=int, default=500, help='events per calendar')
+    parser.add_argument('--days', type=int, default=365, help='days the events are spread over, centred on today')
+    parser.add_argument('--recurring', type=float, default=0.05, help='fraction of events that recur')
+    parser.add_argument('--latency', type=float, default=0.0, help='mean milliseconds added to every call')
+    parser.add_argument('--jitter', type=float, default=0.0, help='standard deviation of the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of calls that fail')
+    parser.add_argument('--error-status', type=int, default=503, choices=[403, 429, 500, 503])
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    data = FakeCalendarData(args.calendars, args.events, args.days, args.recurring, args.seed)
+    server = FakeCalendarServer((args.host, args.port), data, args.latency, args.jitter,
+                                args.error_rate, args.error_status, args.seed)
+    print(f'Fake Calendar API on http://{args.host}:{server.server_port}/calendar/v3/', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
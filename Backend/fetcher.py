@@ -0,0 +1,43 @@
+import heapq
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import metrics
+
+# Upper bound on calendars fetched from Google at the same time
+MAX_WORKERS = int(os.getenv('FETCH_WORKERS', '8'))
+
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='calendar-fetch')
+
+
+# Sync one store on a pool thread, timed into the profile of the request that asked for it.
+# Each worker checks out its own pooled service, as service objects are not thread safe.
+def _sync(store, service_manager, profile):
+    with metrics.bound(profile), service_manager.service() as service, metrics.span('sync ' + store.calendar_id):
+        return store.sync(service)
+
+
+# Sync every calendar store concurrently and return the per-store change counts in order
+def sync_all(stores, service_manager):
+    profile = metrics.current()
+    futures = [_executor.submit(_sync, store, service_manager, profile) for store in stores]
+    return [future.result() for future in futures]
+
+
+# Sync every calendar store concurrently, yielding (store, future) as each one finishes.
+# future.result() re-raises whatever that store's sync raised.
+def sync_each(stores, service_manager):
+    profile = metrics.current()
+    futures = {_executor.submit(_sync, store, service_manager, profile): store for store in stores}
+    for future in as_completed(futures):
+        yield futures[future], future
+
+
+# Merge per-calendar lists that are already sorted into one list ordered by key
+def merge_sorted(lists, key):
+    return list(heapq.merge(*lists, key=key))
+
+
+# Run fn on the fetch worker pool without waiting for it
+def submit(fn, *args):
+    return _executor.submit(fn, *args)
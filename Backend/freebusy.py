@@ -0,0 +1,88 @@
+import datetime
+
+from event_record import get_timezone
+from event_store import parse_event_time
+
+# Calendars per freebusy().query call; Google rejects more than 50
+QUERY_CALENDARS = 50
+
+
+# Epoch seconds for an RFC 3339 time, or for a local time in tz_name when it has no offset
+def to_timestamp(value, tz_name=None):
+    parsed = parse_event_time(value)
+    if parsed.tzinfo is None:
+        parsed = get_timezone(tz_name).localize(parsed) if tz_name else parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed.timestamp()
+
+
+def iso_utc(ts):
+    return datetime.datetime.fromtimestamp(ts, datetime.timezone.utc).isoformat().replace('+00:00', 'Z')
+
+
+# Merge (start, end) intervals into a sorted list of disjoint ones
+def merge_intervals(intervals):
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+# Gaps between merged busy intervals inside [min_ts, max_ts)
+def free_slots(busy, min_ts, max_ts):
+    free = []
+    cursor = min_ts
+    for start, end in busy:
+        if start > cursor:
+            free.append((cursor, min(start, max_ts)))
+        cursor = max(cursor, end)
+        if cursor >= max_ts:
+            break
+    if cursor < max_ts:
+        free.append((cursor, max_ts))
+    return free
+
+
+# Busy intervals per calendar from the local stores' interval index, clipped to the window
+def local_busy(stores, min_ts, max_ts):
+    return {
+        store.calendar_id: merge_intervals((max(record.start_ts, min_ts), min(record.end_ts, max_ts))
+                                           for record in store.window(min_ts, max_ts)
+                                           if record.busy and record.end_ts > record.start_ts)
+        for store in stores
+    }
+
+
+# Busy intervals per calendar from Google's freebusy().query, for calendars not synced locally
+def google_busy(service, calendar_ids, min_ts, max_ts):
+    busy = {}
+    calendar_ids = list(calendar_ids)
+    for start in range(0, len(calendar_ids), QUERY_CALENDARS):
+        body = {
+            'timeMin': iso_utc(min_ts),
+            'timeMax': iso_utc(max_ts),
+            'items': [{'id': calendar_id} for calendar_id in calendar_ids[start:start + QUERY_CALENDARS]],
+        }
+        result = service.freebusy().query(body=body).execute()
+        for calendar_id, calendar in result.get('calendars', {}).items():
+            if calendar.get('errors'):
+                busy[calendar_id] = None  # Not shared with us, or no such calendar
+                continue
+            busy[calendar_id] = merge_intervals((to_timestamp(period['start']), to_timestamp(period['end']))
+                                                for period in calendar.get('busy', []))
+    return busy
+
+
+# Busy events in the stores that overlap [start_ts, end_ts), except the event being edited
+def find_conflicts(stores, start_ts, end_ts, exclude=None):
+    conflicts = []
+    for store in stores:
+        for record in store.window(start_ts, end_ts):
+            if (record.busy and record.end_ts > record.start_ts
+                    and (record.calendar_id, record.event_id) != exclude):
+                conflicts.append(record.to_wire(store.summary))
+    conflicts.sort(key=lambda event: event['startTs'])
+    return conflicts
@@ -0,0 +1,258 @@
+import datetime
+import uuid
+
+import pytz
+
+from event_record import DISPLAY_TIMEZONE
+
+PRODID = '-//Calendar Widget//Calendar Backend//EN'
+# Content lines are folded to this many octets, as RFC 5545 asks
+LINE_OCTETS = 75
+# Properties of an imported VEVENT passed on to Google as its recurrence lines
+RECURRENCE_PROPERTIES = ('RRULE', 'RDATE', 'EXDATE', 'EXRULE')
+
+
+class ICSError(ValueError):
+    pass
+
+
+# iCalendar text escaping for SUMMARY, LOCATION and DESCRIPTION values
+def escape(text):
+    return (text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,')
+            .replace('\r\n', '\\n').replace('\n', '\\n'))
+
+
+def unescape(text):
+    out = []
+    chars = iter(text)
+    for char in chars:
+        if char == '\\':
+            char = next(chars, '')
+            out.append('\n' if char in 'nN' else char)
+        else:
+            out.append(char)
+    return ''.join(out)
+
+
+def fold(line):
+    # Split after LINE_OCTETS octets, never inside a UTF-8 sequence; continuations start with a space
+    data = line.encode('utf-8')
+    if len(data) <= LINE_OCTETS:
+        return line + '\r\n'
+    parts = []
+    start = 0
+    limit = LINE_OCTETS
+    while len(data) - start > limit:
+        end = start + limit
+        while end > start and (data[end] & 0xC0) == 0x80:
+            end -= 1
+        parts.append(data[start:end].decode('utf-8'))
+        start = end
+        limit = LINE_OCTETS - 1  # Room for the leading space
+    parts.append(data[start:].decode('utf-8'))
+    return '\r\n '.join(parts) + '\r\n'
+
+
+def _utc_stamp(value):
+    parsed = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return parsed.astimezone(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+def _time_property(name, time, local=False):
+    # DTSTART, DTEND, RECURRENCE-ID or EXDATE from a Calendar API start/end/originalStartTime.
+    # Series masters keep their wall time and zone, so their rules expand the same across DST.
+    if 'date' in time:
+        return f"{name};VALUE=DATE:{time['date'].replace('-', '')}"
+    if local and time.get('timeZone'):
+        parsed = datetime.datetime.fromisoformat(time['dateTime'].replace('Z', '+00:00'))
+        parsed = parsed.astimezone(pytz.timezone(time['timeZone']))
+        return f"{name};TZID={time['timeZone']}:{parsed.strftime('%Y%m%dT%H%M%S')}"
+    return f"{name}:{_utc_stamp(time['dateTime'])}"
+
+
+def uid(event):
+    # Google gives a series and its exceptions the same iCalUID, and derives it from the ID
+    return event.get('iCalUID') or f"{event.get('recurringEventId') or event['id']}@google.com"
+
+
+# Content lines of one VEVENT. excluded holds the originalStartTimes of a master's cancelled instances.
+def event_lines(event, stamp, excluded=()):
+    master = bool(event.get('recurrence'))
+    lines = ['BEGIN:VEVENT', f'UID:{uid(event)}', f'DTSTAMP:{stamp}',
+             _time_property('DTSTART', event['start'], master),
+             _time_property('DTEND', event['end'], master)]
+    if event.get('recurringEventId') and event.get('originalStartTime'):
+        lines.append(_time_property('RECURRENCE-ID', event['originalStartTime']))
+    lines.extend(event.get('recurrence', ()))
+    lines.extend(_time_property('EXDATE', original) for original in excluded)
+    for name, field in (('SUMMARY', 'summary'), ('LOCATION', 'location'), ('DESCRIPTION', 'description')):
+        if event.get(field):
+            lines.append(f'{name}:{escape(event[field])}')
+    if event.get('transparency') == 'transparent':
+        lines.append('TRANSP:TRANSPARENT')
+    lines.append('END:VEVENT')
+    return lines
+
+
+# A VCALENDAR as text chunks, one per batch of events, so it can be sent as it is written.
+# batches yields lists of (event, excluded) pairs.
+def write_calendar(batches, name=None):
+    stamp = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    head = ['BEGIN:VCALENDAR', 'VERSION:2.0', f'PRODID:{PRODID}', 'CALSCALE:GREGORIAN']
+    if name:
+        head.append(f'X-WR-CALNAME:{escape(name)}')
+    yield ''.join(fold(line) for line in head)
+    for batch in batches:
+        yield ''.join(fold(line) for event, excluded in batch for line in event_lines(event, stamp, excluded))
+    yield 'END:VCALENDAR\r\n'
+
+
+def unfold(stream):
+    # Logical content lines of a binary or text stream, continuation lines joined back on
+    pending = None
+    for raw in stream:
+        line = raw.decode('utf-8', 'replace') if isinstance(raw, bytes) else raw
+        line = line.rstrip('\r\n')
+        if line[:1] in (' ', '\t'):
+            if pending is not None:
+                pending += line[1:]
+            continue
+        if pending is not None:
+            yield pending
+        pending = line
+    if pending:
+        yield pending
+
+
+def parse_line(line):
+    # (NAME, {PARAM: value}, value), with ':' and ';' allowed inside quoted parameter values
+    quoted = False
+    split = None
+    for index, char in enumerate(line):
+        if char == '"':
+            quoted = not quoted
+        elif char == ':' and not quoted:
+            split = index
+            break
+    if split is None:
+        raise ICSError(f'Malformed content line: {line[:80]!r}')
+    name, *params = line[:split].split(';')
+    parsed = {}
+    for param in params:
+        key, _, value = param.partition('=')
+        parsed[key.upper()] = value.strip('"')
+    return name.upper(), parsed, line[split + 1:]
+
+
+# Each VEVENT of a stream as a list of (NAME, params, value), read one at a time.
+# Alarms and other components nested in an event are skipped.
+def read_events(stream):
+    properties = None
+    nested = 0
+    for line in unfold(stream):
+        if not line:
+            continue
+        try:
+            name, params, value = parse_line(line)
+        except ICSError:
+            continue  # Some exporters write stray lines; the rest of the file is still good
+        if name == 'BEGIN':
+            if value.upper() == 'VEVENT' and properties is None:
+                properties = []
+            elif properties is not None:
+                nested += 1
+        elif name == 'END':
+            if properties is None:
+                continue
+            if nested:
+                nested -= 1
+            elif value.upper() == 'VEVENT':
+                yield properties
+                properties = None
+        elif properties is not None and not nested:
+            properties.append((name, params, value))
+
+
+def _zone(params, default_tz):
+    # Google only knows IANA zone names; others (Outlook's 'Pacific Standard Time') fall back
+    tzid = params.get('TZID')
+    return tzid if tzid in pytz.all_timezones_set else default_tz
+
+
+def _time_value(params, value, default_tz):
+    value = value.strip()
+    if params.get('VALUE') == 'DATE' or (len(value) == 8 and value.isdigit()):
+        return {'date': f'{value[:4]}-{value[4:6]}-{value[6:8]}'}
+    if value.endswith('Z'):
+        parsed = datetime.datetime.strptime(value, '%Y%m%dT%H%M%SZ')
+        return {'dateTime': parsed.strftime('%Y-%m-%dT%H:%M:%SZ'), 'timeZone': 'UTC'}
+    parsed = datetime.datetime.strptime(value, '%Y%m%dT%H%M%S')
+    return {'dateTime': parsed.strftime('%Y-%m-%dT%H:%M:%S'), 'timeZone': _zone(params, default_tz)}
+
+
+def _duration(value):
+    # An RFC 5545 DURATION such as P1D, PT1H30M or P2W
+    sign = -1 if value.startswith('-') else 1
+    value = value.lstrip('+-')
+    if not value.startswith('P'):
+        raise ICSError(f'Malformed duration: {value!r}')
+    total = datetime.timedelta()
+    number = ''
+    units = {'W': 'weeks', 'D': 'days', 'H': 'hours', 'M': 'minutes', 'S': 'seconds'}
+    for char in value[1:]:
+        if char.isdigit():
+            number += char
+        elif char in units:
+            total += datetime.timedelta(**{units[char]: int(number or 0)})
+            number = ''
+    return sign * total
+
+
+def _shift(time, delta):
+    if 'date' in time:
+        return {'date': (datetime.date.fromisoformat(time['date']) + delta).isoformat()}
+    parsed = datetime.datetime.fromisoformat(time['dateTime'].replace('Z', ''))
+    shifted = (parsed + delta).strftime('%Y-%m-%dT%H:%M:%S')
+    return {'dateTime': shifted + ('Z' if time['dateTime'].endswith('Z') else ''), 'timeZone': time['timeZone']}
+
+
+# Body for events().import from one parsed VEVENT, or None for a cancelled one.
+# Exceptions to a series (with a RECURRENCE-ID) carry originalStartTime and the series' iCalUID.
+def to_event(properties, default_tz=DISPLAY_TIMEZONE):
+    values = {}
+    recurrence = []
+    for name, params, value in properties:
+        if name in RECURRENCE_PROPERTIES:
+            head = ''.join(f';{key}={param}' for key, param in params.items())
+            recurrence.append(f'{name}{head}:{value}')
+        elif name not in values:
+            values[name] = (params, value)
+    if 'DTSTART' not in values:
+        raise ICSError('VEVENT has no DTSTART')
+    if values.get('STATUS', (None, ''))[1].upper() == 'CANCELLED':
+        return None
+
+    start = _time_value(*values['DTSTART'], default_tz)
+    if 'DTEND' in values:
+        end = _time_value(*values['DTEND'], default_tz)
+    elif 'DURATION' in values:
+        end = _shift(start, _duration(values['DURATION'][1]))
+    else:
+        # A date-only event lasts the day, a timed one is an instant
+        end = _shift(start, datetime.timedelta(days=1 if 'date' in start else 0))
+
+    event = {
+        'iCalUID': values['UID'][1] if 'UID' in values else f'{uuid.uuid4().hex}@calendar-widget',
+        'start': start,
+        'end': end,
+    }
+    for name, field in (('SUMMARY', 'summary'), ('LOCATION', 'location'), ('DESCRIPTION', 'description')):
+        if name in values:
+            event[field] = unescape(values[name][1])
+    if values.get('TRANSP', (None, ''))[1].upper() == 'TRANSPARENT':
+        event['transparency'] = 'transparent'
+    if recurrence:
+        event['recurrence'] = recurrence
+    if 'RECURRENCE-ID' in values:
+        event['originalStartTime'] = _time_value(*values['RECURRENCE-ID'], default_tz)
+    return event
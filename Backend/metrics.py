@@ -0,0 +1,363 @@
+import json
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter as Tally
+from contextlib import nullcontext
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Requests may ask for a profile (?profile=timing or ?profile=sample) only when this is on
+PROFILING = os.getenv('PROFILING', '0').lower() in ('1', 'true', 'yes')
+# Seconds between stack samples in sample mode
+SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL', '0.005'))
+PROFILE_MODES = ('timing', 'sample')
+# Distinct stacks returned by a sampled profile, most frequent first
+TOP_STACKS = 50
+
+PREFIX = 'calendar_backend_'
+# Seconds between a worker's copies of its metrics to a shared cache tier
+SHARE_INTERVAL = float(os.getenv('METRICS_SHARE_INTERVAL', '5'))
+# Workers whose last copy is still counted; older ones drop out of the totals
+KEEP_WORKERS = 64
+WORKERS_KEY = 'metrics:workers'
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                     for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Counter:
+    def __init__(self, name, description, labels=()):
+        self.name = PREFIX + name
+        self.description = description
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(labels), value] for labels, value in self._values.items()]
+
+    def merge(self, snapshots):
+        # Values summed over several workers' snapshots
+        values = {}
+        for snapshot in snapshots:
+            for labels, value in snapshot:
+                labels = tuple(labels)
+                values[labels] = values.get(labels, 0) + value
+        return values
+
+    def render(self, values=None):
+        if values is None:
+            with self._lock:
+                values = dict(self._values)
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} counter']
+        for labels, value in sorted(values.items()):
+            lines.append(f'{self.name}{_labels(self.labels, labels)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, description, labels=(), buckets=BUCKETS):
+        self.name = PREFIX + name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}  # labels -> [count per bucket..., count above the last, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            else:
+                counts[len(self.buckets)] += 1
+            counts[-1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(labels), counts] for labels, counts in self._values.items()]
+
+    def merge(self, snapshots):
+        values = {}
+        for snapshot in snapshots:
+            for labels, counts in snapshot:
+                labels = tuple(labels)
+                total = values.get(labels)
+                values[labels] = counts if total is None else [a + b for a, b in zip(total, counts)]
+        return values
+
+    def render(self, values=None):
+        if values is None:
+            with self._lock:
+                values = {labels: list(counts) for labels, counts in self._values.items()}
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        names = self.labels + ('le',)
+        for labels, counts in sorted(values.items()):
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                lines.append(f'{self.name}_bucket{_labels(names, labels + (bound,))} {total}')
+            lines.append(f'{self.name}_sum{_labels(self.labels, labels)} {counts[-1]}')
+            lines.append(f'{self.name}_count{_labels(self.labels, labels)} {total}')
+        return lines
+
+
+class Gauge:
+    # Read from a callback when /metrics is scraped
+    def __init__(self, name, description, read):
+        self.name = PREFIX + name
+        self.description = description
+        self.read = read
+
+    def snapshot(self):
+        return self.read()
+
+    def merge(self, snapshots):
+        return sum(snapshots)
+
+    def render(self, value=None):
+        value = self.read() if value is None else value
+        return [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} gauge', f'{self.name} {value}']
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def snapshot(self):
+        return {metric.name: metric.snapshot() for metric in self.metrics}
+
+    def render(self, snapshots=None):
+        # This process's metrics, or the sum of several workers' snapshots when given
+        lines = []
+        for metric in self.metrics:
+            if snapshots is None:
+                lines.extend(metric.render())
+            else:
+                lines.extend(metric.render(metric.merge([s[metric.name] for s in snapshots if metric.name in s])))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+HTTP_REQUESTS = REGISTRY.add(Counter('http_requests_total', 'Requests served, by route and status',
+                                     ('route', 'method', 'status')))
+HTTP_DURATION = REGISTRY.add(Histogram('http_request_duration_seconds', 'Time to build each response',
+                                       ('route', 'method')))
+UPSTREAM_REQUESTS = REGISTRY.add(Counter('upstream_requests_total', 'Google API calls, every attempt, by status',
+                                         ('operation', 'status')))
+UPSTREAM_DURATION = REGISTRY.add(Histogram('upstream_request_duration_seconds', 'Time of each Google API attempt',
+                                           ('operation',)))
+UPSTREAM_RETRIES = REGISTRY.add(Counter('upstream_retries_total', 'Google API calls sent again after a failure',
+                                        ('operation',)))
+COALESCED = REGISTRY.add(Counter('coalesced_calls_total', 'Calls that shared a result already in flight',
+                                 ('flight',)))
+CACHE_LOOKUPS = REGISTRY.add(Counter('cache_lookups_total', 'Cache lookups by cache and result',
+                                     ('cache', 'result')))
+TOKEN_REFRESHES = REGISTRY.add(Counter('token_refreshes_total', 'OAuth access token refreshes by result',
+                                       ('result',)))
+
+
+class SharedMetrics:
+    # Metrics of every worker sharing a cache tier, so a scrape that reaches any one of them
+    # sees the totals. Each worker copies its own into the store every SHARE_INTERVAL seconds
+    # and /metrics sums the copies. A restarted worker's last copy is still counted, so the
+    # totals keep growing instead of looking like a reset to Prometheus.
+    def __init__(self, store, registry=REGISTRY):
+        self.store = store
+        self.registry = registry
+        worker = uuid.uuid4().hex[:8]
+        self._key = f'metrics:{worker}'
+        store.append(WORKERS_KEY, worker.encode('ascii'), KEEP_WORKERS)
+        threading.Thread(target=self._run, name='metrics-share', daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(SHARE_INTERVAL)
+            try:
+                self.share()
+            except Exception:
+                pass  # The cache tier is unreachable; the next copy catches up
+
+    def share(self):
+        self.store.set(self._key, json.dumps(self.registry.snapshot()).encode('utf-8'))
+
+    def render(self):
+        self.share()  # Our own numbers as of now
+        snapshots = []
+        for _, worker in self.store.since(WORKERS_KEY, 0):
+            data = self.store.get(f"metrics:{worker.decode('ascii')}")
+            if data is not None:
+                snapshots.append(json.loads(data))
+        return self.registry.render(snapshots)
+
+
+# Per-request profiling. A request's Profile is attached to the threads working for it,
+# and span() records into whichever Profile the calling thread has, if any.
+_local = threading.local()
+
+
+class Profile:
+    def __init__(self, mode):
+        self.mode = mode
+        self.started = time.perf_counter()
+        self.spans = []  # (name, start, duration) in seconds from the start of the request
+        self.threads = set()
+        self.samples = Tally()  # Collapsed stack -> times it was seen
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def add(self, name, start, end):
+        with self._lock:
+            self.spans.append((name, start - self.started, end - start))
+
+    def start_sampling(self):
+        self._sampler = threading.Thread(target=self._sample, name='profile-sampler', daemon=True)
+        self._sampler.start()
+
+    def _sample(self):
+        while not self._stop.wait(SAMPLE_INTERVAL):
+            frames = sys._current_frames()
+            with self._lock:
+                threads = list(self.threads)
+            for ident in threads:
+                frame = frames.get(ident)
+                if frame is not None:
+                    self.samples[collapse(frame)] += 1
+
+    def finish(self):
+        self.elapsed = time.perf_counter() - self.started
+        if self._sampler is not None:
+            self._stop.set()
+            self._sampler.join()
+
+    def totals(self):
+        # Total time and count per span name, in the order the names first appeared
+        totals = {}
+        with self._lock:
+            for name, _, duration in self.spans:
+                total = totals.setdefault(name, [0.0, 0])
+                total[0] += duration
+                total[1] += 1
+        return totals
+
+    def server_timing(self):
+        parts = [f'total;dur={self.elapsed * 1000:.2f}']
+        for name, (duration, count) in self.totals().items():
+            token = re.sub(r'[^A-Za-z0-9_.-]', '_', name)
+            parts.append(f'{token};dur={duration * 1000:.2f};desc="{name} x{count}"')
+        return ', '.join(parts)
+
+    def report(self):
+        report = {
+            'mode': self.mode,
+            'totalMs': round(self.elapsed * 1000, 3),
+            'spans': [{'name': name, 'startMs': round(start * 1000, 3), 'durationMs': round(duration * 1000, 3)}
+                      for name, start, duration in sorted(self.spans, key=lambda span: span[1])],
+        }
+        if self.mode == 'sample':
+            report['sampleIntervalMs'] = SAMPLE_INTERVAL * 1000
+            report['samples'] = sum(self.samples.values())
+            report['stacks'] = [{'stack': stack, 'count': count} for stack, count in self.samples.most_common(TOP_STACKS)]
+        return report
+
+
+# Stack of a frame as 'outer;...;inner', each entry 'function (file:line)', as flame graph tools read them
+def collapse(frame):
+    entries = []
+    while frame is not None:
+        code = frame.f_code
+        entries.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(entries))
+
+
+def current():
+    return getattr(_local, 'profile', None)
+
+
+def start_profile(mode):
+    profile = Profile(mode)
+    attach(profile)
+    if mode == 'sample':
+        profile.start_sampling()
+    return profile
+
+
+def attach(profile):
+    _local.profile = profile
+    if profile is not None:
+        with profile._lock:
+            profile.threads.add(threading.get_ident())
+
+
+def detach():
+    profile = current()
+    _local.profile = None
+    if profile is not None:
+        with profile._lock:
+            profile.threads.discard(threading.get_ident())
+
+
+class _Span:
+    __slots__ = ('profile', 'name', 'start')
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.profile.add(self.name, self.start, time.perf_counter())
+
+
+_NOTHING = nullcontext()
+
+
+def span(name):
+    # Time a block into the current request's profile; free when the request is not profiled
+    profile = getattr(_local, 'profile', None)
+    return _NOTHING if profile is None else _Span(profile, name)
+
+
+class _Bound:
+    __slots__ = ('profile',)
+
+    def __init__(self, profile):
+        self.profile = profile
+
+    def __enter__(self):
+        attach(self.profile)
+
+    def __exit__(self, *exc):
+        detach()
+
+
+def bound(profile):
+    # Run a block on a worker thread as part of the given request's profile
+    return _NOTHING if profile is None else _Bound(profile)
@@ -0,0 +1,232 @@
+import datetime
+import json
+import threading
+import time
+import uuid
+from urllib.parse import unquote
+
+from googleapiclient.errors import HttpError
+
+from shared_store import MemoryStore
+
+# Seconds between keep-alive comments on an idle Server-Sent Events stream
+HEARTBEAT = 15
+# Seconds between checks for changes published by other workers
+POLL_INTERVAL = 1.0
+# Lifetime requested for Calendar watch channels; Google caps it at its own maximum
+CHANNEL_TTL = 7 * 24 * 3600
+# Renew channels this long before they expire
+RENEW_MARGIN = datetime.timedelta(hours=1)
+# Wait before retrying a calendar that refused a watch channel
+RETRY_FAILED_AFTER = 3600
+# Seconds a worker's claim on registering a calendar's channel lasts while the registration runs
+CLAIM_TTL = 60
+
+
+class ChangeFeed:
+    # Numbered change notifications that frontends follow over SSE or long-polling.
+    # The numbered log lives in the cache tier, so a change published by any worker reaches
+    # listeners on every worker; listeners on other workers notice it within POLL_INTERVAL.
+    # Numbers start over whenever the log does (an in-process log on every restart), so event
+    # IDs carry the log's epoch and a client resuming from another epoch is told to reload.
+    def __init__(self, store=None, namespace='', history=256):
+        self.store = store if store is not None else MemoryStore()
+        self.history = history
+        self._key = f'{namespace}:changes'
+        self._cond = threading.Condition()
+        self.listeners = 0  # Frontends currently following the feed
+        self.epoch = self._epoch()
+
+    def _epoch(self):
+        epoch = uuid.uuid4().hex[:8]
+        if not self.store.shared:
+            return epoch
+        # Workers sharing the log share its epoch; the first one to start picks it
+        self.store.add(self._key + ':epoch', epoch.encode('ascii'))
+        return (self.store.get(self._key + ':epoch') or epoch.encode('ascii')).decode('ascii')
+
+    def event_id(self, seq):
+        return f'{self.epoch}-{seq}'
+
+    def resume_seq(self, event_id):
+        # Sequence number to resume after from a Last-Event-ID, or None if it is from another epoch
+        epoch, _, seq = event_id.rpartition('-')
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        return int(seq)
+
+    def reset(self):
+        # Tells a client that lost its place to reload everything
+        return {'calendarId': None, 'seq': self.last_seq}
+
+    @property
+    def last_seq(self):
+        return self.store.counter(self._key)
+
+    def publish(self, calendar_id=None, time_range=None):
+        change = {'calendarId': calendar_id}
+        if time_range:
+            change['timeMin'] = time_range[0].isoformat()
+            change['timeMax'] = time_range[1].isoformat()
+        change['seq'] = self.store.append(self._key, json.dumps(change).encode('utf-8'), self.history)
+        with self._cond:
+            self._cond.notify_all()
+        return change
+
+    def since(self, seq, timeout):
+        # Block until something newer than seq is published or the timeout passes
+        if seq > self.last_seq:
+            return [self.reset()]  # A number from before the log started over
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self.listeners += 1
+            try:
+                while True:
+                    changes = self.store.since(self._key, seq)
+                    remaining = deadline - time.monotonic()
+                    if changes or remaining <= 0:
+                        break
+                    self._cond.wait(min(remaining, POLL_INTERVAL) if self.store.shared else remaining)
+            finally:
+                self.listeners -= 1
+        changes = [dict(json.loads(change), seq=number) for number, change in changes]
+        if changes and changes[0]['seq'] > seq + 1:
+            # The client fell behind the kept history, tell it to reload everything
+            changes = [{'calendarId': None, 'seq': changes[-1]['seq']}]
+        return changes
+
+    def _message(self, change):
+        return f"id: {self.event_id(change['seq'])}\ndata: {json.dumps(change)}\n\n"
+
+    # seq is None for a client resuming from another epoch, which is sent a reset first
+    def stream(self, seq):
+        with self._cond:
+            self.listeners += 1
+        try:
+            yield 'retry: 5000\n\n'
+            if seq is None:
+                change = self.reset()
+                seq = change['seq']
+                yield self._message(change)
+            while True:
+                changes = self.since(seq, HEARTBEAT)
+                if not changes:
+                    yield ': keep-alive\n\n'
+                    continue
+                for change in changes:
+                    seq = change['seq']
+                    yield self._message(change)
+        finally:
+            with self._cond:
+                self.listeners -= 1
+
+    # What stream() would send first, without waiting for more: the stream then ends and the
+    # client reconnects after retry seconds, polling the feed over the same protocol. With
+    # nothing new it still sends the position, an id without data, for the client to resume from.
+    def poll(self, seq, retry):
+        yield f'retry: {int(retry * 1000)}\n\n'
+        changes = [self.reset()] if seq is None else self.since(seq, 0)
+        for change in changes:
+            yield self._message(change)
+        if not changes:
+            yield f'id: {self.event_id(seq)}\n\n'
+
+
+class WatchChannels:
+    # Calendar events().watch channels, one per calendar, pointed at our webhook.
+    # Workers claim a calendar in the cache tier before registering it, so only one holds its channel.
+    def __init__(self, address, token, store=None, namespace=''):
+        self.address = address
+        self.token = token
+        self.store = store if store is not None else MemoryStore()
+        self.namespace = namespace
+        self._channels = {}  # channel ID -> {'calendarId', 'resourceId', 'expiration'}
+        self._failed = {}  # calendar ID -> time of the last refused registration
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.address and self.token)
+
+    def calendar_for(self, channel_id):
+        with self._lock:
+            channel = self._channels.get(channel_id)
+            return channel['calendarId'] if channel else None
+
+    def listing(self):
+        with self._lock:
+            return [{'channelId': channel_id, 'calendarId': channel['calendarId'],
+                     'expiration': channel['expiration'].isoformat()}
+                    for channel_id, channel in self._channels.items()]
+
+    def ensure(self, calendar_ids, service_manager):
+        # Register channels for calendars without a live one and renew those about to expire
+        if not self.enabled:
+            return
+        now = datetime.datetime.now(datetime.timezone.utc)
+        with self._lock:
+            live = {}
+            for channel_id, channel in self._channels.items():
+                if channel['expiration'] - RENEW_MARGIN > now:
+                    live[channel['calendarId']] = channel_id
+            expired = [(channel_id, channel) for channel_id, channel in self._channels.items()
+                       if live.get(channel['calendarId']) != channel_id]
+            missing = [calendar_id for calendar_id in calendar_ids
+                       if calendar_id not in live
+                       and time.monotonic() - self._failed.get(calendar_id, -RETRY_FAILED_AFTER) >= RETRY_FAILED_AFTER]
+
+        if not missing and not expired:
+            return
+        with service_manager.service() as service:
+            for calendar_id in missing:
+                if self.store.add(self._claim(calendar_id), b'1', CLAIM_TTL):
+                    self._register(service, calendar_id)
+            for channel_id, channel in expired:
+                self._stop(service, channel_id, channel)
+
+    def _register(self, service, calendar_id):
+        body = {
+            'id': str(uuid.uuid4()),
+            'type': 'web_hook',
+            'address': self.address,
+            'token': self.token,
+            'params': {'ttl': str(CHANNEL_TTL)},
+        }
+        try:
+            result = service.events().watch(calendarId=calendar_id, body=body).execute()
+        except HttpError:
+            # Some calendars (holidays, birthdays) do not support push notifications
+            self.store.delete(self._claim(calendar_id))
+            with self._lock:
+                self._failed[calendar_id] = time.monotonic()
+            return
+        expiration = datetime.datetime.fromtimestamp(int(result['expiration']) / 1000, datetime.timezone.utc)
+        # Hold the claim until the channel is due for renewal, when any worker may take it over
+        renew_in = (expiration - RENEW_MARGIN - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+        self.store.set(self._claim(calendar_id), b'1', max(renew_in, 1))
+        with self._lock:
+            self._channels[result['id']] = {
+                'calendarId': calendar_id,
+                'resourceId': result['resourceId'],
+                'expiration': expiration,
+            }
+            self._failed.pop(calendar_id, None)
+
+    def _claim(self, calendar_id):
+        return f'{self.namespace}:watch:{calendar_id}'
+
+    def _stop(self, service, channel_id, channel):
+        with self._lock:
+            self._channels.pop(channel_id, None)
+        try:
+            service.channels().stop(body={'id': channel_id, 'resourceId': channel['resourceId']}).execute()
+        except HttpError:
+            pass  # Already gone upstream
+
+
+# Pull the calendar ID out of a notification's resource URI,
+# e.g. https://www.googleapis.com/calendar/v3/calendars/<id>/events?alt=json
+def calendar_from_uri(resource_uri):
+    if not resource_uri or '/calendars/' not in resource_uri:
+        return None
+    return unquote(resource_uri.split('/calendars/', 1)[1].split('/', 1)[0])
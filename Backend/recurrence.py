@@ -0,0 +1,214 @@
+import bisect
+import datetime
+import os
+import re
+from collections import OrderedDict
+
+from dateutil import rrule
+
+from event_record import EventRecord, DISPLAY_TIMEZONE, get_timezone
+
+# How far past timeMin a window with no timeMax expands series that never end
+RECURRENCE_HORIZON = int(os.getenv('RECURRENCE_HORIZON_DAYS', '365')) * 86400
+# Series are expanded in buckets of this many seconds, aligned to the epoch, so any window
+# inside already expanded buckets is answered by bisecting them
+BUCKET = 28 * 86400
+# Expanded buckets remembered per series, least recently used are dropped first; enough for
+# a year past any timeMin, which is how far open-ended windows expand
+MEMO_BUCKETS = int(os.getenv('RECURRENCE_MEMO_BUCKETS', '32'))
+# Slack around a window in local time, so DST shifts never drop an instance at its edge
+PAD = datetime.timedelta(days=1)
+
+UTC_UNTIL = re.compile(r'UNTIL=(\d{8}T\d{6})Z')
+
+
+def parse_utc(value):
+    return datetime.datetime.strptime(value, '%Y%m%dT%H%M%SZ').replace(tzinfo=datetime.timezone.utc)
+
+
+# Suffix Google gives the IDs of a series' instances: the original start in UTC, or the date
+def instance_suffix(start):
+    if 'date' in start:
+        return start['date'].replace('-', '')
+    value = datetime.datetime.fromisoformat(start['dateTime'].replace('Z', '+00:00'))
+    return value.astimezone(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+# Naive local times in tz for the values of an EXDATE or RDATE line
+def parse_dates(line, tz):
+    head, _, values = line.partition(':')
+    params = dict(param.split('=', 1) for param in head.split(';')[1:] if '=' in param)
+    value_tz = get_timezone(params['TZID']) if 'TZID' in params else None
+    dates = []
+    for value in values.split(','):
+        value = value.split('/')[0].strip()  # A PERIOD only counts by its start
+        if not value:
+            continue
+        if 'T' not in value:
+            dates.append(datetime.datetime.strptime(value, '%Y%m%d'))
+        elif value.endswith('Z'):
+            dates.append(parse_utc(value).astimezone(tz).replace(tzinfo=None))
+        else:
+            local = datetime.datetime.strptime(value, '%Y%m%dT%H%M%S')
+            if value_tz is not None:
+                local = value_tz.localize(local).astimezone(tz).replace(tzinfo=None)
+            dates.append(local)
+    return dates
+
+
+# The RRULE, EXRULE, RDATE and EXDATE lines of an event as one rule set over naive local
+# times in tz, and whether it ends. UTC UNTIL values are moved into tz as well, since
+# dateutil will not mix them with a naive start.
+def build_rules(lines, dtstart, tz):
+    def local_until(match):
+        return 'UNTIL=' + parse_utc(match.group(1) + 'Z').astimezone(tz).strftime('%Y%m%dT%H%M%S')
+
+    rules = rrule.rruleset(cache=True)
+    bounded = True
+    has_rule = False
+    for line in lines:
+        name = line.split(':', 1)[0].split(';', 1)[0].upper()
+        if name in ('RRULE', 'EXRULE'):
+            line = UTC_UNTIL.sub(local_until, line)
+            rule = rrule.rrulestr(line.split(':', 1)[1], dtstart=dtstart)
+            if name == 'RRULE':
+                has_rule = True
+                bounded = bounded and ('COUNT=' in line or 'UNTIL=' in line)
+                rules.rrule(rule)
+            else:
+                rules.exrule(rule)
+        elif name in ('RDATE', 'EXDATE'):
+            add = rules.rdate if name == 'RDATE' else rules.exdate
+            for value in parse_dates(line, tz):
+                add(value)
+    if not has_rule:
+        rules.rdate(dtstart)
+    return rules, bounded
+
+
+class Series:
+    # A recurring event's master, expanded into single instances only for the windows asked for
+    def __init__(self, calendar_id, master, overrides, tz_name=DISPLAY_TIMEZONE):
+        self.calendar_id = calendar_id
+        self.master = master
+        self.tz_name = tz_name
+        # Suffixes of instances an exception moved, edited or cancelled; owned by the store
+        self.overrides = overrides
+        self.all_day = 'dateTime' not in master['start']
+        if self.all_day:
+            # All-day instances are floating dates, expanded like EventRecord places them
+            self.tz = get_timezone(tz_name)
+            start_date = datetime.date.fromisoformat(master['start']['date'])
+            end_date = datetime.date.fromisoformat(master['end']['date'])
+            dtstart = datetime.datetime.combine(start_date, datetime.time())
+            self.duration = end_date - start_date
+        else:
+            # Timed instances keep their wall-clock time in the series' own timezone across DST
+            self.tz = get_timezone(master['start'].get('timeZone') or tz_name)
+            start = datetime.datetime.fromisoformat(master['start']['dateTime'].replace('Z', '+00:00'))
+            end = datetime.datetime.fromisoformat(master['end']['dateTime'].replace('Z', '+00:00'))
+            dtstart = start.astimezone(self.tz).replace(tzinfo=None)
+            self.duration = end - start
+        try:
+            self.rules, bounded = build_rules(master.get('recurrence', []), dtstart, self.tz)
+        except (ValueError, KeyError):
+            # A rule we cannot read still leaves the master's own occurrence
+            self.rules, bounded = build_rules([], dtstart, self.tz)
+        # Bucket number -> (instance records starting in it, their starts), least recently used first
+        self._buckets = OrderedDict()
+        # No instance lasts longer than this, with room for an all-day instance spanning a DST change
+        self.longest = self.duration.total_seconds() + (3600 if self.all_day else 0)
+
+        # Spans the whole series, for the search index and the saved copy
+        self.record = EventRecord(calendar_id, master, tz_name)
+        self.start_ts = self.record.start_ts
+        self.end_ts = float('inf')
+        if bounded:
+            last = None
+            for last in self.rules:
+                pass
+            self.end_ts = self._end_ts(last) if last is not None else self.start_ts
+        self.record.end_ts = self.end_ts
+
+    def _local(self, ts):
+        return datetime.datetime.fromtimestamp(ts, self.tz).replace(tzinfo=None)
+
+    def _aware(self, start):
+        return self.tz.normalize(self.tz.localize(start))
+
+    def _end_ts(self, start):
+        if self.all_day:
+            return self._aware(start + self.duration).timestamp()
+        return self._aware(start).timestamp() + self.duration.total_seconds()
+
+    def suffix(self, start):
+        if self.all_day:
+            return start.strftime('%Y%m%d')
+        return self._aware(start).astimezone(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+    def instance_event(self, start):
+        # The event resource Google would return for the instance starting at local time start
+        event = {key: value for key, value in self.master.items() if key not in ('recurrence', 'start', 'end')}
+        event['id'] = f"{self.master['id']}_{self.suffix(start)}"
+        event['recurringEventId'] = self.master['id']
+        if self.all_day:
+            event['start'] = {'date': start.date().isoformat()}
+            event['end'] = {'date': (start + self.duration).date().isoformat()}
+        else:
+            aware = self._aware(start)
+            time_zone = self.master['start'].get('timeZone')
+            event['start'] = {'dateTime': aware.isoformat(), 'timeZone': time_zone}
+            event['end'] = {'dateTime': self.tz.normalize(aware + self.duration).isoformat(), 'timeZone': time_zone}
+        event['originalStartTime'] = event['start']
+        return event
+
+    def instance(self, suffix):
+        # Event resource of the instance with this ID suffix, or None if the series has no such instance
+        try:
+            if self.all_day:
+                start = datetime.datetime.strptime(suffix, '%Y%m%d')
+            else:
+                start = parse_utc(suffix).astimezone(self.tz).replace(tzinfo=None)
+        except ValueError:
+            return None
+        if suffix in self.overrides or not self.rules.between(start, start, inc=True):
+            return None
+        return self.instance_event(start)
+
+    def instances(self, min_ts, max_ts=None):
+        # Records of the instances overlapping [min_ts, max_ts) in start order.
+        # Series that never end are expanded RECURRENCE_HORIZON past min_ts when there is no max_ts.
+        if max_ts is None:
+            max_ts = min_ts + RECURRENCE_HORIZON
+        first = max(min_ts - self.longest, self.start_ts)
+        last = min(max_ts, self.end_ts)
+        records = []
+        if first > last:
+            return records
+        for number in range(int(first // BUCKET), int(last // BUCKET) + 1):
+            bucket, starts = self._bucket(number)
+            lo = bisect.bisect_left(starts, min_ts - self.longest)
+            hi = bisect.bisect_left(starts, max_ts)
+            records.extend(record for record in bucket[lo:hi] if record.end_ts > min_ts)
+        return records
+
+    def _bucket(self, number):
+        bucket = self._buckets.get(number)
+        if bucket is not None:
+            self._buckets.move_to_end(number)
+            return bucket
+        lo = number * BUCKET
+        hi = lo + BUCKET
+        records = []
+        for start in self.rules.between(self._local(lo) - PAD, self._local(hi) + PAD, inc=True):
+            if not lo <= self._aware(start).timestamp() < hi or self.suffix(start) in self.overrides:
+                continue
+            records.append(EventRecord(self.calendar_id, self.instance_event(start), self.tz_name))
+        bucket = self._buckets[number] = (records, [record.start_ts for record in records])
+        if len(self._buckets) > MEMO_BUCKETS:
+            self._buckets.popitem(last=False)
+        return bucket
+
+    def forget_windows(self):
+        # Called when an exception to the series changes
+        self._buckets.clear()
@@ -0,0 +1,53 @@
+import hashlib
+import os
+import struct
+
+import metrics
+from compression import compress
+from shared_store import MemoryStore
+
+# Seconds a serialized response is served without going back to Google
+CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', '30'))
+
+# A stored entry is the ETag, the body's length, the body and then the gzip form, if any
+HEADER = struct.Struct('>64sI')
+
+
+class ResponseCache:
+    # Serialized JSON bodies, their gzip form and strong ETags, keyed by route and query window.
+    # Entries live in the cache tier under the user's namespace, so every worker serves them,
+    # and invalidate() bumps a generation number that retires all of them at once.
+    def __init__(self, store=None, namespace='', ttl=CACHE_TTL):
+        self.store = store if store is not None else MemoryStore()
+        self.namespace = namespace
+        self.ttl = ttl
+        self._generation_key = f'{namespace}:responses'
+
+    def _key(self, key):
+        generation = self.store.counter(self._generation_key)
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return f'{self.namespace}:response:{generation}:{digest}'
+
+    def get(self, key):
+        entry = self.store.get(self._key(key))
+        if entry is None:
+            metrics.CACHE_LOOKUPS.inc('response', 'miss')
+            return None
+        metrics.CACHE_LOOKUPS.inc('response', 'hit')
+        etag, length = HEADER.unpack_from(entry)
+        body = entry[HEADER.size:HEADER.size + length]
+        compressed = entry[HEADER.size + length:] or None
+        return body, etag.decode('ascii'), compressed
+
+    def put(self, key, body):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        etag = hashlib.sha256(body).hexdigest()
+        # Compressed once per rebuild rather than on every cache hit
+        compressed = compress(body)
+        entry = HEADER.pack(etag.encode('ascii'), len(body)) + body + (compressed or b'')
+        self.store.set(self._key(key), entry, self.ttl)
+        return body, etag, compressed
+
+    def invalidate(self):
+        self.store.incr(self._generation_key)
@@ -0,0 +1,221 @@
+import email.utils
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future
+from urllib.parse import unquote, urlsplit
+
+import metrics
+
+# Sustained requests per second and burst size Google allows the whole project, and each user
+PROJECT_RATE = float(os.getenv('UPSTREAM_PROJECT_RATE', '50'))
+PROJECT_BURST = int(os.getenv('UPSTREAM_PROJECT_BURST', '100'))
+USER_RATE = float(os.getenv('UPSTREAM_USER_RATE', '10'))
+USER_BURST = int(os.getenv('UPSTREAM_USER_BURST', '20'))
+# Retries of a throttled or failing upstream call before its error is passed on
+MAX_RETRIES = int(os.getenv('UPSTREAM_RETRIES', '5'))
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 32
+
+# Statuses that are worth retrying, besides a 403 when Google says it is a rate limit
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+
+class TokenBucket:
+    # Lets through `rate` requests per second on average and up to `burst` at once
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        # The full cost is taken at once, even past the burst size, so the bucket can go negative;
+        # the caller then sleeps until it is paid off and later callers queue behind it
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                else:
+                    self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    wait = max(0.0, (tokens - self._tokens) / self.rate)
+                    self._tokens -= tokens
+                    break
+            time.sleep(wait)
+        if wait:
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        # Google asked us to slow down: hold every caller of this quota, not just the one that was told
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class SingleFlight:
+    # Concurrent calls with the same key share the first caller's result instead of repeating the work
+    def __init__(self, name='calls'):
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+        if not leader:
+            metrics.COALESCED.inc(self.name)
+            return call.result()
+        try:
+            result = fn()
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+# Seconds to wait before retry number `attempt`: Retry-After when given, else full-jitter backoff
+def retry_delay(attempt, retry_after=None):
+    if retry_after is not None:
+        return retry_after
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+# Seconds from a Retry-After header, given either as a number or an HTTP date
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+# Whether Google rejected a call for going over quota
+def is_rate_limited(status, content):
+    if status == 429:
+        return True
+    if status != 403:
+        return False
+    try:
+        errors = json.loads(content)['error']['errors']
+    except (ValueError, KeyError, TypeError):
+        return False
+    return any(error.get('reason') in RATE_LIMIT_REASONS for error in errors)
+
+
+def is_retryable(status, content):
+    return status in RETRY_STATUSES or is_rate_limited(status, content)
+
+
+class UpstreamScheduler:
+    # Gate in front of every Google call: shared project quota, identical GETs coalesced, retries
+    def __init__(self, rate=PROJECT_RATE, burst=PROJECT_BURST, max_retries=MAX_RETRIES):
+        self.project_quota = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self.flights = SingleFlight('upstream')
+
+    def request(self, send, quotas, cost=1):
+        # send() performs the HTTP call and returns httplib2's (response, content)
+        attempt = 0
+        while True:
+            with metrics.span('quota_wait'):
+                for quota in (self.project_quota,) + tuple(quotas):
+                    quota.acquire(cost)
+            response, content = send(attempt)
+            if attempt >= self.max_retries or not is_retryable(response.status, content):
+                return response, content
+            retry_after = parse_retry_after(response.get('retry-after'))
+            delay = retry_delay(attempt, retry_after)
+            if retry_after is not None:
+                for quota in (self.project_quota,) + tuple(quotas):
+                    quota.pause(retry_after)
+            time.sleep(delay)
+            attempt += 1
+
+
+# Calendar API method a request URI calls, e.g. 'events.list', for metrics labels that never
+# carry calendar or event IDs
+def upstream_operation(method, uri):
+    path = unquote(urlsplit(uri).path)
+    if '/batch/' in path or path.endswith('/batch'):
+        return 'batch'
+    parts = path.split('/calendar/v3/', 1)[-1].strip('/').split('/')
+    if parts[-1] == 'calendarList':
+        return 'calendarList.list'
+    if parts == ['freeBusy']:
+        return 'freebusy.query'
+    if parts[:2] == ['channels', 'stop']:
+        return 'channels.stop'
+    if len(parts) >= 3 and parts[0] == 'calendars' and parts[2] == 'events':
+        if len(parts) == 3:
+            return 'events.insert' if method == 'POST' else 'events.list'
+        if parts[3] == 'watch':
+            return 'events.watch'
+        return {'GET': 'events.get', 'PUT': 'events.update', 'PATCH': 'events.patch',
+                'DELETE': 'events.delete'}.get(method, 'events.other')
+    if len(parts) == 2 and parts[0] == 'calendars':
+        return 'calendars.get'
+    return 'other'
+
+
+class ScheduledHttp:
+    # An httplib2-compatible Http whose requests all go through the scheduler.
+    # GETs in flight for the same user and URI are sent once and share the response.
+    def __init__(self, http, scheduler, quota, owner):
+        self.http = http
+        self.scheduler = scheduler
+        self.quota = quota
+        self.owner = owner
+
+    @property
+    def credentials(self):
+        return self.http.credentials
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        operation = upstream_operation(method, uri)
+
+        def send(attempt):
+            if attempt:
+                metrics.UPSTREAM_RETRIES.inc(operation)
+            started = time.perf_counter()
+            status = 'error'
+            try:
+                with metrics.span(operation):
+                    response, content = self.http.request(uri, method=method, body=body, headers=headers, **kwargs)
+                status = response.status
+                return response, content
+            finally:
+                metrics.UPSTREAM_DURATION.observe(time.perf_counter() - started, operation)
+                metrics.UPSTREAM_REQUESTS.inc(operation, status)
+
+        # A batch counts against quota once per request inside it
+        cost = body.count('Content-ID: ') if '/batch/' in uri and isinstance(body, str) else 1
+
+        def scheduled():
+            return self.scheduler.request(send, (self.quota,), max(cost, 1))
+
+        if method == 'GET' and body is None:
+            return self.scheduler.flights.do((self.owner, uri), scheduled)
+        return scheduled()
+
+    def __getattr__(self, name):
+        return getattr(self.http, name)
@@ -0,0 +1,135 @@
+import bisect
+import math
+import re
+import threading
+
+# How much a match in each field counts towards an event's score
+FIELD_WEIGHTS = (('summary', 3.0), ('location', 2.0), ('description', 1.0))
+# Matching a query word as a prefix counts for less than matching it exactly
+PREFIX_WEIGHT = 0.5
+# Index terms a single prefix may expand to, so one-letter queries stay cheap
+MAX_EXPANSIONS = 200
+
+WORD = re.compile(r'\w+')
+
+
+def tokenize(text):
+    return WORD.findall(text.casefold()) if text else []
+
+
+class SearchIndex:
+    # Inverted index over event summaries, locations and descriptions, kept up to date one
+    # event at a time as stores apply sync deltas and local edits
+    def __init__(self):
+        self._postings = {}  # term -> {(calendar_id, event_id): weight}
+        self._terms = []  # Every indexed term, sorted, for prefix lookups
+        self._docs = {}  # (calendar_id, event_id) -> (start_ts, end_ts, terms)
+        self._lock = threading.Lock()
+
+    def add(self, record, event):
+        # Index an event, replacing whatever was indexed for it before
+        with self._lock:
+            self._add(record, event, new_terms=self._insert_term)
+
+    def add_many(self, records_and_events):
+        # Index a whole calendar at once, sorting the term list once at the end
+        with self._lock:
+            for record, event in records_and_events:
+                self._add(record, event)
+            self._terms = sorted(self._postings)
+
+    def _insert_term(self, term):
+        bisect.insort(self._terms, term)
+
+    def _add(self, record, event, new_terms=None):
+        weights = {}
+        for field, weight in FIELD_WEIGHTS:
+            for term in tokenize(event.get(field)):
+                weights[term] = weights.get(term, 0) + weight
+        key = (record.calendar_id, record.event_id)
+        self._remove(key)
+        for term, weight in weights.items():
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = {}
+                if new_terms is not None:
+                    new_terms(term)
+            postings[key] = weight
+        self._docs[key] = (record.start_ts, record.end_ts, tuple(weights))
+
+    def remove(self, calendar_id, event_id):
+        with self._lock:
+            self._remove((calendar_id, event_id))
+
+    def remove_calendar(self, calendar_id):
+        with self._lock:
+            for key in [key for key in self._docs if key[0] == calendar_id]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._postings.clear()
+            self._terms.clear()
+            self._docs.clear()
+
+    def _remove(self, key):
+        doc = self._docs.pop(key, None)
+        if doc is None:
+            return
+        for term in doc[2]:
+            postings = self._postings[term]
+            del postings[key]
+            if not postings:
+                del self._postings[term]
+                index = bisect.bisect_left(self._terms, term)
+                if index < len(self._terms) and self._terms[index] == term:
+                    del self._terms[index]
+
+    def _expand(self, word):
+        # Index terms starting with word, the exact match first
+        start = bisect.bisect_left(self._terms, word)
+        terms = []
+        for term in self._terms[start:start + MAX_EXPANSIONS]:
+            if not term.startswith(word):
+                break
+            terms.append(term)
+        return terms
+
+    def search(self, query, min_ts=None, max_ts=None, calendar_ids=None):
+        # Keys of events matching every query word (as a word or a word prefix) and
+        # overlapping [min_ts, max_ts), best first, then by start time
+        words = tokenize(query)
+        if not words:
+            return []
+        with self._lock:
+            total = len(self._docs)
+            scores = None
+            for word in words:
+                matched = {}
+                for term in self._expand(word):
+                    postings = self._postings[term]
+                    idf = math.log(1 + total / len(postings))
+                    factor = idf if term == word else idf * PREFIX_WEIGHT
+                    for key, weight in postings.items():
+                        score = weight * factor
+                        if score > matched.get(key, 0):
+                            matched[key] = score
+                if scores is None:
+                    scores = matched
+                else:
+                    scores = {key: score + matched[key] for key, score in scores.items() if key in matched}
+                if not scores:
+                    return []
+
+            results = []
+            for key, score in scores.items():
+                start_ts, end_ts, _ = self._docs[key]
+                if min_ts is not None and end_ts <= min_ts:
+                    continue
+                if max_ts is not None and start_ts >= max_ts:
+                    continue
+                if calendar_ids and key[0] not in calendar_ids:
+                    continue
+                results.append((-score, start_ts, key))
+        results.sort()
+        return [(key, -score) for score, _, key in results]
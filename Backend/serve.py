@@ -0,0 +1,110 @@
+# Production entry point: runs the backend under a multi-process WSGI server instead of the
+# Werkzeug development server that `python app.py` starts, e.g.:
+#   python serve.py --workers 4 --threads 8
+# Uses gunicorn's threaded workers where it is available (Linux, macOS) and waitress otherwise
+# (Windows), which serves from one process with a thread pool.
+#
+# Every open /changes stream (one per running widget) keeps a request thread for as long as it
+# is open, so each process holds at most --streams of them, half its threads by default; past
+# that, widgets are answered at once and poll every few seconds instead. Under waitress that is
+# the limit for the whole server, 8 live streams with its default 16 threads; raise --threads
+# (and --streams) for more widgets than that.
+#
+# Each worker counts its own metrics and copies them to the shared cache tier every few seconds
+# (METRICS_SHARE_INTERVAL), so /metrics on any worker reports the sum over all of them.
+import argparse
+import importlib.util
+import os
+import pathlib
+import sys
+
+HERE = pathlib.Path(__file__).resolve().parent
+# Cache tier several workers share when CACHE_BACKEND is not set
+DEFAULT_SHARED_CACHE = HERE / 'shared_cache.sqlite3'
+# Upstream quota settings that are per process, with scheduler.py's defaults
+QUOTA_SETTINGS = {'UPSTREAM_PROJECT_RATE': '50', 'UPSTREAM_PROJECT_BURST': '100',
+                  'UPSTREAM_USER_RATE': '10', 'UPSTREAM_USER_BURST': '20'}
+
+
+def configure(workers, streams):
+    # Run before any worker imports app.py, which reads these when it is imported.
+    # Each worker has its own token buckets, so each gets its share of the quota.
+    os.environ['MAX_CHANGE_STREAMS'] = str(streams)
+    if workers > 1:
+        os.environ.setdefault('CACHE_BACKEND', f'sqlite:///{DEFAULT_SHARED_CACHE}')
+        for name, default in QUOTA_SETTINGS.items():
+            value = float(os.getenv(name, default)) / workers
+            os.environ[name] = str(value) if name.endswith('RATE') else str(max(1, int(value)))
+
+
+def load_app():
+    sys.path.insert(0, str(HERE))
+    from app import app
+    return app
+
+
+def run_gunicorn(args):
+    from gunicorn.app.base import BaseApplication
+
+    class Server(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f'{args.host}:{args.port}')
+            self.cfg.set('workers', args.workers)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('threads', args.threads)
+            # Long enough for a cold sync of every calendar and for held /changes polls
+            self.cfg.set('timeout', 120)
+            self.cfg.set('keepalive', 5)
+
+        def load(self):
+            # Imported in each worker after the fork, so no worker inherits another's
+            # database connections, connection pools or background threads
+            return load_app()
+
+    Server().run()
+
+
+def run_waitress(args):
+    from waitress import serve
+    serve(load_app(), host=args.host, port=args.port, threads=args.threads)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the calendar backend')
+    parser.add_argument('--host', default=os.getenv('HOST', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=int(os.getenv('PORT', '9876')))
+    parser.add_argument('--workers', type=int, default=os.getenv('WEB_CONCURRENCY'),
+                        help='worker processes, gunicorn only (default: one per core, at most 4)')
+    parser.add_argument('--threads', type=int, default=os.getenv('WEB_THREADS'),
+                        help='request threads per worker (default: 8 for gunicorn, 16 for waitress)')
+    parser.add_argument('--streams', type=int, default=os.getenv('MAX_CHANGE_STREAMS'),
+                        help='open /changes streams per worker, each holding a thread (default: half the threads)')
+    parser.add_argument('--server', choices=['gunicorn', 'waitress'],
+                        help='default: gunicorn if it is installed and supported here, otherwise waitress')
+    args = parser.parse_args()
+
+    server = args.server
+    if server is None:
+        has_gunicorn = importlib.util.find_spec('gunicorn') is not None
+        server = 'gunicorn' if has_gunicorn and os.name == 'posix' else 'waitress'
+    if server == 'waitress':
+        if args.workers is not None and args.workers > 1:
+            print('waitress serves from one process; ignoring --workers', file=sys.stderr)
+        args.workers = 1
+    elif args.workers is None:
+        args.workers = min(os.cpu_count() or 1, 4)
+    if args.threads is None:
+        # One waitress process has to hold the streams several gunicorn workers would share
+        args.threads = 16 if server == 'waitress' else 8
+    streams = args.threads // 2 if args.streams is None else args.streams
+    if not 0 < streams < args.threads:
+        parser.error('--streams must leave at least one thread for other requests')
+    configure(args.workers, streams)
+    if server == 'gunicorn':
+        run_gunicorn(args)
+    else:
+        run_waitress(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+import datetime
+import os
+import queue
+import threading
+from contextlib import contextmanager
+
+import httplib2
+from google.auth.exceptions import RefreshError, TransportError
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import build
+from googleapiclient.http import set_user_agent
+
+import metrics
+from scheduler import ScheduledHttp, TokenBucket, USER_RATE, USER_BURST
+
+# Refresh access tokens this long before Google would reject them
+REFRESH_MARGIN = datetime.timedelta(minutes=5)
+# Idle Calendar services kept around for reuse
+POOL_SIZE = int(os.getenv('SERVICE_POOL_SIZE', '8'))
+HTTP_TIMEOUT = 30
+# Base URL of the Calendar API, e.g. http://127.0.0.1:8765/calendar/v3/ for the local fake used by
+# benchmark.py; batch requests go to /batch/calendar/v3 on the same host
+API_ENDPOINT = os.getenv('CALENDAR_API_ENDPOINT')
+
+# Errors meaning Google could not be reached at all, as opposed to rejecting a request
+OFFLINE_ERRORS = (OSError, httplib2.HttpLib2Error, TransportError)
+
+
+class ServiceManager:
+    # Owner of one user's credentials and a pool of Calendar services.
+    # Every service sends through the shared upstream scheduler, under this user's quota.
+    # Without a token_file the credentials only live in memory.
+    def __init__(self, token_file, scopes, scheduler, pool_size=POOL_SIZE):
+        self.token_file = token_file
+        self.scopes = scopes
+        self.scheduler = scheduler
+        self.quota = TokenBucket(USER_RATE, USER_BURST)
+        self.pool_size = pool_size
+        self._creds = None
+        self._saved_json = None
+        self._token_mtime = None  # Of the token file as last read or written here
+        self._lock = threading.RLock()
+        self._pool = queue.LifoQueue()
+
+    def credentials(self):
+        with self._lock, metrics.span('credentials'):
+            if self._creds is None or self._token_file_changed():
+                if self.token_file is None or not self.token_file.exists():
+                    return None
+                self._token_mtime = self.token_file.stat().st_mtime_ns
+                self._creds = Credentials.from_authorized_user_file(str(self.token_file), self.scopes)
+                self._saved_json = self._creds.to_json()
+
+            if self._needs_refresh(self._creds):
+                if not self._creds.refresh_token:
+                    return None
+                try:
+                    self._creds.refresh(Request())
+                except RefreshError:
+                    metrics.TOKEN_REFRESHES.inc('rejected')
+                    return None
+                except TransportError:
+                    # Offline: keep the old token, callers fall back to local data
+                    metrics.TOKEN_REFRESHES.inc('offline')
+                    return self._creds
+                metrics.TOKEN_REFRESHES.inc('ok')
+                self._persist(self._creds)
+            return self._creds
+
+    def store(self, creds):
+        # New credentials from the OAuth flow replace the cached ones and every pooled service
+        with self._lock:
+            self._creds = creds
+            self._persist(creds)
+            self._drain()
+
+    def _token_file_changed(self):
+        # Another worker refreshed the token or the user signed in again through it
+        if self.token_file is None:
+            return False
+        try:
+            return self.token_file.stat().st_mtime_ns != self._token_mtime
+        except FileNotFoundError:
+            return False
+
+    def _needs_refresh(self, creds):
+        if creds.expiry is None:
+            return not creds.valid
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        return creds.expiry - REFRESH_MARGIN <= now
+
+    def _persist(self, creds):
+        # Only touch the token file when the token actually changed
+        token_json = creds.to_json()
+        if self.token_file is not None and token_json != self._saved_json:
+            with open(self.token_file, 'w') as token:
+                token.write(token_json)
+            self._saved_json = token_json
+            self._token_mtime = self.token_file.stat().st_mtime_ns
+
+    def _drain(self):
+        while True:
+            try:
+                self._pool.get_nowait()
+            except queue.Empty:
+                return
+
+    def _build(self, creds):
+        # A dedicated keep-alive connection per service, since httplib2 is not thread safe
+        metrics.CACHE_LOOKUPS.inc('service_pool', 'miss')
+        http = AuthorizedHttp(creds, http=httplib2.Http(timeout=HTTP_TIMEOUT))
+        http = ScheduledHttp(http, self.scheduler, self.quota, self)
+        # httplib2 already asks for gzip; Google only compresses when the user agent says so too
+        set_user_agent(http, 'calendar-widget-backend (gzip)')
+        client_options = {'api_endpoint': API_ENDPOINT} if API_ENDPOINT else None
+        with metrics.span('build'):
+            return build('calendar', 'v3', http=http, cache_discovery=False, client_options=client_options)
+
+    @contextmanager
+    def service(self):
+        creds = self.credentials()
+        if creds is None:
+            raise NotAuthorized()
+        try:
+            service = self._pool.get_nowait()
+            if service._http.credentials is not creds:
+                service = self._build(creds)
+            else:
+                metrics.CACHE_LOOKUPS.inc('service_pool', 'hit')
+        except queue.Empty:
+            service = self._build(creds)
+        try:
+            yield service
+        finally:
+            if self._pool.qsize() < self.pool_size:
+                self._pool.put(service)
+
+
+class NotAuthorized(Exception):
+    pass
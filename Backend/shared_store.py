@@ -0,0 +1,219 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+
+# Most values the in-process store keeps, least recently used are dropped first
+MEMORY_ENTRIES = int(os.getenv('SHARED_CACHE_SIZE', '4096'))
+# Expired rows are swept from the SQLite store after this many writes
+SWEEP_EVERY = 256
+
+
+class MemoryStore:
+    # Cache tier for a single worker: plain dictionaries, nothing leaves the process
+    shared = False
+
+    def __init__(self, max_entries=MEMORY_ENTRIES):
+        self.max_entries = max_entries
+        self._values = OrderedDict()  # key -> (expires or None, value)
+        self._counters = {}
+        self._logs = {}  # key -> deque of (seq, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                return None
+            if entry[0] is not None and entry[0] < time.monotonic():
+                del self._values[key]
+                return None
+            self._values.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._set(key, value, ttl)
+
+    def _set(self, key, value, ttl):
+        self._values[key] = (time.monotonic() + ttl if ttl else None, value)
+        self._values.move_to_end(key)
+        while len(self._values) > self.max_entries:
+            self._values.popitem(last=False)
+
+    def add(self, key, value, ttl=None):
+        # Set key only if it has no live value; True if this call set it
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is not None and (entry[0] is None or entry[0] >= time.monotonic()):
+                return False
+            self._set(key, value, ttl)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+
+    def incr(self, key):
+        with self._lock:
+            value = self._counters[key] = self._counters.get(key, 0) + 1
+            return value
+
+    def counter(self, key):
+        with self._lock:
+            return self._counters.get(key, 0)
+
+    def append(self, key, value, keep):
+        # Add value to a log holding the last `keep` values; returns its sequence number
+        with self._lock:
+            seq = self._counters[key] = self._counters.get(key, 0) + 1
+            log = self._logs.get(key)
+            if log is None:
+                log = self._logs[key] = deque(maxlen=keep)
+            log.append((seq, value))
+            return seq
+
+    def since(self, key, seq):
+        # (seq, value) pairs still kept in a log, newer than seq
+        with self._lock:
+            return [(number, value) for number, value in self._logs.get(key, ()) if number > seq]
+
+
+class SQLiteStore:
+    # Cache tier in one SQLite file, shared by every worker process on the machine
+    shared = True
+
+    SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB, expires REAL);
+    CREATE TABLE IF NOT EXISTS counters (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+    CREATE TABLE IF NOT EXISTS log (key TEXT NOT NULL, seq INTEGER NOT NULL, value BLOB, PRIMARY KEY (key, seq));
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+        self._conn().executescript(self.SCHEMA)
+
+    def _conn(self):
+        # One connection per thread; autocommit, with explicit transactions where needed
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(str(self.path), timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def get(self, key):
+        row = self._conn().execute('SELECT value, expires FROM kv WHERE key = ?', (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return None
+        return row[0]
+
+    def set(self, key, value, ttl=None):
+        self._conn().execute('INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)',
+                             (key, value, time.time() + ttl if ttl else None))
+        self._wrote()
+
+    def add(self, key, value, ttl=None):
+        now = time.time()
+        cursor = self._conn().execute(
+            'INSERT INTO kv (key, value, expires) VALUES (?, ?, ?) ON CONFLICT(key) DO UPDATE SET '
+            'value = excluded.value, expires = excluded.expires WHERE kv.expires IS NOT NULL AND kv.expires < ?',
+            (key, value, now + ttl if ttl else None, now))
+        self._wrote()
+        return cursor.rowcount == 1
+
+    def delete(self, key):
+        self._conn().execute('DELETE FROM kv WHERE key = ?', (key,))
+
+    def incr(self, key):
+        return self._incr(self._conn(), key)
+
+    def _incr(self, conn, key):
+        return conn.execute('INSERT INTO counters (key, value) VALUES (?, 1) ON CONFLICT(key) DO UPDATE '
+                            'SET value = value + 1 RETURNING value', (key,)).fetchone()[0]
+
+    def counter(self, key):
+        row = self._conn().execute('SELECT value FROM counters WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else 0
+
+    def append(self, key, value, keep):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            seq = self._incr(conn, key)
+            conn.execute('INSERT INTO log (key, seq, value) VALUES (?, ?, ?)', (key, seq, value))
+            conn.execute('DELETE FROM log WHERE key = ? AND seq <= ?', (key, seq - keep))
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        return seq
+
+    def since(self, key, seq):
+        return self._conn().execute('SELECT seq, value FROM log WHERE key = ? AND seq > ? ORDER BY seq',
+                                    (key, seq)).fetchall()
+
+    def _wrote(self):
+        # Expired values are only skipped on read; clear them out now and then
+        self._writes += 1
+        if self._writes % SWEEP_EVERY == 0:
+            self._conn().execute('DELETE FROM kv WHERE expires IS NOT NULL AND expires < ?', (time.time(),))
+
+
+class RedisStore:
+    # Cache tier in Redis or any server speaking its protocol; needs the redis package
+    shared = True
+
+    def __init__(self, url):
+        import redis
+        self._redis = redis.Redis.from_url(url)
+
+    def get(self, key):
+        return self._redis.get(key)
+
+    def set(self, key, value, ttl=None):
+        self._redis.set(key, value, px=int(ttl * 1000) if ttl else None)
+
+    def add(self, key, value, ttl=None):
+        return bool(self._redis.set(key, value, px=int(ttl * 1000) if ttl else None, nx=True))
+
+    def delete(self, key):
+        self._redis.delete(key)
+
+    def incr(self, key):
+        return self._redis.incr('counter:' + key)
+
+    def counter(self, key):
+        return int(self._redis.get('counter:' + key) or 0)
+
+    def append(self, key, value, keep):
+        # Members carry their sequence number, so equal values stay distinct in the sorted set
+        seq = self.incr(key)
+        pipeline = self._redis.pipeline()
+        pipeline.zadd('log:' + key, {b'%d:' % seq + value: seq})
+        pipeline.zremrangebyscore('log:' + key, '-inf', seq - keep)
+        pipeline.execute()
+        return seq
+
+    def since(self, key, seq):
+        members = self._redis.zrangebyscore('log:' + key, f'({seq}', '+inf', withscores=True)
+        return [(int(score), member.split(b':', 1)[1]) for member, score in members]
+
+
+# The store a CACHE_BACKEND setting names: unset or 'memory' for in-process,
+# 'sqlite:///path/to/file' for a file shared by local workers, 'redis://host:port/db' for Redis
+def open_store(url):
+    if not url or url == 'memory':
+        return MemoryStore()
+    if url.startswith('sqlite:'):
+        path = url[len('sqlite:'):]
+        return SQLiteStore(path[2:] if path.startswith('//') else path)
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        try:
+            return RedisStore(url)
+        except ImportError:
+            raise RuntimeError('CACHE_BACKEND is a Redis URL but the redis package is not installed') from None
+    raise ValueError(f'Unknown CACHE_BACKEND {url!r}')
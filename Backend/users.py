@@ -0,0 +1,158 @@
+import hashlib
+import os
+import re
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from event_db import EventDatabase
+from event_store import EventStore
+from notifications import ChangeFeed, WatchChannels
+from response_cache import ResponseCache
+from scheduler import SingleFlight
+from search_index import SearchIndex
+from service_manager import ServiceManager
+from shared_store import MemoryStore
+
+# Most users whose credentials, services and events are kept in memory at once;
+# the least recently active ones are dropped and reloaded from disk when they come back
+MAX_ACTIVE_USERS = int(os.getenv('MAX_ACTIVE_USERS', '200'))
+# Key of the user of a single-user install, whose token and database live at the old paths
+LEGACY_USER = 'legacy'
+# Least seconds between rereads of the API key files when a key is not known, which
+# happens when another worker signed the user in
+RESCAN_INTERVAL = 5
+
+
+# Stable directory name for a user, so account names never end up in paths
+def user_key(user_id):
+    return hashlib.sha256(user_id.encode('utf-8')).hexdigest()[:32]
+
+USER_KEY_PATTERN = re.compile(r'[0-9a-f]{32}')
+
+
+class UserContext:
+    # Everything the backend holds for one user; nothing in here is shared with other users.
+    # What workers share about the user lives in the cache tier under the user's key.
+    def __init__(self, key, token_file, db_file, scopes, scheduler, webhook_url, webhook_token, store):
+        self.key = key
+        self.service_manager = ServiceManager(token_file, scopes, scheduler)
+        self.search_index = SearchIndex()
+        self.event_store = EventStore(EventDatabase(db_file), self.search_index, store, key)
+        self.event_store.load()
+        self.response_cache = ResponseCache(store, key)
+        self.change_feed = ChangeFeed(store, key)
+        self.refreshes = SingleFlight('refresh')
+        self.watch_channels = WatchChannels(webhook_url, webhook_token, store, key)
+
+    @property
+    def idle(self):
+        # Users with a frontend following their change feed stay loaded
+        return self.change_feed.listeners == 0
+
+
+class UserRegistry:
+    # Signed-in users by key, each stored in its own directory under users_dir:
+    # token.json, events.sqlite3 and the api_key the desktop widget authenticates with
+    def __init__(self, users_dir, scopes, scheduler, webhook_url=None, webhook_token=None,
+                 legacy_token_file=None, legacy_db_file=None, max_active=MAX_ACTIVE_USERS, store=None):
+        self.users_dir = users_dir
+        self.store = store if store is not None else MemoryStore()
+        self.scopes = scopes
+        self.scheduler = scheduler
+        self.webhook_url = webhook_url
+        self.webhook_token = webhook_token
+        self.legacy_token_file = legacy_token_file
+        self.legacy_db_file = legacy_db_file
+        self.max_active = max_active
+        self._active = OrderedDict()  # key -> UserContext, least recently used first
+        self._legacy = None
+        self._api_keys = {}  # API key -> user key
+        self._scanned = 0
+        self._lock = threading.RLock()
+        self.users_dir.mkdir(parents=True, exist_ok=True)
+        self._scan_api_keys()
+
+    def _scan_api_keys(self):
+        for key_file in self.users_dir.glob('*/api_key'):
+            self._api_keys[key_file.read_text().strip()] = key_file.parent.name
+        self._scanned = time.monotonic()
+
+    def get(self, key):
+        # The user's context, loaded from disk if it was evicted or never loaded since startup
+        with self._lock:
+            user = self._active.get(key)
+            if user is not None:
+                self._active.move_to_end(key)
+                return user
+            # Keys also arrive in webhook tokens, never let one point outside users_dir
+            if not USER_KEY_PATTERN.fullmatch(key):
+                return None
+            directory = self.users_dir / key
+            if not (directory / 'token.json').exists():
+                return None
+            user = self._active[key] = self._load(key, directory)
+            self._evict()
+            return user
+
+    @property
+    def active_count(self):
+        with self._lock:
+            return len(self._active) + (self._legacy is not None)
+
+    def legacy(self):
+        # The single user of a pre-multi-user install, for requests that carry no identity
+        with self._lock:
+            if self._legacy is None and self.legacy_token_file and self.legacy_token_file.exists():
+                self._legacy = UserContext(LEGACY_USER, self.legacy_token_file, self.legacy_db_file, self.scopes,
+                                           self.scheduler, self.webhook_url, self.webhook_token, self.store)
+            return self._legacy
+
+    def for_api_key(self, api_key):
+        with self._lock:
+            key = self._api_keys.get(api_key)
+            if key is None and time.monotonic() - self._scanned >= RESCAN_INTERVAL:
+                self._scan_api_keys()
+                key = self._api_keys.get(api_key)
+        return self.get(key) if key else None
+
+    def sign_in(self, user_id, creds):
+        # Store fresh OAuth credentials for a user, creating the user on first sign-in
+        key = user_key(user_id)
+        directory = self.users_dir / key
+        directory.mkdir(exist_ok=True)
+        with self._lock:
+            user = self._active.get(key)
+            if user is None:
+                user = self._active[key] = self._load(key, directory)
+                self._evict()
+            user.service_manager.store(creds)
+            self.api_key(key)
+        return user
+
+    def api_key(self, key):
+        # The user's widget API key, issued the first time it is asked for
+        key_file = self.users_dir / key / 'api_key'
+        with self._lock:
+            if not key_file.exists():
+                api_key = secrets.token_urlsafe(32)
+                key_file.write_text(api_key)
+                self._api_keys[api_key] = key
+            return key_file.read_text().strip()
+
+    def _load(self, key, directory):
+        # Watch channels carry the user's key in their token, so the webhook knows whose calendar changed
+        token = f'{self.webhook_token}:{key}' if self.webhook_token else None
+        return UserContext(key, directory / 'token.json', directory / 'events.sqlite3', self.scopes,
+                           self.scheduler, self.webhook_url, token, self.store)
+
+    def _evict(self):
+        # Drop the least recently used idle users beyond max_active; their data stays on disk
+        excess = len(self._active) - self.max_active
+        for key in list(self._active):
+            if excess <= 0:
+                return
+            if self._active[key].idle:
+                del self._active[key]
+                excess -= 1
@@ -0,0 +1,52 @@
+# Local stand-in for Google's push notification sender.
+# Posts the same headers Google sends to the backend's /notifications webhook, so push
+# updates can be exercised without a public HTTPS address, e.g.:
+#   python webhook_standin.py --calendar primary@example.com --count 3 --interval 5
+import argparse
+import os
+import time
+import uuid
+from urllib.parse import quote
+
+import requests
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def send(backend, token, calendar_id, channel_id, state, message_number):
+    headers = {
+        'X-Goog-Channel-ID': channel_id,
+        'X-Goog-Channel-Token': token,
+        'X-Goog-Message-Number': str(message_number),
+        'X-Goog-Resource-ID': 'standin-' + calendar_id,
+        'X-Goog-Resource-State': state,
+        'X-Goog-Resource-URI': f'https://www.googleapis.com/calendar/v3/calendars/{quote(calendar_id)}/events?alt=json',
+    }
+    response = requests.post(f'{backend}/notifications', headers=headers, timeout=10)
+    print(f'{state} notification for {calendar_id}: HTTP {response.status_code}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Send Calendar-style webhook notifications to the backend')
+    parser.add_argument('--backend', default='http://localhost:9876')
+    parser.add_argument('--calendar', required=True, help='calendar ID the notification is about')
+    parser.add_argument('--channel', default=None, help='channel ID, defaults to a random one')
+    parser.add_argument('--token', default=os.getenv('WEBHOOK_TOKEN'))
+    parser.add_argument('--state', default='exists', choices=['sync', 'exists', 'not_exists'])
+    parser.add_argument('--count', type=int, default=1)
+    parser.add_argument('--interval', type=float, default=1.0)
+    args = parser.parse_args()
+
+    if not args.token:
+        parser.error('--token or WEBHOOK_TOKEN is required')
+
+    channel_id = args.channel or str(uuid.uuid4())
+    for message_number in range(1, args.count + 1):
+        send(args.backend, args.token, args.calendar, channel_id, args.state, message_number)
+        if message_number < args.count:
+            time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    main()
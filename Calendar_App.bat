@@ -1,4 +1,4 @@
 @echo off
-start "" pythonw "A:\Calendar App\Backend\app.py"
+start "" pythonw "A:\Calendar App\Backend\serve.py"
 start "" pythonw "A:\Calendar App\frontend.py"
 exit
@@ -1,13 +1,328 @@
+import os
 import sys
+import json
+import time
+import difflib
+import sqlite3
+import threading
+import zlib
 import requests
-from datetime import datetime
+from datetime import datetime, date, timedelta
 import signal
 from PyQt6.QtWidgets import (QApplication, QWidget, QVBoxLayout, QHBoxLayout, 
                             QPushButton, QLabel, QLineEdit, QCalendarWidget,
-                            QTimeEdit, QScrollArea, QFrame, QDialog, QTextEdit,
-                            QFileDialog, QGroupBox, QToolButton)
-from PyQt6.QtCore import Qt, QTime, QTimer, QDate, QRect,QEvent
-from PyQt6.QtGui import QColor,QBrush
+                            QTimeEdit, QDialog, QTextEdit, QListView,
+                            QFileDialog, QGroupBox, QToolButton, QStyledItemDelegate, QMessageBox)
+from PyQt6.QtCore import (Qt, QTime, QTimer, QDate, QRect,QEvent, QThread, pyqtSignal,
+                          QObject, QRunnable, QThreadPool, QAbstractListModel,
+                          QModelIndex, QSize, QStandardPaths)
+from PyQt6.QtGui import QColor,QBrush, QPalette
+
+# Months loaded on either side of the visible one, so paging feels instant
+PREFETCH_MONTHS = 1
+
+def add_months(year, month, delta):
+    index = year * 12 + (month - 1) + delta
+    return index // 12, index % 12 + 1
+
+# Pause in typing after which the search box queries the backend
+SEARCH_DEBOUNCE_MS = 250
+# Search results shown at once
+SEARCH_LIMIT = 50
+
+# Connect and read timeouts for backend calls, so a hung backend never stalls a refresh for long
+REQUEST_TIMEOUT = (3.05, 20)
+# Identifies this widget's user to a shared backend; shown at /account after signing in
+API_KEY = os.getenv('CALENDAR_API_KEY')
+AUTH_HEADERS = {'X-Api-Key': API_KEY} if API_KEY else {}
+
+_sessions = threading.local()
+
+# One keep-alive session per pool thread, requests.Session is not safe to share between threads
+def thread_session():
+    session = getattr(_sessions, 'session', None)
+    if session is None:
+        session = _sessions.session = requests.Session()
+        session.headers.update(AUTH_HEADERS)
+    return session
+
+class EventCache:
+    # On-disk copy of fetched events, so the widget paints before (or without) the backend
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS events (
+                calendar_id TEXT NOT NULL,
+                event_id TEXT NOT NULL,
+                day INTEGER NOT NULL,
+                start TEXT NOT NULL,
+                body TEXT NOT NULL,
+                PRIMARY KEY (calendar_id, event_id)
+            );
+            CREATE INDEX IF NOT EXISTS events_by_day ON events (day);
+            CREATE INDEX IF NOT EXISTS events_by_calendar ON events (calendar_id, start);
+        ''')
+
+    @staticmethod
+    def default_path():
+        path = os.getenv('CALENDAR_CACHE_FILE')
+        if path:
+            return path
+        directory = QStandardPaths.writableLocation(QStandardPaths.StandardLocation.AppDataLocation)
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, 'events.sqlite3')
+
+    def load(self, first_day, end_day):
+        rows = self.db.execute('SELECT body FROM events WHERE day >= ? AND day < ? ORDER BY start',
+                               (first_day.toordinal(), end_day.toordinal())).fetchall()
+        return [json.loads(body) for body, in rows]
+
+    def replace(self, first_day, end_day, events, calendar_id=None):
+        # Swap in a fresh copy of [first_day, end_day), optionally for a single calendar
+        query = 'DELETE FROM events WHERE day >= ? AND day < ?'
+        params = [first_day.toordinal(), end_day.toordinal()]
+        if calendar_id is not None:
+            query += ' AND calendar_id = ?'
+            params.append(calendar_id)
+        rows = []
+        for event in events:
+            try:
+                rows.append((event['calendarId'], event['eventId'], EventItem(event).day.toordinal(),
+                             event['start'], json.dumps(event)))
+            except (KeyError, ValueError):
+                continue
+        with self.db:
+            self.db.execute(query, params)
+            self.db.executemany('INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?, ?)', rows)
+
+class EventItem:
+    # Compact event built once from the backend's pre-parsed wire fields
+    __slots__ = ('data', 'calendar_id', 'event_id', 'summary', 'start_ts', 'end_ts',
+                 'all_day', 'day', 'time_text')
+
+    def __init__(self, data):
+        self.data = data
+        self.calendar_id = data.get('calendarId')
+        self.event_id = data.get('eventId')
+        self.summary = data.get('summary', 'No Title')
+        self.all_day = data.get('allDay', False)
+        if 'day' in data:
+            self.start_ts = data['startTs']
+            self.end_ts = data['endTs']
+            self.day = date.fromordinal(data['day'])
+        else:
+            # Rows cached before the backend sent pre-parsed fields
+            start = datetime.fromisoformat(data['start'].replace('Z', '+00:00'))
+            self.start_ts = start.timestamp()
+            self.end_ts = datetime.fromisoformat(data['end'].replace('Z', '+00:00')).timestamp()
+            self.day = start.date()
+        if self.all_day:
+            self.time_text = "All day"
+        else:
+            # start/end arrive as 'YYYY-MM-DD HH:MM:SS' in the display timezone
+            self.time_text = f"{data['start'][11:16]} - {data['end'][11:16]}"
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def __eq__(self, other):
+        return isinstance(other, EventItem) and self.data == other.data
+
+class ApiResponse:
+    __slots__ = ('status_code', 'headers', 'data')
+
+    def __init__(self, status_code, headers, data):
+        self.status_code = status_code
+        self.headers = headers
+        self.data = data
+
+class RequestSignals(QObject):
+    finished = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+class RequestTask(QRunnable):
+    # Runs one backend call on the thread pool and decodes the JSON body off the GUI thread
+    def __init__(self, method, url, kwargs):
+        super().__init__()
+        self.method = method
+        self.url = url
+        self.kwargs = kwargs
+        self.signals = RequestSignals()
+
+    def run(self):
+        try:
+            response = thread_session().request(self.method, self.url, timeout=REQUEST_TIMEOUT, **self.kwargs)
+            data = response.json() if response.content and response.status_code != 304 else None
+            self.signals.finished.emit(ApiResponse(response.status_code, response.headers, data))
+        except (requests.exceptions.RequestException, ValueError) as e:
+            self.signals.failed.emit(str(e))
+
+class StreamSignals(QObject):
+    chunk = pyqtSignal(list)
+    finished = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+class StreamTask(QRunnable):
+    # Reads a newline-delimited JSON response, handing decoded objects to the GUI thread in chunks
+    CHUNK_SIZE = 200
+    CHUNK_INTERVAL = 0.1  # Seconds between chunks while lines trickle in
+
+    def __init__(self, url, kwargs):
+        super().__init__()
+        self.url = url
+        self.kwargs = kwargs
+        self.signals = StreamSignals()
+
+    def run(self):
+        try:
+            headers = dict(self.kwargs.pop('headers', None) or {}, Accept='application/x-ndjson')
+            with thread_session().get(self.url, headers=headers, stream=True,
+                                      timeout=REQUEST_TIMEOUT, **self.kwargs) as response:
+                if response.headers.get('Content-Type', '').startswith('application/x-ndjson'):
+                    chunk = []
+                    sent = time.monotonic()
+                    for line in response.iter_lines():
+                        if not line:
+                            continue
+                        item = json.loads(line)
+                        if 'error' in item:
+                            raise ValueError(item['error'])
+                        chunk.append(item)
+                        if len(chunk) >= self.CHUNK_SIZE or time.monotonic() - sent >= self.CHUNK_INTERVAL:
+                            self.signals.chunk.emit(chunk)
+                            chunk = []
+                            sent = time.monotonic()
+                    if chunk:
+                        self.signals.chunk.emit(chunk)
+                    data = None
+                else:
+                    # Plain JSON, e.g. an error from before the stream started
+                    data = response.json() if response.content else None
+                self.signals.finished.emit(ApiResponse(response.status_code, response.headers, data))
+        except (requests.exceptions.RequestException, ValueError) as e:
+            self.signals.failed.emit(str(e))
+
+class ApiClient(QObject):
+    # Asynchronous access to the backend; callbacks always run on the GUI thread
+    def __init__(self, base_url, parent=None):
+        super().__init__(parent)
+        self.base_url = base_url
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(4)
+        self._latest = {}  # key -> number of the newest request made under that key
+        self._in_flight = set()
+
+    def request(self, method, path, on_success, on_error=None, key=None, **kwargs):
+        self._start(RequestTask(method, f"{self.base_url}{path}", kwargs), on_success, on_error, key)
+
+    def stream(self, path, on_chunk, on_success, on_error=None, key=None, **kwargs):
+        # Like request(), but for NDJSON bodies: on_chunk gets each batch of objects as it arrives
+        task = StreamTask(f"{self.base_url}{path}", kwargs)
+        self._start(task, on_success, on_error, key, on_chunk)
+
+    def _start(self, task, on_success, on_error, key, on_chunk=None):
+        # A newer request with the same key makes older ones stale; their results are dropped
+        number = None
+        if key is not None:
+            number = self._latest[key] = self._latest.get(key, 0) + 1
+        task.setAutoDelete(False)
+        self._in_flight.add(task)
+
+        def is_current():
+            self._in_flight.discard(task)
+            return key is None or self._latest.get(key) == number
+
+        def finished(response):
+            if is_current():
+                on_success(response)
+
+        def failed(error):
+            if is_current() and on_error:
+                on_error(error)
+
+        def chunk(items):
+            if key is None or self._latest.get(key) == number:
+                on_chunk(items)
+
+        task.signals.finished.connect(finished)
+        task.signals.failed.connect(failed)
+        if on_chunk is not None:
+            task.signals.chunk.connect(chunk)
+        self.pool.start(task)
+
+class ChangeListener(QThread):
+    # Follows the backend's /changes Server-Sent Events stream on a background thread
+    change_received = pyqtSignal(dict)
+    connection_changed = pyqtSignal(bool)
+
+    def __init__(self, api_url, parent=None):
+        super().__init__(parent)
+        self.api_url = api_url
+        self._running = True
+        self._response = None
+
+    def run(self):
+        last_id = None
+        delay = 1
+        retry = None  # Milliseconds the backend asked us to wait after a stream it ended
+        connected = False
+        while self._running:
+            headers = dict(AUTH_HEADERS, Accept='text/event-stream')
+            if last_id:
+                headers['Last-Event-ID'] = last_id
+            ended = False
+            try:
+                # The backend sends a keep-alive every 15 s, so a silent minute means the stream is dead
+                self._response = requests.get(f"{self.api_url}/changes", headers=headers,
+                                              stream=True, timeout=(5, 60))
+                with self._response as response:
+                    if response.status_code == 200:
+                        # Event IDs are '<epoch>-<seq>'; a restarted backend numbers from a new epoch,
+                        # so an ID from the old one is dropped instead of resumed from again
+                        epoch = response.headers.get('X-Feed-Epoch')
+                        if last_id and epoch and not last_id.startswith(epoch + '-'):
+                            last_id = None
+                        if not connected:
+                            connected = True
+                            self.connection_changed.emit(True)
+                        delay = 1
+                        data = []
+                        for line in response.iter_lines(decode_unicode=True):
+                            if line.startswith('id:'):
+                                last_id = line[3:].strip()
+                            elif line.startswith('retry:') and line[6:].strip().isdigit():
+                                retry = int(line[6:].strip())
+                            elif line.startswith('data:'):
+                                data.append(line[5:].strip())
+                            elif not line and data:
+                                self.change_received.emit(json.loads('\n'.join(data)))
+                                data = []
+                        ended = retry is not None
+            except (requests.exceptions.RequestException, ValueError, AttributeError):
+                pass  # Closed by stop() or the backend went away
+            if not self._running:
+                return
+            if ended:
+                # A busy backend sends what is pending and closes; ask again when it said to
+                for _ in range(max(retry // 100, 1)):
+                    if not self._running:
+                        return
+                    self.msleep(100)
+                continue
+            connected = False
+            self.connection_changed.emit(False)
+            # Back off before reconnecting, waking up early if we are stopped
+            for _ in range(delay * 10):
+                if not self._running:
+                    return
+                self.msleep(100)
+            delay = min(delay * 2, 60)
+
+    def stop(self):
+        self._running = False
+        if self._response is not None:
+            self._response.close()
+        self.wait(2000)
 
 class EventDialog(QDialog):
     def __init__(self, parent=None):
@@ -127,9 +442,84 @@ class EventDialog(QDialog):
             'timeZone': 'Asia/Kolkata'
         }
 
+# Dot colors for calendars on the month grid; a calendar keeps its color across runs
+CALENDAR_COLORS = ('#3498DB', '#E74C3C', '#2ECC71', '#F1C40F', '#9B59B6', '#1ABC9C', '#E67E22', '#EC87C0')
+# Most calendar dots drawn in one day cell, busiest calendars first
+MAX_DOTS = 3
+# Day cells are shaded one step darker per this many busy minutes, up to the last step
+BUSY_MINUTES_PER_LEVEL = 120
+HEAT_ALPHAS = (0, 35, 60, 85, 110)
+
+def calendar_color(calendar_id):
+    return CALENDAR_COLORS[zlib.crc32((calendar_id or '').encode('utf-8')) % len(CALENDAR_COLORS)]
+
+class MonthMarkers:
+    # What the month grid draws for each day of the shown page, worked out once per page and
+    # per change to the events. Slots are indexed by Julian day minus base_jd, so paintCell
+    # needs one subtraction and a few list reads per cell.
+    # The grid shows at most 7 days before the 1st and 42 days in all
+    SLOTS = 49
+
+    _colors = {}  # Hex color -> QColor, shared by every page
+    _heat = [None] + [QColor(231, 76, 60, alpha) for alpha in HEAT_ALPHAS[1:]]
+
+    def __init__(self, year, month, events_by_date):
+        first = date(year, month, 1)
+        self.base_jd = QDate(year, month, 1).toJulianDay() - 7
+        base_ordinal = first.toordinal() - 7
+        self.counts = [0] * self.SLOTS
+        self.busy = [0] * self.SLOTS  # Minutes of timed events starting that day, capped at a day
+        self.dots = [()] * self.SLOTS  # QColors, one per calendar with events that day
+        self.shades = [None] * self.SLOTS  # QColor washed over the cell, by busy minutes
+        self.labels = [None] * self.SLOTS  # Event count as text, when there is more than one
+        for slot in range(self.SLOTS):
+            items = events_by_date.get(date.fromordinal(base_ordinal + slot))
+            if not items:
+                continue
+            per_calendar = {}
+            busy = 0
+            for item in items:
+                per_calendar[item.calendar_id] = per_calendar.get(item.calendar_id, 0) + 1
+                if not item.all_day:
+                    busy += max(0, item.end_ts - item.start_ts)
+            busy = min(int(busy // 60), 24 * 60)
+            self.counts[slot] = len(items)
+            self.busy[slot] = busy
+            ranked = sorted(per_calendar, key=lambda calendar_id: -per_calendar[calendar_id])
+            self.dots[slot] = tuple(self.color(calendar_color(calendar_id)) for calendar_id in ranked[:MAX_DOTS])
+            self.shades[slot] = self._heat[min(-(-busy // BUSY_MINUTES_PER_LEVEL), len(self._heat) - 1)]
+            if len(items) > 1:
+                self.labels[slot] = str(len(items))
+
+    @classmethod
+    def color(cls, name):
+        color = cls._colors.get(name)
+        if color is None:
+            color = cls._colors[name] = QColor(name)
+        return color
+
 class CustomCalendarWidget(QCalendarWidget):
+    DOT_SIZE = 5
+    DOT_GAP = 2
+
     def __init__(self, parent=None):
         super().__init__(parent)
+        self.events_by_date = {}
+        self.markers = MonthMarkers(self.yearShown(), self.monthShown(), self.events_by_date)
+        self.count_font = self.font()
+        self.count_font.setPointSizeF(max(self.count_font.pointSizeF() * 0.7, 6))
+        self.count_pen = QColor('#ECF0F1')
+        # Connected before anyone else, so the markers match the page before it repaints
+        self.currentPageChanged.connect(self.rebuild_markers)
+
+    def set_events(self, events_by_date):
+        # Call whenever the events change; rebuilds the shown page's markers and repaints
+        self.events_by_date = events_by_date
+        self.rebuild_markers(self.yearShown(), self.monthShown())
+        self.updateCells()
+
+    def rebuild_markers(self, year, month):
+        self.markers = MonthMarkers(year, month, self.events_by_date)
 
     def paintCell(self, painter, rect, date):
         super().paintCell(painter, rect, date)  # Call the base class method to draw the cell
@@ -139,23 +529,136 @@ class CustomCalendarWidget(QCalendarWidget):
                 painter.setBrush(QBrush())  # Set the background color to yellow
                 painter.setPen(QColor('orange'))  # No outline for the cell
                 painter.drawRect(rect)  # Draw a filled rectangle to highlight the cell
-                
-             # Use the same color for all events
-        if date.toPyDate() in self.parent().events_by_date:
-            painter.setBrush(QColor('#3498DB'))  # Blue color for events
-            painter.setPen(Qt.PenStyle.NoPen)  # No outline for the marker
-            marker_size = 6
-            x = int(rect.center().x() - marker_size / 2)
-            y = int(rect.bottom() - marker_size - 2)
-            width = int(marker_size)
-            height = int(marker_size)
-            painter.drawEllipse(x, y, width, height)  # Draw the event marker
+
+        markers = self.markers
+        slot = date.toJulianDay() - markers.base_jd
+        if not 0 <= slot < MonthMarkers.SLOTS or not markers.counts[slot]:
+            return
+        painter.save()
+        shade = markers.shades[slot]
+        if shade is not None:
+            painter.fillRect(rect, shade)
+
+        # One dot per calendar, centred along the bottom of the cell
+        dots = markers.dots[slot]
+        size = self.DOT_SIZE
+        x = rect.x() + (rect.width() - len(dots) * (size + self.DOT_GAP) + self.DOT_GAP) // 2
+        y = rect.bottom() - size - 2
+        painter.setPen(Qt.PenStyle.NoPen)
+        for color in dots:
+            painter.setBrush(color)
+            painter.drawEllipse(x, y, size, size)
+            x += size + self.DOT_GAP
+
+        label = markers.labels[slot]
+        if label is not None:
+            painter.setFont(self.count_font)
+            painter.setPen(self.count_pen)
+            painter.drawText(rect.x(), rect.y() + 1, rect.width() - 3, rect.height() - 1,
+                             Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignTop, label)
+        painter.restore()
+
+# Text lines shown for one event in the events list
+def event_lines(event):
+    return (f"Title: {event.summary}",
+            f"Time: {event.time_text}",
+            f"Location: {event.get('location', 'N/A')}",
+            f"Notes: {event.get('notes', 'N/A')}")
+
+def event_key(event):
+    return event.calendar_id, event.event_id
+
+class EventListModel(QAbstractListModel):
+    # Events of the selected date; updates are diffed into row inserts, removals and changes
+    EventRole = Qt.ItemDataRole.UserRole
+    LinesRole = Qt.ItemDataRole.UserRole + 1
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._events = []
+        self._lines = []  # Formatted text per row, filled in the first time a row is painted
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._events)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        row = index.row()
+        if role == self.LinesRole:
+            if self._lines[row] is None:
+                self._lines[row] = event_lines(self._events[row])
+            return self._lines[row]
+        if role == self.EventRole:
+            return self._events[row]
+        if role == Qt.ItemDataRole.DisplayRole:
+            return self._events[row].get('summary')
+        return None
+
+    def set_events(self, events):
+        old_keys = [event_key(event) for event in self._events]
+        new_keys = [event_key(event) for event in events]
+        if old_keys == new_keys and all(a is b for a, b in zip(self._events, events)):
+            return
+
+        # Apply the edit script back to front so earlier row numbers stay valid
+        opcodes = difflib.SequenceMatcher(None, old_keys, new_keys, autojunk=False).get_opcodes()
+        for tag, i1, i2, j1, j2 in reversed(opcodes):
+            if tag == 'equal':
+                changed = [offset for offset in range(i2 - i1) if self._events[i1 + offset] != events[j1 + offset]]
+                for offset in range(i2 - i1):
+                    self._events[i1 + offset] = events[j1 + offset]
+                for offset in changed:
+                    self._lines[i1 + offset] = None
+                    index = self.index(i1 + offset)
+                    self.dataChanged.emit(index, index)
+                continue
+            if tag in ('replace', 'delete'):
+                self.beginRemoveRows(QModelIndex(), i1, i2 - 1)
+                del self._events[i1:i2]
+                del self._lines[i1:i2]
+                self.endRemoveRows()
+            if tag in ('replace', 'insert'):
+                self.beginInsertRows(QModelIndex(), i1, i1 + (j2 - j1) - 1)
+                self._events[i1:i1] = events[j1:j2]
+                self._lines[i1:i1] = [None] * (j2 - j1)
+                self.endInsertRows()
+
+class EventDelegate(QStyledItemDelegate):
+    # Paints an event card straight onto the list view, no per-event widgets
+    MARGIN = 5
+    PADDING = 6
+
+    def sizeHint(self, option, index):
+        line_height = option.fontMetrics.lineSpacing()
+        return QSize(option.rect.width(), 4 * line_height + 2 * (self.MARGIN + self.PADDING))
+
+    def paint(self, painter, option, index):
+        lines = index.data(EventListModel.LinesRole)
+        painter.save()
+        card = option.rect.adjusted(self.MARGIN, self.MARGIN, -self.MARGIN, -self.MARGIN)
+        painter.setPen(Qt.PenStyle.NoPen)
+        painter.setBrush(QColor('#2C3E50'))
+        painter.drawRoundedRect(card, 5, 5)
+
+        painter.setPen(option.palette.color(QPalette.ColorRole.WindowText))
+        line_height = option.fontMetrics.lineSpacing()
+        text_rect = card.adjusted(self.PADDING, self.PADDING, -self.PADDING, -self.PADDING)
+        for number, line in enumerate(lines):
+            line_rect = QRect(text_rect.x(), text_rect.y() + number * line_height, text_rect.width(), line_height)
+            text = option.fontMetrics.elidedText(line, Qt.TextElideMode.ElideRight, line_rect.width())
+            painter.drawText(line_rect, Qt.AlignmentFlag.AlignLeft | Qt.AlignmentFlag.AlignVCenter, text)
+        painter.restore()
 
 class CalendarWidget(QWidget):
     def __init__(self):
         super().__init__()
         self.API_URL = "http://localhost:9876"
+        self.api = ApiClient(self.API_URL, self)
         self.events_by_date = {}  # Store events by date
+        self.loaded_range = None  # (timeMin, timeMax) covered by events_by_date
+        self.events_etag = None  # ETag of the response behind loaded_range
+        self.cache = EventCache(EventCache.default_path())
         self.initUI()
         self.set_window_properties()
         
@@ -185,9 +688,21 @@ class CalendarWidget(QWidget):
         self.setAttribute(Qt.WidgetAttribute.WA_TranslucentBackground)
         self.setAttribute(Qt.WidgetAttribute.WA_NoSystemBackground)
         
+        # Search box; a query goes out once typing pauses, clicking a date goes back to that date
+        self.search_input = QLineEdit()
+        self.search_input.setPlaceholderText("Search events")
+        self.search_input.setClearButtonEnabled(True)
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(SEARCH_DEBOUNCE_MS)
+        self.search_timer.timeout.connect(self.search_events)
+        self.search_input.textChanged.connect(self.search_timer.start)
+
         self.calendar = CustomCalendarWidget(self)
         self.calendar.selectionChanged.connect(self.update_events_list)
+        self.calendar.clicked.connect(self.search_input.clear)
         self.calendar.clicked.connect(self.update_events_list)
+        self.calendar.currentPageChanged.connect(self.on_page_changed)
         
         self.calendar.setStyleSheet("""
             QCalendarWidget {
@@ -212,8 +727,8 @@ class CalendarWidget(QWidget):
         add_btn = QPushButton("Add Event")
         add_btn.clicked.connect(self.show_event_dialog)
         
-        events_label = QLabel("Events for Selected Date")
-        events_label.setStyleSheet("font-weight: bold; margin-top: 10px;")
+        self.events_label = QLabel("Events for Selected Date")
+        self.events_label.setStyleSheet("font-weight: bold; margin-top: 10px;")
         
         # Create a layout for event details
         self.event_details_group = QGroupBox("Event Details")
@@ -227,33 +742,64 @@ class CalendarWidget(QWidget):
         self.toggle_button.clicked.connect(self.toggle_event_details)
         
         # Scroll area for events
-        self.events_layout = QVBoxLayout()
-        scroll = QScrollArea()
-        scroll.setWidgetResizable(True)
-        
-        scroll_content = QWidget()
-        scroll_content.setLayout(self.events_layout)  # Set the layout directly here
-        self.events_layout.setSpacing(2)  # Decrease spacing between event widgets
-        self.events_layout.setContentsMargins(0, 0, 0, 0)  # Remove margins
-
-        scroll.setWidget(scroll_content)
+        # Only the visible rows are painted, by the delegate, straight from the model
+        self.events_model = EventListModel(self)
+        self.events_view = QListView()
+        self.events_view.setModel(self.events_model)
+        self.events_view.setItemDelegate(EventDelegate(self.events_view))
+        self.events_view.setUniformItemSizes(True)
+        self.events_view.setSelectionMode(QListView.SelectionMode.NoSelection)
+        self.events_view.setVerticalScrollMode(QListView.ScrollMode.ScrollPerPixel)
+        self.events_view.setSpacing(1)
         
         container_layout = QVBoxLayout()
         container_layout.addWidget(self.calendar)
         container_layout.addWidget(today_btn)  # Add the "Go to Today" button
         container_layout.addWidget(self.toggle_button)
         container_layout.addWidget(add_btn)
-        container_layout.addWidget(events_label)
-        container_layout.addWidget(scroll)
+        container_layout.addWidget(self.search_input)
+        container_layout.addWidget(self.events_label)
+        container_layout.addWidget(self.events_view)
         container_layout.addWidget(self.event_details_group)  
         
         self.setLayout(container_layout)
         
+        # Poll every minute only while the push channel is down
         self.refresh_timer = QTimer()
         self.refresh_timer.timeout.connect(self.fetch_events)
-        self.refresh_timer.start(60000)  # Refresh every minute
+        self.refresh_timer.start(60000)
+
+        self.change_listener = ChangeListener(self.API_URL, self)
+        self.change_listener.change_received.connect(self.on_change)
+        self.change_listener.connection_changed.connect(self.on_push_connection)
+        self.change_listener.start()
         
         self.fetch_events()
+
+    def closeEvent(self, event):
+        self.change_listener.stop()
+        super().closeEvent(event)
+
+    def on_push_connection(self, connected):
+        if connected:
+            self.refresh_timer.stop()
+            self.fetch_events()  # Catch up on anything missed while disconnected
+        elif not self.refresh_timer.isActive():
+            self.refresh_timer.start(60000)
+
+    def on_change(self, change):
+        if not self.loaded_range:
+            return
+        # Ignore changes that only touch dates outside the loaded window
+        if 'timeMin' in change:
+            change_min = datetime.fromisoformat(change['timeMin'])
+            change_max = datetime.fromisoformat(change['timeMax'])
+            if change_max < self.loaded_range[0] or change_min >= self.loaded_range[1]:
+                return
+        if change.get('calendarId'):
+            self.refresh_calendar(change['calendarId'])
+        else:
+            self.fetch_events()
         
     def jump_to_today(self):
         today = QDate.currentDate()
@@ -265,11 +811,11 @@ class CalendarWidget(QWidget):
         if self.event_details_group.isVisible():
             self.event_details_group.hide()
             self.toggle_button.setText("Expand")
-            self.events_layout.parentWidget().setFixedHeight(self.height() - 150)
+            self.events_view.setFixedHeight(self.height() - 150)
         else:
             self.event_details_group.show()
             self.toggle_button.setText("Collapse")
-            self.events_layout.parentWidget().setFixedHeight(self.height() - 300)
+            self.events_view.setFixedHeight(self.height() - 300)
 
     def show_event_dialog(self):
         dialog = EventDialog(self)
@@ -278,91 +824,191 @@ class CalendarWidget(QWidget):
             self.add_event(event_data)
     
     def add_event(self, event_data):
-        try:
-            response = requests.post(f"{self.API_URL}/add_event", json=event_data)
+        def added(response):
             if response.status_code == 201:
                 self.fetch_events()
-        except requests.exceptions.RequestException as e:
-            print(f"Error adding event: {e}")
+                conflicts = response.data.get('conflicts', [])
+                if conflicts:
+                    # The event was still added; let the user see what it clashes with
+                    lines = [f"{conflict['summary']} ({conflict['start']} - {conflict['end']})" for conflict in conflicts]
+                    QMessageBox.warning(self, "Overlapping events",
+                                        "The new event overlaps:\n" + "\n".join(lines))
+
+        self.api.request('POST', '/add_event', added,
+                         lambda error: print(f"Error adding event: {error}"),
+                         json=event_data)
     
-    def fetch_events(self):
-        try:
-            response = requests.get(f"{self.API_URL}/events")
+    def shown_range(self, year, month):
+        # Every day a month's page can show, as local-time bounds: its grid starts at most a
+        # week before the 1st and spans MonthMarkers.SLOTS days from there
+        first = datetime(year, month, 1) - timedelta(days=7)
+        return first.astimezone(), (first + timedelta(days=MonthMarkers.SLOTS)).astimezone()
+
+    def visible_range(self, year, month):
+        # The shown page plus the prefetched pages around it, grids included
+        return (self.shown_range(*add_months(year, month, -PREFETCH_MONTHS))[0],
+                self.shown_range(*add_months(year, month, PREFETCH_MONTHS))[1])
+
+    def on_page_changed(self, year, month):
+        shown_min, shown_max = self.shown_range(year, month)
+        if self.loaded_range and self.loaded_range[0] <= shown_min and shown_max <= self.loaded_range[1]:
+            # Prefetched: paint from memory, then move the loaded window along without clearing it
+            self.update_calendar()
+            self.fetch_events(stream=False)
+            return
+        self.fetch_events()
+
+    # A window other than the loaded one is streamed in over what was saved for it, unless
+    # stream is False, which keeps what is shown until the whole new window has arrived
+    def fetch_events(self, stream=True):
+        time_min, time_max = self.visible_range(self.calendar.yearShown(), self.calendar.monthShown())
+        params = {
+            'timeMin': time_min.isoformat(),
+            'timeMax': time_max.isoformat(),
+        }
+        same_range = self.loaded_range == (time_min, time_max)
+        if stream and not same_range:
+            self.stream_events(time_min, time_max, params)
+            return
+
+        headers = {}
+        if self.events_etag and same_range:
+            headers['If-None-Match'] = self.events_etag
+
+        def loaded(response):
+            if response.status_code == 304:
+                return  # Nothing changed since the last refresh
             if response.status_code == 200:
-                events = response.json()
-                self.organize_events_by_date(events)
+                self.loaded_range = (time_min, time_max)
+                self.events_etag = response.headers.get('ETag')
+                self.organize_events_by_date(response.data)
+                self.cache.replace(time_min.date(), time_max.date(), response.data)
                 self.update_calendar()
                 self.update_events_list()
-        except requests.exceptions.RequestException as e:
-            print(f"Error fetching events: {e}")
+
+        # Superseding the 'events' key drops any refresh still in flight for an older page
+        self.api.request('GET', '/events', loaded,
+                         lambda error: print(f"Error fetching events: {error}"),
+                         key='events', headers=headers, params=params)
+
+    def stream_events(self, time_min, time_max, params):
+        # A window we have not loaded yet: paint what was saved for it, then fold in
+        # each chunk of the backend's stream as it lands, calendar by calendar
+        self.organize_events_by_date(self.cache.load(time_min.date(), time_max.date()))
+        self.update_calendar()
+        self.update_events_list()
+        received = []
+
+        def chunk(events):
+            received.extend(events)
+            self.merge_events_by_date(events)
+            self.update_calendar()
+            self.update_events_list()
+
+        def loaded(response):
+            if response.status_code != 200 or response.data is not None:
+                print(f"Error fetching events: HTTP {response.status_code}")
+                return
+            # The stream is complete, so anything not in it was deleted upstream
+            self.loaded_range = (time_min, time_max)
+            self.events_etag = None
+            self.organize_events_by_date(received)
+            self.cache.replace(time_min.date(), time_max.date(), received)
+            self.update_calendar()
+            self.update_events_list()
+
+        self.api.stream('/events', chunk, loaded,
+                        lambda error: print(f"Error fetching events: {error}"),
+                        key='events', params=params)
     
+    def refresh_calendar(self, calendar_id):
+        # Reload one calendar over the loaded window and swap its events in place
+        requested_range = self.loaded_range
+        time_min, time_max = requested_range
+
+        def loaded(response):
+            if response.status_code == 200 and self.loaded_range == requested_range:
+                events = response.data
+                self.events_etag = None  # No longer matches what events_by_date holds
+                for date in list(self.events_by_date):
+                    kept = [e for e in self.events_by_date[date] if e.calendar_id != calendar_id]
+                    if kept:
+                        self.events_by_date[date] = kept
+                    else:
+                        del self.events_by_date[date]
+                self.add_events_by_date(events)
+                self.cache.replace(time_min.date(), time_max.date(), events, calendar_id)
+                self.update_calendar()
+                self.update_events_list()
+
+        self.api.request('GET', '/events', loaded,
+                         lambda error: print(f"Error refreshing calendar {calendar_id}: {error}"),
+                         key=('calendar', calendar_id), params={
+                             'timeMin': time_min.isoformat(),
+                             'timeMax': time_max.isoformat(),
+                             'calendarId': calendar_id,
+                         })
+
     def organize_events_by_date(self, events):
         self.events_by_date = {}
+        self.add_events_by_date(events)
+
+    def merge_events_by_date(self, events):
+        # Add streamed events, replacing any earlier copy of the same event (it may have moved day)
+        keys = {(event.get('calendarId'), event.get('eventId')) for event in events}
+        for day in list(self.events_by_date):
+            kept = [item for item in self.events_by_date[day] if event_key(item) not in keys]
+            if len(kept) != len(self.events_by_date[day]):
+                if kept:
+                    self.events_by_date[day] = kept
+                else:
+                    del self.events_by_date[day]
+        self.add_events_by_date(events)
+
+    def add_events_by_date(self, events):
+        touched = set()
         for event in events:
             try:
-                date = datetime.fromisoformat(event['start'].replace('Z', '+00:00')).date()
-                if date not in self.events_by_date:
-                    self.events_by_date[date] = []
-                self.events_by_date[date].append(event)
+                item = EventItem(event)
             except Exception as e:
                 print(f"Error parsing date for event: {event.get('summary', 'Unknown')} - {e}")
+                continue
+            if item.day not in self.events_by_date:
+                self.events_by_date[item.day] = []
+            self.events_by_date[item.day].append(item)
+            touched.add(item.day)
+        for day in touched:
+            self.events_by_date[day].sort(key=lambda item: item.start_ts)
 
     def update_calendar(self):
-        self.calendar.updateCells()
-    
-    def paintCell(self, painter, rect, date):
-        if date.toPyDate() in self.events_by_date:
-            painter.setBrush(QColor('#3498DB'))  # Use the same color for all events
-            painter.setPen(Qt.PenStyle.NoPen)  # No outline for the marker
-            marker_size = 6
+        self.calendar.set_events(self.events_by_date)
+        
+    def search_events(self):
+        query = self.search_input.text().strip()
+        if not query:
+            self.events_label.setText("Events for Selected Date")
+            self.update_events_list()
+            return
 
-            # Ensure all coordinates are cast to int
-            x = int(rect.center().x() - marker_size / 2)
-            y = int(rect.bottom() - marker_size - 2)
-            width = int(marker_size)
-            height = int(marker_size)
+        def found(response):
+            if response.status_code == 200 and self.search_input.text().strip() == query:
+                self.events_label.setText(f"Search Results ({response.data['total']})")
+                self.events_model.set_events([EventItem(event) for event in response.data['items']])
 
-            painter.drawEllipse(x, y, width, height)
+        # Superseding the 'search' key drops results for what was typed before
+        self.api.request('GET', '/search', found,
+                         lambda error: print(f"Error searching events: {error}"),
+                         key='search', params={'q': query, 'limit': SEARCH_LIMIT})
 
-
-
-        
     def update_events_list(self):
-        while self.events_layout.count():
-            child = self.events_layout.takeAt(0)
-            if child.widget():
-                child.widget().deleteLater()
-        
+        if self.search_input.text().strip():
+            return  # Search results stay up until the search is cleared
         selected_date = self.calendar.selectedDate().toPyDate()
-        
-        if selected_date in self.events_by_date:
-            for event in self.events_by_date[selected_date]:
-                event_widget = self.create_event_widget(event)
-                self.events_layout.addWidget(event_widget)
-    
-    def create_event_widget(self, event):
-        event_widget = QFrame()
-        event_widget.setStyleSheet("background-color: #2C3E50; margin: 5px; border-radius: 5px;")
-        layout = QVBoxLayout(event_widget)
-        
-        title = QLabel(f"Title: {event['summary']}")
-        start_time = datetime.fromisoformat(event['start'].replace('Z', '+00:00')).strftime("%H:%M")
-        end_time = datetime.fromisoformat(event['end'].replace('Z', '+00:00')).strftime("%H:%M")
-        time_label = QLabel(f"Time: {start_time} - {end_time}")
-        location = QLabel(f"Location: {event.get('location', 'N/A')}")
-        notes = QLabel(f"Notes: {event.get('notes', 'N/A')}")
-        
-        layout.addWidget(title)
-        layout.addWidget(time_label)
-        layout.addWidget(location)
-        layout.addWidget(notes)
-        
-        event_widget.setLayout(layout)
-        
-        return event_widget
+        self.events_model.set_events(self.events_by_date.get(selected_date, []))
     
 if __name__ == "__main__":
     app = QApplication(sys.argv)
+    app.setApplicationName("Calendar Widget")
     window = CalendarWidget()
     window.show()
     signal.signal(signal.SIGINT, signal.SIG_DFL)